@@ -0,0 +1,62 @@
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from benchmarks.synthetic import AREA
+
+# Geocoder locale per i benchmark: stessa interfaccia di geopy.Nominatim (geocode/reverse con
+# risultati che hanno latitude, longitude e raw), nessuna chiamata di rete.
+# Le coordinate sono ricavate dall'hash della query, quindi la stessa query dà sempre lo stesso
+# risultato; una frazione delle query (miss_rate) non viene trovata.
+# La latenza simulata permette di misurare l'effetto delle cache e della coalescenza delle chiamate.
+
+
+class FakeLocation:
+    def __init__(self, latitude: float, longitude: float, address: str, postcode: str):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.address = address
+        self.raw = {'lat': str(latitude), 'lon': str(longitude), 'display_name': address,
+                    'address': {'postcode': postcode}}
+
+
+class FakeGeocoder:
+    """
+    Sostituto deterministico di Nominatim.
+    @:param latency: Secondi di attesa simulati per ogni chiamata
+    @:param miss_rate: Frazione delle query senza risultato
+    """
+
+    def __init__(self, latency: float = 0.0, miss_rate: float = 0.0):
+        self.latency = latency
+        self.miss_rate = miss_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(text: str) -> int:
+        return int.from_bytes(hashlib.blake2b(text.lower().encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def geocode(self, query: str, *args, **kwargs) -> Optional[FakeLocation]:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        h = self._hash(str(query))
+        if (h % 10000) / 10000 < self.miss_rate:
+            return None
+        lat = AREA[0] + (h & 0xFFFFFFF) / 0xFFFFFFF * (AREA[1] - AREA[0])
+        lon = AREA[2] + ((h >> 28) & 0xFFFFFFF) / 0xFFFFFFF * (AREA[3] - AREA[2])
+        return FakeLocation(lat, lon, str(query), str(90001 + h % 2000))
+
+    def reverse(self, query, *args, **kwargs) -> Optional[FakeLocation]:
+        if isinstance(query, str):
+            lat, lon = (float(v) for v in query.split(','))
+        else:
+            lat, lon = query
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeLocation(lat, lon, f"{lat:.5f}, {lon:.5f}", '90001')
@@ -0,0 +1,362 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# Benchmark dei percorsi critici su dati sintetici (benchmarks/synthetic.py) e senza rete
+# (benchmarks/fake_geocoder.py). Per ogni caso e ogni dimensione dei dati vengono misurati:
+#   - setup: tempo e picco di memoria (tracemalloc) per costruire dati e indici;
+#   - latenza delle operazioni (p50/p95/p99, in microsecondi) e throughput (operazioni al secondo);
+#   - picco di memoria allocata durante le operazioni e RSS massimo del processo.
+# I risultati possono essere salvati in JSON (--output) e confrontati tra due commit (--compare).
+#
+# Uso (dalla root del progetto):
+#   python -m benchmarks.run --sizes 100 1000 10000 --output bench.json
+#   python -m benchmarks.run --cases suggest_street geojson_bbox --sizes 1000000
+#   python -m benchmarks.run --compare vecchio.json nuovo.json
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from benchmarks import synthetic
+from benchmarks.fake_geocoder import FakeGeocoder
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+DEFAULT_OPS = 200
+# Variazione della latenza p50 oltre la quale --compare segnala una regressione
+DEFAULT_THRESHOLD = 0.2
+
+
+class Case:
+    """
+    Caso di benchmark.
+    @:param name: Nome del caso
+    @:param setup: Funzione (n, cartella di lavoro) -> stato
+    @:param op: Funzione (stato, i) eseguita e cronometrata ad ogni operazione
+    @:param max_ops: Numero massimo di operazioni (per i casi lenti, es. caricamento di interi file)
+    """
+
+    def __init__(self, name: str, setup: Callable[[int, Path], Any], op: Callable[[Any, int], Any],
+                 max_ops: Optional[int] = None):
+        self.name = name
+        self.setup = setup
+        self.op = op
+        self.max_ops = max_ops
+
+
+# ==============================================================================
+# CASI
+# ==============================================================================
+
+def _shelters_setup(n: int, workdir: Path):
+    import scripts.posizione_utente as pu
+    df = synthetic.shelters(n)
+    # Database e indice globali, come dopo load_rifugi_db()
+    pu.rifugi_db = df
+    pu.rifugi_index = pu.build_rifugi_index(df)
+    pu.set_offline_geocoder(None)
+    qlat, qlon = synthetic.random_points(1000, seed=7)
+    streets = synthetic.street_names(1000)
+    return {'pu': pu, 'lat': df['Latitude'].to_numpy(), 'lon': df['Longitude'].to_numpy(), 'qlat': qlat,
+            'qlon': qlon, 'addresses': synthetic.addresses(1000, streets), 'geocoder': FakeGeocoder()}
+
+
+def _haversine(state, i):
+    k = i % len(state['qlat'])
+    d = state['pu'].haversine_distance(state['qlat'][k], state['qlon'][k], state['lat'], state['lon'])
+    return int(np.argmin(d))
+
+
+def _trova_rifugio(state, i):
+    return state['pu'].trova_rifugio_piu_vicino(state['addresses'][i % len(state['addresses'])],
+                                                geolocator=state['geocoder'], k=3)
+
+
+def _server_client():
+    from scripts import server
+    app = server.create_app(load=False)
+    app.config['READY'] = True
+    return server, app.test_client()
+
+
+def _street_entries(n: int) -> List[dict]:
+    df = synthetic.streets(n)
+    display = df['name'] + ', ' + df['city'] + ', ' + df['state']
+    lat = df['lat'].astype(object).where(df['lat'].notna(), None)
+    lon = df['lon'].astype(object).where(df['lon'].notna(), None)
+    return [{'name': a, 'city': b, 'state': c, 'display': d, 'lat': e, 'lon': f, 'postcode': g}
+            for a, b, c, d, e, f, g in zip(df['name'], df['city'], df['state'], display, lat, lon, df['postcode'])]
+
+
+def _suggest_setup(n: int, workdir: Path):
+    from scripts.geocode_cache import GeocodeCache
+    from scripts.street_autocomplete import StreetAutocomplete
+    server, client = _server_client()
+    entries = _street_entries(n)
+    server.STREET_NAMES = entries
+    server.STREET_INDEX = StreetAutocomplete(entries, limit=20)
+    server.GEOCODE_CACHE = GeocodeCache(None)
+    r = synthetic.rng(11)
+    # Prefissi di 2-8 caratteri e sottostringhe, come durante la digitazione
+    queries = []
+    for name in (entries[j]['name'] for j in r.integers(0, n, 1000)):
+        cut = int(r.integers(2, min(8, len(name)) + 1))
+        queries.append(name[:cut] if r.random() < 0.7 else name[1:cut + 1])
+    return {'client': client, 'queries': queries}
+
+
+def _suggest(state, i):
+    resp = state['client'].get('/api/suggest-street', query_string={'q': state['queries'][i % len(state['queries'])]})
+    assert resp.status_code == 200
+    return resp
+
+
+def _street_csv_setup(n: int, workdir: Path):
+    import scripts.db_queries.queries as queries
+    from scripts.dataset_store import DatasetStore
+    data_dir = workdir / 'dataset'
+    data_dir.mkdir()
+    synthetic.streets(n).to_csv(data_dir / 'strade_all_enriched.csv', index=False)
+    queries.DATA_DIR = data_dir
+    queries.DATASETS = DatasetStore(data_dir / '.columnar')
+    # Primo caricamento (CSV -> copia colonnare), riportato a parte
+    start = time.perf_counter()
+    queries.load_street_names()
+    return {'queries': queries, 'extra': {'cold_s': time.perf_counter() - start}}
+
+
+def _load_streets(state, i):
+    return state['queries'].load_street_names()
+
+
+def _merge_setup(n: int, workdir: Path):
+    import scripts.db_queries.queries as queries
+    from scripts.dataset_store import DatasetStore
+    data_dir = workdir / 'dataset'
+    data_dir.mkdir()
+    synthetic.city_street_files(n, data_dir)
+    queries.DATA_DIR = data_dir
+    queries.DATASETS = DatasetStore(data_dir / '.columnar')
+    start = time.perf_counter()
+    queries.merge_streets(data_dir / 'strade_all_unique.csv')
+    return {'queries': queries, 'out': data_dir / 'strade_all_unique.csv',
+            'extra': {'cold_s': time.perf_counter() - start}}
+
+
+def _merge(state, i):
+    return state['queries'].merge_streets(state['out'])
+
+
+def _geojson_setup(n: int, workdir: Path):
+    from scripts.geojson_store import GeoJSONStore
+    server, client = _server_client()
+    geojson_dir = workdir / 'geojson'
+    synthetic.write_geojson(synthetic.point_features(n), geojson_dir / 'animali_randagi.geojson')
+    server.GEOJSON_DIR = geojson_dir
+    server.GEOJSON_STORE = GeoJSONStore(geojson_dir)
+    server.GEOJSON_STORE.preload()
+    r = synthetic.rng(13)
+    # Finestre pari a circa l'1% dell'area
+    lat0 = r.uniform(synthetic.AREA[0], synthetic.AREA[1] - 0.08, 1000)
+    lon0 = r.uniform(synthetic.AREA[2], synthetic.AREA[3] - 0.1, 1000)
+    bboxes = [f"{x:.5f},{y:.5f},{x + 0.1:.5f},{y + 0.08:.5f}" for x, y in zip(lon0, lat0)]
+    state = {'client': client, 'bboxes': bboxes, 'url': '/api/geojson/animali_randagi'}
+    # Prima richiesta per bbox: costruzione dell'indice STR, riportata a parte
+    start = time.perf_counter()
+    client.get(state['url'], query_string={'bbox': bboxes[0]})
+    state['extra'] = {'index_build_s': time.perf_counter() - start}
+    return state
+
+
+def _geojson_full(state, i):
+    resp = state['client'].get(state['url'], headers={'Accept-Encoding': 'br, gzip'})
+    assert resp.status_code == 200
+    return resp
+
+
+def _geojson_bbox(state, i):
+    resp = state['client'].get(state['url'], query_string={'bbox': state['bboxes'][i % len(state['bboxes'])]},
+                               headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    return resp
+
+
+def _cache_setup(n: int, workdir: Path):
+    from scripts.geocode_cache import GeocodeCache
+    cache = GeocodeCache(workdir / 'geocode_cache.sqlite')
+    lat, lon = synthetic.random_points(n)
+    for j in range(n):
+        cache.set(f"strada {j}, long beach", {'lat': float(lat[j]), 'lon': float(lon[j]), 'postcode': '90802'})
+    r = synthetic.rng(17)
+    # 80% chiavi presenti, 20% assenti
+    keys = [f"strada {j}, long beach" if r.random() < 0.8 else f"assente {j}" for j in r.integers(0, n, 1000)]
+    return {'cache': cache, 'keys': keys}
+
+
+def _cache_get(state, i):
+    return state['cache'].get(state['keys'][i % len(state['keys'])])
+
+
+CASES: Dict[str, Case] = {c.name: c for c in [
+    Case('haversine_distance', _shelters_setup, _haversine),
+    Case('trova_rifugio_piu_vicino', _shelters_setup, _trova_rifugio),
+    Case('suggest_street', _suggest_setup, _suggest),
+    Case('load_street_names', _street_csv_setup, _load_streets, max_ops=10),
+    Case('merge_streets', _merge_setup, _merge, max_ops=10),
+    Case('geojson_full', _geojson_setup, _geojson_full),
+    Case('geojson_bbox', _geojson_setup, _geojson_bbox),
+    Case('geocode_cache', _cache_setup, _cache_get),
+]}
+
+
+# ==============================================================================
+# MISURA
+# ==============================================================================
+
+def _max_rss_mb() -> float:
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def measure(bench: Case, n: int, ops: int, warmup: int = 5) -> dict:
+    """
+    Esegue un caso con n elementi e restituisce le misure.
+    @:param bench: Caso di benchmark
+    @:param n: Dimensione dei dati sintetici
+    @:param ops: Operazioni cronometrate
+    @:param warmup: Operazioni eseguite prima della misura
+    """
+    ops = min(ops, bench.max_ops) if bench.max_ops else ops
+    with tempfile.TemporaryDirectory(prefix=f'bench-{bench.name}-') as tmp, \
+            contextlib.redirect_stdout(io.StringIO()):
+        gc.collect()
+        # Il tempo di setup comprende il costo di tracemalloc: è confrontabile solo tra esecuzioni del benchmark
+        tracemalloc.start()
+        start = time.perf_counter()
+        state = bench.setup(n, Path(tmp))
+        setup_s = time.perf_counter() - start
+        _, setup_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        for i in range(min(warmup, ops)):
+            bench.op(state, i)
+
+        times = np.empty(ops)
+        total_start = time.perf_counter()
+        for i in range(ops):
+            t0 = time.perf_counter_ns()
+            bench.op(state, i)
+            times[i] = time.perf_counter_ns() - t0
+        total = time.perf_counter() - total_start
+
+        # Memoria allocata dalle operazioni (misurata a parte: tracemalloc rallenta l'esecuzione)
+        tracemalloc.start()
+        for i in range(min(10, ops)):
+            bench.op(state, i)
+        _, op_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        extra = state.get('extra', {}) if isinstance(state, dict) else {}
+        del state
+        gc.collect()
+
+    times /= 1000.0
+    return {
+        'case': bench.name, 'n': n, 'ops': ops,
+        'setup_s': round(setup_s, 4), 'setup_peak_mb': round(setup_peak / 2 ** 20, 2),
+        'p50_us': round(float(np.percentile(times, 50)), 2), 'p95_us': round(float(np.percentile(times, 95)), 2),
+        'p99_us': round(float(np.percentile(times, 99)), 2), 'mean_us': round(float(times.mean()), 2),
+        'ops_per_s': round(ops / total, 1) if total > 0 else None,
+        'op_peak_kb': round(op_peak / 1024, 1), 'max_rss_mb': round(_max_rss_mb(), 1),
+        'extra': {k: round(v, 4) for k, v in extra.items()},
+    }
+
+
+def environment() -> dict:
+    """Informazioni sull'ambiente e sul commit, salvate con i risultati."""
+    import pandas as pd
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def print_table(results: List[dict]):
+    header = f"{'caso':<26}{'n':>10}{'setup s':>10}{'p50 us':>11}{'p95 us':>11}{'p99 us':>11}{'op/s':>11}{'setup MB':>10}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['case']:<26}{r['n']:>10}{r['setup_s']:>10.3f}{r['p50_us']:>11.1f}{r['p95_us']:>11.1f}"
+              f"{r['p99_us']:>11.1f}{r['ops_per_s'] or 0:>11.1f}{r['setup_peak_mb']:>10.1f}")
+
+
+def compare(base: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> int:
+    """
+    Confronta due file di risultati (stessi casi e dimensioni).
+    @:return: Numero di regressioni (p50 peggiorata oltre la soglia)
+    """
+    old = {(r['case'], r['n']): r for r in base['results']}
+    print(f"Base: {base['env'].get('commit')}  Nuovo: {new['env'].get('commit')}  (soglia {threshold:.0%})")
+    print(f"{'caso':<26}{'n':>10}{'p50 base':>12}{'p50 nuovo':>12}{'variazione':>12}")
+    regressions = 0
+    for r in new['results']:
+        b = old.get((r['case'], r['n']))
+        if b is None or not b['p50_us']:
+            continue
+        change = r['p50_us'] / b['p50_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSIONE'
+            regressions += 1
+        print(f"{r['case']:<26}{r['n']:>10}{b['p50_us']:>12.1f}{r['p50_us']:>12.1f}{change:>+12.1%}{flag}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi critici su dati sintetici.")
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES), help="Casi da eseguire")
+    parser.add_argument('--sizes', nargs='+', type=lambda v: int(float(v)), default=list(DEFAULT_SIZES),
+                        help="Dimensioni dei dati (es. 1e2 1e4 1e7)")
+    parser.add_argument('--ops', type=int, default=DEFAULT_OPS, help="Operazioni cronometrate per caso")
+    parser.add_argument('--output', help="File JSON in cui salvare i risultati")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NUOVO'), help="Confronta due file di risultati")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Soglia di regressione")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        base, new = (json.loads(Path(p).read_text(encoding='utf-8')) for p in args.compare)
+        return 1 if compare(base, new, args.threshold) else 0
+
+    results = []
+    for name in args.cases:
+        for n in args.sizes:
+            print(f"{name} n={n}...", file=sys.stderr, flush=True)
+            results.append(measure(CASES[name], n, args.ops))
+    print_table(results)
+    if args.output:
+        Path(args.output).write_text(json.dumps({'env': environment(), 'results': results}, indent=2),
+                                     encoding='utf-8')
+        print(f"Risultati salvati in {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import json
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+# Generatori di dati sintetici per i benchmark, riproducibili (seme fisso) e scalabili da 10^2 a 10^7.
+# I dati hanno lo stesso formato dei file reali in dataset/ e animali_qgis/geojson/ e cadono
+# nell'area coperta dal progetto (contea di Los Angeles / Orange).
+
+SEED = 42
+# Bounding box dell'area (lat_min, lat_max, lon_min, lon_max)
+AREA = (33.6, 34.4, -118.7, -117.7)
+CITIES = ('Long Beach', 'Los Angeles', 'Orange')
+STREET_TYPES = ('St', 'Ave', 'Blvd', 'Dr', 'Rd', 'Way', 'Pl', 'Ln', 'Ct')
+# Sillabe da cui sono composti i nomi delle strade (nomi pronunciabili, con prefissi condivisi)
+_SILLABE = ('an', 'a', 'he', 'im', 'cal', 'li', 'for', 'ni', 'pa', 'ci', 'fic', 'o', 'ce', 'sun',
+            'set', 'ma', 'ple', 'wood', 'lake', 'view', 'hill', 'cres', 'ver', 'del', 'mar')
+
+
+def rng(seed: int = SEED) -> np.random.Generator:
+    return np.random.default_rng(seed)
+
+
+def random_points(n: int, seed: int = SEED):
+    """n coordinate (lat, lon) uniformi nell'area."""
+    r = rng(seed)
+    return r.uniform(AREA[0], AREA[1], n), r.uniform(AREA[2], AREA[3], n)
+
+
+def shelters(n: int, seed: int = SEED) -> pd.DataFrame:
+    """Rifugi nel formato di rifugi_locations.csv."""
+    lat, lon = random_points(n, seed)
+    r = rng(seed + 1)
+    return pd.DataFrame({
+        'Shelter_Name': [f"Shelter {i}" for i in range(n)],
+        'Address': [f"{num} Main St" for num in r.integers(1, 9999, n)],
+        'City': r.choice(CITIES, n),
+        'Latitude': lat,
+        'Longitude': lon,
+    })
+
+
+def street_names(n: int, seed: int = SEED) -> List[str]:
+    """n nomi di strada distinti e pronunciabili ("Anhe St", "Calimar Ave", ...)."""
+    r = rng(seed)
+    # Ogni numero (in ordine casuale) scritto in base len(_SILLABE), una sillaba per cifra
+    codes = r.permutation(n) + len(_SILLABE)
+    kinds = r.integers(0, len(STREET_TYPES), n)
+    base = len(_SILLABE)
+    names = []
+    for code, kind in zip(codes.tolist(), kinds.tolist()):
+        parts = []
+        while code:
+            code, digit = divmod(code, base)
+            parts.append(_SILLABE[digit])
+        names.append(f"{''.join(parts).capitalize()} {STREET_TYPES[kind]}")
+    return names
+
+
+def streets(n: int, seed: int = SEED, enriched: bool = True) -> pd.DataFrame:
+    """Strade nel formato di strade_all_enriched.csv (o strade_all_unique.csv se enriched=False)."""
+    r = rng(seed + 2)
+    df = pd.DataFrame({'name': street_names(n, seed), 'city': r.choice(CITIES, n), 'state': 'CA'})
+    if enriched:
+        lat, lon = random_points(n, seed + 3)
+        # Un quinto delle strade senza coordinate, come dopo un arricchimento parziale
+        missing = r.random(n) < 0.2
+        df['lat'] = np.where(missing, np.nan, lat)
+        df['lon'] = np.where(missing, np.nan, lon)
+        df['postcode'] = np.where(missing, None, r.integers(90001, 92899, n).astype(str))
+    return df
+
+
+def city_street_files(n: int, directory: Path, seed: int = SEED) -> List[Path]:
+    """File strade_<città>_cleaned.csv letti da merge_streets (n nomi in totale, con duplicati)."""
+    names = street_names(n, seed)
+    paths = []
+    for i, stem in enumerate(('long_beach', 'los_angeles', 'orange_city')):
+        path = Path(directory) / f"strade_{stem}_cleaned.csv"
+        # Un decimo di duplicati (stesso nome, maiuscole e spazi diversi)
+        part = names[i::3]
+        dup = [f"  {nm.upper()} " for nm in part[::10]]
+        pd.DataFrame({'name': part + dup, 'osm_id': np.arange(len(part) + len(dup))}).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def point_features(n: int, seed: int = SEED) -> dict:
+    """FeatureCollection di n punti con proprietà simili ai layer degli animali."""
+    lat, lon = random_points(n, seed)
+    r = rng(seed + 4)
+    species = np.array(['Dog', 'Cat', 'Bird', 'Rabbit', 'Other'])[r.integers(0, 5, n)]
+    features = [
+        {'type': 'Feature',
+         'properties': {'Animal Name': f"A{i}", 'Animal Type': str(s), 'Intake Date': '2023-05-01'},
+         'geometry': {'type': 'Point', 'coordinates': [round(float(x), 6), round(float(y), 6)]}}
+        for i, (x, y, s) in enumerate(zip(lon, lat, species))
+    ]
+    return {'type': 'FeatureCollection', 'name': 'synthetic', 'features': features}
+
+
+def write_geojson(collection: dict, path: Path) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(collection, separators=(',', ':')), encoding='utf-8')
+    return path
+
+
+def addresses(n: int, street_list: List[str], seed: int = SEED) -> List[str]:
+    """Indirizzi "civico via, città" costruiti sulle strade indicate."""
+    r = rng(seed + 5)
+    picks = r.integers(0, len(street_list), n)
+    numbers = r.integers(1, 9999, n)
+    cities = r.choice(CITIES, n)
+    return [f"{num} {street_list[p]}, {city}" for num, p, city in zip(numbers, picks, cities)]
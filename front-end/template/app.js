@@ -46,6 +46,9 @@ if (swipeHeader) swipeHeader.textContent = "Analisi Prevalenza Animali Selvatici
 // ==========================================
 let map = null;
 let userMarker = null;
+// Punto scelto con un click sulla mappa: finché il testo non viene modificato, la ricerca usa
+// queste coordinate e non l'indirizzo (che è solo la strada più vicina, senza civico)
+let posizioneScelta = null;
 let shelterMarker = null;
 let routingControl = null;
 
@@ -59,14 +62,17 @@ let centriFocolaiLayer = null;
 let mapSwipe = null;
 let swipeLeftGroup = null;
 let swipeRightGroup = null;
+let swipeLeftMarkers = null;   // cluster/punti Animali Domestici (dal server)
+let swipeRightMarkers = null;  // cluster/punti Fauna Selvatica (dal server)
+let swipeClusterRequest = 0;
 let rawDomesticData = null; // Owner Surrender
 let rawWildData = null;     // Wildlife
 
 // Randagi
 let mapRandagi = null;
 let pieChart = null;
-let randagiDataFeatures = [];
-let monthBuckets = {};
+let monthBuckets = {};      // mese -> Promise delle feature del mese (scaricate su richiesta)
+let randagiVersion = null;
 let sortedMonthKeys = [];
 let currentMonthIndex = 0;
 let animationTimer = null;
@@ -77,6 +83,7 @@ let randagiLayerGroup = null;
 let mapDifficili = null;
 let difficiliLayer = null;
 let difficiliLegendControl = null;
+let difficiliEtag = null;
 
 // Pool immagini
 const animalMediaPool = [
@@ -171,18 +178,24 @@ function initMap(lat = 34.0219, lng = -118.4814, zoom = 10) {
         const clickedLng = e.latlng.lng;
 
         userMarker = L.marker([clickedLat, clickedLng]).addTo(map).bindPopup('Posizione selezionata').openPopup();
+        posizioneScelta = { lat: clickedLat, lon: clickedLng };
         indirizzoInput.value = "Recupero indirizzo...";
 
         try {
-            const response = await fetch(`https://nominatim.openstreetmap.org/reverse?format=jsonv2&lat=${clickedLat}&lon=${clickedLng}`);
+            // Strada più vicina risolta dal server (dataset locale, Nominatim solo come ripiego)
+            const response = await fetch(`/api/reverse-geocode?lat=${clickedLat}&lon=${clickedLng}`);
             if (!response.ok) throw new Error("Errore geocoding");
             const data = await response.json();
-            if (data && data.display_name) indirizzoInput.value = data.display_name;
+            if (data && data.display) indirizzoInput.value = data.display;
             else indirizzoInput.value = `${clickedLat.toFixed(5)}, ${clickedLng.toFixed(5)}`;
         } catch (err) {
             console.warn("Errore reverse geocoding:", err);
             indirizzoInput.value = `${clickedLat.toFixed(5)}, ${clickedLng.toFixed(5)}`;
         }
+        // Un click successivo può essere arrivato durante l'attesa
+        if (posizioneScelta && posizioneScelta.lat === clickedLat && posizioneScelta.lon === clickedLng) {
+            posizioneScelta.testo = indirizzoInput.value;
+        }
     });
   } else {
     map.setView([lat, lng], zoom);
@@ -204,6 +217,9 @@ if (form) {
       e.preventDefault();
       const indirizzo = indirizzoInput.value.trim();
       if (!indirizzo) { showFeedback('Inserisci un indirizzo valido.', true); return; }
+      // Testo non modificato dopo il click sulla mappa: si cerca dal punto esatto
+      const daMappa = posizioneScelta && posizioneScelta.testo === indirizzoInput.value;
+      const richiesta = daMappa ? { lat: posizioneScelta.lat, lon: posizioneScelta.lon } : { indirizzo };
 
       setButtonLoading(true);
       showFeedback('Sto cercando il rifugio più vicino...', false, true);
@@ -213,7 +229,7 @@ if (form) {
         const resp = await fetch('/api/nearest', {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ indirizzo })
+          body: JSON.stringify(richiesta)
         });
         const json = await resp.json();
         if (!resp.ok || !json.successo) {
@@ -347,6 +363,7 @@ async function selectAutocomplete(i) {
   const item = acItems[i]._ac_item;
   if (!item) return;
   const val = typeof item === 'string' ? item : (item.display || item.name);
+  posizioneScelta = null;
   indirizzoInput.value = val;
   if (item.postcode && !val.includes(item.postcode)) {
     indirizzoInput.value += `, ${item.postcode}`;
@@ -380,7 +397,13 @@ async function fetchSuggestions(q) {
   if (acAbortController) acAbortController.abort();
   acAbortController = new AbortController();
   try {
-    const res = await fetch(`/api/suggest-street?q=${encodeURIComponent(q)}`, {signal: acAbortController.signal});
+    let url = `/api/suggest-street?q=${encodeURIComponent(q)}`;
+    // Con una posizione già scelta i suggerimenti vicini vengono mostrati per primi
+    if (userMarker) {
+      const pos = userMarker.getLatLng();
+      url += `&lat=${pos.lat}&lon=${pos.lng}`;
+    }
+    const res = await fetch(url, {signal: acAbortController.signal});
     if (!res.ok) return [];
     const j = await res.json();
     return j.suggestions || [];
@@ -393,6 +416,8 @@ function debounce(fn, ms) {
 }
 
 if (indirizzoInput) {
+    // Testo modificato dall'utente: il punto scelto sulla mappa non vale più
+    indirizzoInput.addEventListener('input', () => { posizioneScelta = null; });
     indirizzoInput.addEventListener('input', debounce(async () => {
       const v = indirizzoInput.value.trim();
       if (!v) { clearAutocomplete(); return; }
@@ -702,48 +727,30 @@ async function loadSwipeMap() {
   showFeedback('Carico Mappa Confronto...', false, true);
   try {
     // 1. Carica Animali Domestici (OWNER SURRENDER) - Sinistra
+    // I marker arrivano già raggruppati dal server (vedi refreshSwipeClusters),
+    // i dati completi servono solo al Radar di Conflitto
     const resLeft = await fetch('/api/geojson/Animali Domestici.geojson');
+    swipeLeftGroup.clearLayers();
+    swipeLeftMarkers = L.layerGroup().addTo(swipeLeftGroup);
     if (resLeft.ok) {
       const data = await resLeft.json();
       rawDomesticData = data.features; // Salva dati
-      swipeLeftGroup.clearLayers();
-      L.geoJSON(data, {
-        pointToLayer: (f, latlng) => L.circleMarker(latlng, { radius:6, fillColor:'#ff7b7b', color:'#fff', weight:1, fillOpacity:0.9 }),
-        onEachFeature: (feature, layer) => {
-          const p = feature.properties || {};
-          layer.bindPopup(createSwipePopupContent(p));
-          layer.on('click', L.DomEvent.stopPropagation);
-        }
-      }).addTo(swipeLeftGroup);
     }
 
     // 2. Carica Fauna Selvatica (WILDLIFE) - Destra
     const resRight = await fetch('/api/geojson/Fauna Selvatica.geojson');
-    const resHeat = await fetch('/api/geojson/Fauna Selvatica -Heatmap.geojson');
 
     swipeRightGroup.clearLayers();
+    // Heatmap calcolata dal server e servita come tile PNG
+    L.tileLayer('/api/heatmap/fauna_selvatica/{z}/{x}/{y}.png', { maxZoom: 19, opacity: 0.8 }).addTo(swipeRightGroup);
+    swipeRightMarkers = L.layerGroup().addTo(swipeRightGroup);
     if (resRight.ok) {
       const data = await resRight.json();
       rawWildData = data.features; // Salva dati
-      L.geoJSON(data, {
-        pointToLayer: (f, latlng) => L.circleMarker(latlng, { radius:6, fillColor:'#7bdcff', color:'#fff', weight:1, fillOpacity:0.9 }),
-        onEachFeature: (feature, layer) => {
-          const p = feature.properties || {};
-          layer.bindPopup(createSwipePopupContent(p));
-          layer.on('click', L.DomEvent.stopPropagation);
-        }
-      }).addTo(swipeRightGroup);
     }
 
-    if (resHeat.ok) {
-      const heatData = await resHeat.json();
-      const heatPoints = [];
-      for (const f of heatData.features) {
-        const c = extractCoords(f.geometry);
-        if (c) heatPoints.push([c[0], c[1], 0.6]);
-      }
-      if (heatPoints.length) L.heatLayer(heatPoints, { radius: 25, blur: 15, maxZoom: 17 }).addTo(swipeRightGroup);
-    }
+    await refreshSwipeClusters();
+    mapSwipe.on('moveend', refreshSwipeClusters);
 
     // Listener per Radar di Conflitto
     mapSwipe.on('click', onSwipeMapClick);
@@ -757,14 +764,60 @@ async function loadSwipeMap() {
   }
 }
 
+// Cluster (o singoli punti ad alto zoom) della porzione visibile della mappa, calcolati dal server
+async function refreshSwipeClusters() {
+  if (!mapSwipe) return;
+  const requestId = ++swipeClusterRequest;
+  const b = mapSwipe.getBounds();
+  const query = `bbox=${b.getWest()},${b.getSouth()},${b.getEast()},${b.getNorth()}&zoom=${mapSwipe.getZoom()}`;
+  try {
+    const [left, right] = await Promise.all([
+      fetch(`/api/clusters/animali_domestici?${query}`).then(r => r.ok ? r.json() : null),
+      fetch(`/api/clusters/fauna_selvatica?${query}`).then(r => r.ok ? r.json() : null)
+    ]);
+    // Una risposta arrivata dopo uno spostamento successivo non va disegnata
+    if (requestId !== swipeClusterRequest) return;
+    drawClusterMarkers(left, swipeLeftMarkers, '#ff7b7b');
+    drawClusterMarkers(right, swipeRightMarkers, '#7bdcff');
+  } catch (e) {
+    console.warn('refreshSwipeClusters error', e);
+  }
+}
+
+function drawClusterMarkers(data, group, color) {
+  if (!group || !data) return;
+  group.clearLayers();
+  L.geoJSON(data, {
+    pointToLayer: (f, latlng) => {
+      const p = f.properties || {};
+      if (!p.cluster) return L.circleMarker(latlng, { radius:6, fillColor:color, color:'#fff', weight:1, fillOpacity:0.9 });
+      const radius = Math.min(24, 8 + Math.log2(p.point_count) * 2);
+      return L.circleMarker(latlng, { radius: radius, fillColor:color, color:'#fff', weight:2, fillOpacity:0.75 })
+        .bindTooltip(String(p.point_count_abbreviated), { permanent: true, direction: 'center' });
+    },
+    onEachFeature: (feature, layer) => {
+      const p = feature.properties || {};
+      if (p.cluster) {
+        // Click su un cluster: zoom al livello in cui si divide
+        layer.on('click', (e) => { L.DomEvent.stopPropagation(e); mapSwipe.setView(layer.getLatLng(), p.expansion_zoom); });
+      } else {
+        layer.bindPopup(createSwipePopupContent(p));
+        layer.on('click', L.DomEvent.stopPropagation);
+      }
+    }
+  }).addTo(group);
+}
+
 function destroySwipeMap() {
   try {
     if (mapSwipe) {
       mapSwipe.off('click', onSwipeMapClick);
+      mapSwipe.off('moveend', refreshSwipeClusters);
       if (swipeLeftGroup) try { swipeLeftGroup.clearLayers(); } catch(e){}
       if (swipeRightGroup) try { swipeRightGroup.clearLayers(); } catch(e){}
       mapSwipe.remove();
       mapSwipe = null; swipeLeftGroup = null; swipeRightGroup = null;
+      swipeLeftMarkers = null; swipeRightMarkers = null;
       rawDomesticData = null;
       rawWildData = null;
     }
@@ -896,7 +949,6 @@ function destroyRandagiMap() {
         if (controls) controls.remove();
         if (randagiLayerGroup) { randagiLayerGroup.clearLayers(); randagiLayerGroup = null; }
         if (mapRandagi) { mapRandagi.remove(); mapRandagi = null; }
-        randagiDataFeatures = [];
         monthBuckets = {};
         sortedMonthKeys = [];
         if (randagiContainer) randagiContainer.classList.add('hidden');
@@ -906,44 +958,21 @@ function destroyRandagiMap() {
 async function loadRandagiData() {
     showRandagiFeedback('Caricamento dati...', false);
     try {
-        const res = await fetch(`/api/geojson/animali_randagi?_=${Date.now()}`);
+        // Il server raggruppa e deduplica gli animali per mese: qui arriva solo il riepilogo
+        const res = await fetch('/api/randagi/mesi');
         if (!res.ok) throw new Error('Errore fetch');
         const data = await res.json();
-        if (!data || !data.features || data.features.length === 0) {
+        if (!data || !data.mesi || data.mesi.length === 0) {
             showRandagiFeedback('Nessun dato trovato.', true);
             return;
         }
-        randagiDataFeatures = data.features;
         initRandagiMap();
 
+        randagiVersion = data.versione;
         monthBuckets = {};
-        randagiDataFeatures.forEach(f => {
-            const p = f.properties || {};
-            let rawDate = getVal(p, DATE_KEYS);
-            let monthKey = 'Unknown';
-            if (rawDate) {
-                const d = new Date(rawDate);
-                if (!isNaN(d.getTime())) {
-                    const m = String(d.getUTCMonth() + 1).padStart(2, '0');
-                    const y = d.getUTCFullYear();
-                    monthKey = `${y}-${m}`;
-                }
-            }
-            if (!monthBuckets[monthKey]) monthBuckets[monthKey] = [];
-            f._monthKey = monthKey;
-
-            const name = getVal(p, NAME_KEYS) || 'unknown';
-            const species = getVal(p, TYPE_KEYS) || 'unknown';
-            const dateStr = rawDate ? new Date(rawDate).toISOString().split('T')[0] : 'nodate';
-            const shelterName = getVal(p, SHELTER_KEYS) || 'unknown';
-            const compositeId = `${name}-${species}-${dateStr}-${shelterName}`.toLowerCase().replace(/[^a-z0-9]/g, '');
-            f._safeId = compositeId;
-            monthBuckets[monthKey].push(f);
-        });
-
-        sortedMonthKeys = Object.keys(monthBuckets).filter(k => k !== 'Unknown').sort();
-        if (monthBuckets['Unknown']) sortedMonthKeys.push('Unknown');
-        currentMonthIndex = sortedMonthKeys.length > 0 ? 0 : 0;
+        // Ordine cronologico già fornito dal server ('Unknown' in fondo)
+        sortedMonthKeys = data.mesi.map(m => m.mese);
+        currentMonthIndex = 0;
 
         setupRandagiControls();
         renderMonthState();
@@ -954,6 +983,19 @@ async function loadRandagiData() {
     }
 }
 
+// Feature (già deduplicate) di un mese; con soloNuovi solo gli animali non visti nei mesi precedenti
+function getMonthFeatures(key, soloNuovi = false) {
+    const cacheKey = soloNuovi ? `${key}#nuovi` : key;
+    if (!monthBuckets[cacheKey]) {
+        const url = `/api/randagi/mese/${encodeURIComponent(key)}?v=${randagiVersion}${soloNuovi ? '&nuovi=1' : ''}`;
+        monthBuckets[cacheKey] = fetch(url)
+            .then(res => { if (!res.ok) throw new Error('Errore fetch'); return res.json(); })
+            .then(data => (data.features || []).map(f => { f._safeId = f.id; f._monthKey = key; return f; }))
+            .catch(e => { delete monthBuckets[cacheKey]; throw e; });
+    }
+    return monthBuckets[cacheKey];
+}
+
 function setupRandagiControls() {
     const old = document.getElementById('randagi-controls-ui');
     if (old) old.remove();
@@ -1039,12 +1081,18 @@ function renderMonthState() {
         }
     }
     if (!isAnimating) {
-        randagiLayerGroup.clearLayers();
-        const features = monthBuckets[key] || [];
-        const uniqueFeatures = getUniqueFeatures(features);
-        addFeaturesToMap(uniqueFeatures);
-        buildRandagiTable(uniqueFeatures);
-        updateChartFromFeatures(uniqueFeatures);
+        getMonthFeatures(key).then(features => {
+            // Nel frattempo l'utente potrebbe aver cambiato mese o avviato l'animazione
+            if (isAnimating || sortedMonthKeys[currentMonthIndex] !== key || !randagiLayerGroup) return;
+            randagiLayerGroup.clearLayers();
+            const uniqueFeatures = getUniqueFeatures(features);
+            addFeaturesToMap(uniqueFeatures);
+            buildRandagiTable(uniqueFeatures);
+            updateChartFromFeatures(uniqueFeatures);
+        }).catch(e => {
+            console.error(e);
+            showRandagiFeedback('Errore caricamento.', true);
+        });
     }
 }
 
@@ -1090,10 +1138,21 @@ function startAnimation() {
     const accumulatedFeatures = [];
     const seenIds = new Set();
     const animationCounts = { 'dog': 0, 'cat': 0, 'bird': 0, 'rabbit': 0, 'other': 0 };
-    const step = () => {
+    const step = async () => {
+        if (!isAnimating) return;
         if (currentMonthIndex >= sortedMonthKeys.length) { stopAnimation(false); return; }
         const key = sortedMonthKeys[currentMonthIndex];
-        const rawFeats = monthBuckets[key] || [];
+        let rawFeats = [];
+        try {
+            rawFeats = await getMonthFeatures(key, true);
+        } catch (e) {
+            console.error(e);
+        }
+        if (!isAnimating) return;
+        // Il mese successivo si scarica mentre si mostra quello corrente
+        if (currentMonthIndex + 1 < sortedMonthKeys.length) {
+            getMonthFeatures(sortedMonthKeys[currentMonthIndex + 1], true).catch(() => {});
+        }
         const newUniqueFeats = [];
         rawFeats.forEach(f => {
             if(!seenIds.has(f._safeId)) {
@@ -1110,14 +1169,14 @@ function startAnimation() {
         buildRandagiTable(accumulatedFeatures);
         updateChartFromFeatures(accumulatedFeatures);
         currentMonthIndex++;
+        animationTimer = setTimeout(step, 800);
     };
     step();
-    animationTimer = setInterval(step, 800);
 }
 
 function stopAnimation(resetToSingle = true) {
     isAnimating = false;
-    if (animationTimer) { clearInterval(animationTimer); animationTimer = null; }
+    if (animationTimer) { clearTimeout(animationTimer); animationTimer = null; }
     const btn = document.getElementById('randagi-btn-play');
     if (btn) { btn.innerHTML = '▶ Animazione Totale'; btn.classList.remove('active'); }
     if (resetToSingle && sortedMonthKeys.length > 0) {
@@ -1252,17 +1311,23 @@ function initDifficiliMap() {
     if (mapDifficili) { setTimeout(() => mapDifficili.invalidateSize(), 100); return; }
     mapDifficili = L.map('map-difficili').setView([34.0522, -118.2437], 10);
     L.tileLayer('https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png', { attribution: '© OpenStreetMap' }).addTo(mapDifficili);
+    // Il server fornisce geometrie semplificate per livello di zoom: si ricarica al cambio di zoom
+    mapDifficili.on('zoomend', () => { if (difficiliLayer) loadDifficiliData(false); });
 }
 
-async function loadDifficiliData() {
+async function loadDifficiliData(fit = true) {
     if (!mapDifficili) return;
     try {
-        const res = await fetch('/api/geojson/animali_difficili');
+        const res = await fetch(`/api/geojson/animali_difficili?zoom=${Math.round(mapDifficili.getZoom())}`);
         if (!res.ok) throw new Error(`Errore Server: ${res.status}`);
+        // Stessa versione già disegnata (stesso ETag): niente da ridisegnare
+        const etag = res.headers.get('ETag');
+        if (!fit && difficiliLayer && etag && etag === difficiliEtag) return;
         const data = await res.json();
+        difficiliEtag = etag;
         if (difficiliLayer) mapDifficili.removeLayer(difficiliLayer);
         difficiliLayer = L.geoJson(data, { style: styleDifficili, onEachFeature: onEachFeatureDifficili }).addTo(mapDifficili);
-        if (data.features && data.features.length > 0) mapDifficili.fitBounds(difficiliLayer.getBounds());
+        if (fit && data.features && data.features.length > 0) mapDifficili.fitBounds(difficiliLayer.getBounds());
         buildDifficiliLegend();
     } catch (e) {
         console.error("ERRORE CARICAMENTO:", e);
@@ -1322,7 +1387,7 @@ function destroyDifficiliMap() {
             }
             if (difficiliLayer) mapDifficili.removeLayer(difficiliLayer);
             mapDifficili.remove();
-            mapDifficili = null; difficiliLayer = null;
+            mapDifficili = null; difficiliLayer = null; difficiliEtag = null;
         }
     } catch (e) { console.warn('destroyDifficiliMap error', e); }
 }
@@ -0,0 +1,261 @@
+import re
+from functools import lru_cache
+from typing import List, Optional
+
+# Scomposizione e normalizzazione degli indirizzi statunitensi digitati dagli utenti.
+# Un indirizzo ("4000 East Anaheim Street, Long Beach, CA 90804") viene scomposto in civico,
+# direzione, nome della via, tipo di via, unità (apt/suite), città, stato e CAP; tipi di via e
+# direzioni vengono ridotti alle abbreviazioni USPS e gli stati al codice di due lettere.
+# Da qui si ottiene la chiave canonica usata da tutti i percorsi di geocoding (cache del server,
+# calcola_coordinate, geocoder locale): indirizzi scritti in modo diverso ma equivalenti
+# ("4000 E Anaheim St", "4000 east anaheim street") condividono la stessa voce in cache.
+# L'unità non cambia le coordinate e non fa parte della chiave; il CAP ne fa parte solo se manca
+# la città. Senza stato si assume DEFAULT_STATE (l'applicazione copre la contea di Los Angeles).
+# I percorsi che interrogano Nominatim in modo diverso usano spazi di chiavi distinti (namespace):
+# /api/geocode-street cerca la query così com'è, calcola_coordinate la limita a Los Angeles County
+# e agli USA, quindi lo stesso indirizzo può avere due risultati diversi.
+# calcola_coordinate aggiunge ", Los Angeles County, CA, USA" solo se mancano stato e paese: nel
+# namespace NAMESPACE_NEAREST lo stato mancante non diventa DEFAULT_STATE (e il solo paese diventa
+# 'us'), così chiavi uguali corrispondono sempre alla stessa richiesta a Nominatim.
+
+DEFAULT_STATE = 'ca'
+# Namespace delle chiavi in cache
+NAMESPACE_GEOCODE = 'geocode'
+NAMESPACE_NEAREST = 'nearest'
+
+# Tipi di via (USPS Publication 28, i più comuni) -> abbreviazione
+STREET_TYPES = {
+    'alley': 'aly', 'aly': 'aly', 'avenue': 'ave', 'ave': 'ave', 'av': 'ave', 'boulevard': 'blvd',
+    'blvd': 'blvd', 'circle': 'cir', 'cir': 'cir', 'court': 'ct', 'ct': 'ct', 'crescent': 'cres',
+    'cres': 'cres', 'drive': 'dr', 'dr': 'dr', 'expressway': 'expy', 'expy': 'expy', 'freeway': 'fwy',
+    'fwy': 'fwy', 'highway': 'hwy', 'hwy': 'hwy', 'lane': 'ln', 'ln': 'ln', 'loop': 'loop',
+    'parkway': 'pkwy', 'pkwy': 'pkwy', 'place': 'pl', 'pl': 'pl', 'plaza': 'plz', 'plz': 'plz',
+    'road': 'rd', 'rd': 'rd', 'square': 'sq', 'sq': 'sq', 'street': 'st', 'st': 'st', 'str': 'st',
+    'terrace': 'ter', 'ter': 'ter', 'trail': 'trl', 'trl': 'trl', 'way': 'way', 'walk': 'walk',
+}
+DIRECTIONALS = {
+    'north': 'n', 'n': 'n', 'south': 's', 's': 's', 'east': 'e', 'e': 'e', 'west': 'w', 'w': 'w',
+    'northeast': 'ne', 'ne': 'ne', 'northwest': 'nw', 'nw': 'nw',
+    'southeast': 'se', 'se': 'se', 'southwest': 'sw', 'sw': 'sw',
+}
+UNIT_WORDS = {'apt', 'apartment', 'unit', 'suite', 'ste', 'bldg', 'building', 'fl', 'floor', 'rm', 'room', '#'}
+STATES = {
+    'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar', 'california': 'ca', 'colorado': 'co',
+    'connecticut': 'ct', 'delaware': 'de', 'district of columbia': 'dc', 'florida': 'fl', 'georgia': 'ga',
+    'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il', 'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks',
+    'kentucky': 'ky', 'louisiana': 'la', 'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma',
+    'michigan': 'mi', 'minnesota': 'mn', 'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt',
+    'nebraska': 'ne', 'nevada': 'nv', 'new hampshire': 'nh', 'new jersey': 'nj', 'new mexico': 'nm',
+    'new york': 'ny', 'north carolina': 'nc', 'north dakota': 'nd', 'ohio': 'oh', 'oklahoma': 'ok',
+    'oregon': 'or', 'pennsylvania': 'pa', 'rhode island': 'ri', 'south carolina': 'sc',
+    'south dakota': 'sd', 'tennessee': 'tn', 'texas': 'tx', 'utah': 'ut', 'vermont': 'vt',
+    'virginia': 'va', 'washington': 'wa', 'west virginia': 'wv', 'wisconsin': 'wi', 'wyoming': 'wy',
+}
+STATE_CODES = set(STATES.values())
+COUNTRIES = {'us', 'usa', 'u s', 'u s a', 'united states', 'united states of america'}
+# Nomi abbreviati delle città più comuni nell'area
+CITY_ALIASES = {'la': 'los angeles', 'l a': 'los angeles', 'lb': 'long beach'}
+
+_ZIP = re.compile(r'^\d{5}(-\d{4})?$')
+_NUMBER = re.compile(r'^\d+[a-z]?(-\d+[a-z]?)?$')
+_FRACTION = re.compile(r'^\d/\d$')
+
+
+def tokens(text: str) -> List[str]:
+    """Parole dell'indirizzo in minuscolo, senza punteggiatura ('#' resta una parola a sé)."""
+    text = str(text).lower().replace('#', ' # ')
+    return re.sub(r"[^\w\s#/-]|_", ' ', text).split()
+
+
+def _state(words: List[str]) -> Optional[str]:
+    """Codice dello stato se le parole sono un nome o un codice di stato."""
+    text = ' '.join(words)
+    if text in STATE_CODES:
+        return text
+    return STATES.get(text)
+
+
+def _take_trailing_state(words: List[str], min_left: int) -> Optional[str]:
+    """Rimuove dalla fine delle parole un nome (anche di più parole) o codice di stato."""
+    for size in (3, 2, 1):
+        if len(words) - size >= min_left:
+            state = _state(words[-size:])
+            if state is not None:
+                del words[-size:]
+                return state
+    return None
+
+
+class ParsedAddress:
+    """Componenti di un indirizzo; le parti mancanti sono None."""
+
+    __slots__ = ('number', 'predirectional', 'name', 'street_type', 'postdirectional', 'unit',
+                 'city', 'state', 'zip', 'country')
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, None)
+
+    def street(self, with_number: bool = True) -> str:
+        """Via in forma canonica (es. '4000 e anaheim st')."""
+        parts = [self.number if with_number else None, self.predirectional, self.name,
+                 self.street_type, self.postdirectional]
+        return ' '.join(p for p in parts if p)
+
+    def key(self, default_state: Optional[str] = DEFAULT_STATE) -> str:
+        """
+        Chiave canonica per la cache del geocoding: 'via, città, stato' (CAP al posto della
+        città se questa manca).
+        @:param default_state: Stato usato se manca (None = nessuno stato nella chiave)
+        """
+        parts = [self.street(), self.city or self.zip, self.state or default_state]
+        return ', '.join(p for p in parts if p)
+
+    def as_dict(self) -> dict:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __repr__(self):
+        fields = ', '.join(f"{k}={v!r}" for k, v in self.as_dict().items() if v is not None)
+        return f"ParsedAddress({fields})"
+
+
+def _parse_street(words: List[str], address: ParsedAddress):
+    """Civico, direzioni, nome e tipo di via dalle parole della prima parte dell'indirizzo."""
+    words = list(words)
+    # Unità (apt 5, suite 200, # 12): tutto ciò che segue viene scartato
+    for i, word in enumerate(words):
+        if i > 0 and word in UNIT_WORDS:
+            address.unit = ' '.join(words[i:i + 2])
+            del words[i:]
+            break
+    if words and _NUMBER.match(words[0]):
+        address.number = words.pop(0)
+        if words and _FRACTION.match(words[0]):
+            address.number += ' ' + words.pop(0)
+    # Direzione iniziale solo se resta un nome di via ("E St" è la via E, non "est St")
+    if len(words) > 2 or (len(words) == 2 and words[1] not in STREET_TYPES):
+        if words[0] in DIRECTIONALS:
+            address.predirectional = DIRECTIONALS[words.pop(0)]
+    if len(words) > 1 and words[-1] in DIRECTIONALS and words[-2] in STREET_TYPES:
+        address.postdirectional = DIRECTIONALS[words.pop()]
+    if len(words) > 1 and words[-1] in STREET_TYPES:
+        address.street_type = STREET_TYPES[words.pop()]
+    address.name = ' '.join(words) or None
+
+
+def _normalize_city(words: List[str]) -> Optional[str]:
+    text = ' '.join(words)
+    return CITY_ALIASES.get(text, text) or None
+
+
+def _parse_single(words: List[str], address: ParsedAddress):
+    """Indirizzo senza virgole: città e stato si riconoscono dopo il tipo di via."""
+    if len(words) > 1 and _ZIP.match(words[-1]):
+        address.zip = words.pop()
+    for size in (4, 3, 2, 1):
+        if len(words) > size and ' '.join(words[-size:]) in COUNTRIES:
+            address.country = 'us'
+            del words[-size:]
+            break
+    if len(words) > 1 and _ZIP.match(words[-1]):
+        address.zip = words.pop()
+
+    # Il tipo di via segue almeno una parola del nome: quello che viene dopo l'ultimo tipo di via
+    # (direzione e unità escluse) sono città e stato
+    first_name = 1 if words and _NUMBER.match(words[0]) else 0
+    typed = [i for i, w in enumerate(words) if w in STREET_TYPES and i > first_name]
+    if typed and typed[-1] < len(words) - 1:
+        street, tail = words[:typed[-1] + 1], words[typed[-1] + 1:]
+        if len(tail) > 1 and tail[0] in DIRECTIONALS:
+            street.append(tail.pop(0))
+        if tail and tail[0] in UNIT_WORDS:
+            street.extend(tail[:2])
+            tail = tail[2:]
+        address.state = _take_trailing_state(tail, 0)
+        address.city = _normalize_city(tail)
+        words = street
+    else:
+        address.state = _take_trailing_state(words, 2)
+    _parse_street(words, address)
+
+
+@lru_cache(maxsize=65536)
+def _parse(query: str) -> tuple:
+    address = ParsedAddress()
+    parts = [tokens(p) for p in str(query).split(',')]
+    parts = [p for p in parts if p]
+    if len(parts) == 1:
+        _parse_single(parts[0], address)
+    elif parts:
+        _parse_street(parts[0], address)
+        for words in parts[1:]:
+            words = list(words)
+            if words[0] in UNIT_WORDS and address.unit is None:
+                address.unit = ' '.join(words[:2])
+                continue
+            if _ZIP.match(words[-1]):
+                address.zip = words.pop()
+            if not words:
+                continue
+            text = ' '.join(words)
+            if text in COUNTRIES:
+                address.country = 'us'
+            elif words[-1] == 'county':
+                continue
+            elif text in CITY_ALIASES and address.city is None:
+                # "LA" è Los Angeles, non la Louisiana
+                address.city = CITY_ALIASES[text]
+            elif _state(words) is not None:
+                address.state = _state(words)
+            elif address.city is None:
+                # "Long Beach CA" in una sola parte
+                state = _take_trailing_state(words, 1)
+                if state is not None:
+                    address.state = state
+                address.city = _normalize_city(words)
+    return tuple(getattr(address, attr) for attr in ParsedAddress.__slots__)
+
+
+def parse_address(query: str) -> ParsedAddress:
+    """
+    Scompone un indirizzo testuale.
+    @:param query: Indirizzo digitato (es. "4000 E Anaheim St, Long Beach, CA 90804")
+    @:return: ParsedAddress con le parti normalizzate
+    """
+    address = ParsedAddress()
+    for attr, value in zip(ParsedAddress.__slots__, _parse(str(query).strip())):
+        setattr(address, attr, value)
+    return address
+
+
+def canonical_key(query: str, namespace: Optional[str] = None) -> str:
+    """
+    Chiave canonica di un indirizzo per le cache del geocoding.
+    @:param query: Indirizzo digitato
+    @:param namespace: Prefisso del percorso di geocoding (es. NAMESPACE_GEOCODE)
+    @:return: Chiave (es. 'geocode:4000 e anaheim st, long beach, ca')
+    """
+    address = parse_address(query)
+    if namespace == NAMESPACE_NEAREST:
+        # Stesso criterio di calcola_coordinate per aggiungere Los Angeles County alla ricerca
+        key = address.key(default_state='us' if address.country else None)
+    else:
+        key = address.key()
+    return f"{namespace}:{key}" if namespace else key
+
+
+def canonical_street(name: str) -> str:
+    """Nome di via in forma canonica, senza civico (es. 'East Anaheim Street' -> 'e anaheim st')."""
+    address = ParsedAddress()
+    _parse_street(tokens(name), address)
+    return address.street(with_number=False)
+
+
+def normalize_city(city: str) -> str:
+    """Nome di città in forma canonica (minuscolo, senza punteggiatura, alias espansi)."""
+    return _normalize_city(tokens(city)) or ''
+
+
+def normalize_state(state: str) -> Optional[str]:
+    """Codice di due lettere di uno stato (es. 'California' -> 'ca'), None se non riconosciuto."""
+    return _state(tokens(state))
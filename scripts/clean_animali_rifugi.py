@@ -1,119 +1,197 @@
-import pandas as pd
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import re
+from typing import Iterator, Optional
+
+import pandas as pd
+
+# Pulizia del dataset animali-rifugi (prodotto da merge_rifugi_to_intakes.py).
+# Le regole sono applicate da clean_chunk() a un blocco di righe con operazioni vettoriali di pandas;
+# clean_file() legge il CSV a blocchi, li pulisce (eventualmente in un pool di processi) e li scrive
+# nell'ordine di lettura in CSV (default) o, con --format parquet, in Parquet (richiede pyarrow).
+# Tutte le colonne vengono lette come testo, tranne le coordinate (float): così il tipo delle
+# colonne non dipende dal contenuto del singolo blocco e lo schema dell'output è sempre lo stesso.
+#
+# Uso: python scripts/clean_animali_rifugi.py [--format csv|parquet] [--workers 4]
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 # Percorsi assoluti
 base_dir = Path(__file__).resolve().parent.parent
 input_path = base_dir / 'dataset' / 'animali-rifugi.csv'
 output_path = base_dir / 'dataset' / 'animali-rifugi-clean.csv'
 
-df = pd.read_csv(input_path)
-
-# funzione di utilità per rimuovere caratteri di elenco iniziali o qualsiasi punteggiatura iniziale
-def _strip_leading_non_alnum(val):
-    # preserva NaN
-    if pd.isna(val):
-        return val
-    s = str(val)
-    # rimuove i caratteri iniziali fino al primo carattere alfanumerico
-    i = 0
-    L = len(s)
-    while i < L and not s[i].isalnum():
-        i += 1
-    return s[i:].strip()
-
-# 0. Assicuriamoci che la colonna Health esista e riempiamo i null con 'Unknown' (case-insensitive)
-if 'Health' not in df.columns and 'health' in df.columns:
-    df['Health'] = df['health']
-
-if 'Health' in df.columns:
-    df['Health'] = df['Health'].apply(lambda x: x if not (pd.isna(x) or str(x).strip()=='' ) else pd.NA)
-    df['Health'] = df['Health'].fillna('Unknown')
-else:
-    # crea colonna se non esiste
-    df['Health'] = 'Unknown'
-
-print("Valori unici in 'Health':", df['Health'].unique()[:20])
-
-# 1. Colonna Health da Sex (se utile)
-if 'Sex' in df.columns:
-    # Crea la colonna Health se vuota
-    mask = df['Sex'].isin(['Spayed', 'Neutered'])
-    df.loc[mask, 'Health'] = df.loc[mask, 'Sex']
-    df.loc[df['Health'] == 'Spayed', 'Sex'] = 'Female'
-    df.loc[df['Health'] == 'Neutered', 'Sex'] = 'Male'
-    condition_female = (df['Sex'] == 'Female') & (df['Health'].isnull())
-    df.loc[condition_female, 'Health'] = 'Spayed'
-    condition_male = (df['Sex'] == 'Male') & (df['Health'].isnull())
-    df.loc[condition_male, 'Health'] = 'Neutered'
-
-# Garanzia finale: tutti i null in Health <-> 'Unknown'
-df['Health'] = df['Health'].fillna('Unknown')
-
-# 2. Colonna Animal Name: sostituisci NULL con Unknown e rimuovi asterisco iniziale
-if 'Animal Name' in df.columns:
-    df['Animal Name'] = df['Animal Name'].fillna('Unknown')
-    df['Animal Name'] = df['Animal Name'].astype(str).str.lstrip('*').str.strip()
-
-# 3. Colonna DOB: sostituisci NULL con Unknown
-if 'DOB' in df.columns:
-    df['DOB'] = df['DOB'].fillna('Unknown')
-
-# 4. Colonna Reason for Intake: sostituisci NULL con Unknown
-if 'Reason for Intake' in df.columns:
-    df['Reason for Intake'] = df['Reason for Intake'].fillna('Unknown')
-
-# 5. Colonne latitude, longitude, geopoint: controllo valori null o 0 (non rimuovo, solo controllo)
-cols_to_check = ['latitude', 'longitude', 'geopoint']
-for col in cols_to_check:
-    if col in df.columns:
-        df[col] = df[col].replace(0, pd.NA)
-
-# 6. Colonna Outcome Subtype: sostituisci NULL con Unknown
-if 'Outcome Subtype' in df.columns:
-    df['Outcome Subtype'] = df['Outcome Subtype'].fillna('Unknown')
-
-# 7. Colonna Secondary Color: sostituisci NULL con Unknown
-if 'Secondary Color' in df.columns:
-    df['Secondary Color'] = df['Secondary Color'].fillna('Unknown')
-
-# DEBUG: verifica colonne e valori unici
-cols_to_debug = ['outcome_is_dead', 'outcome_is_other', 'outcome_is_alive']
-for col in cols_to_debug:
-    if col in df.columns:
-        print(f"Colonna trovata: {col}")
-        print(df[col].head(10))
-        print(df[col].unique()[:20])
+CHUNK_SIZE = 200_000
+COORD_COLUMNS = ['latitude', 'longitude']
+# Colonne controllate per i valori 0 (non rimossi, solo resi mancanti)
+ZERO_AS_NA_COLUMNS = ['latitude', 'longitude', 'geopoint']
+OUTCOME_COLUMNS = ['outcome_is_dead', 'outcome_is_other', 'outcome_is_alive']
+# Colonne in cui i valori mancanti diventano 'Unknown'
+UNKNOWN_FILL_COLUMNS = ['DOB', 'Reason for Intake', 'Outcome Subtype', 'Secondary Color']
+
+
+def strip_leading_non_alnum(values: pd.Series) -> pd.Series:
+    """
+    Rimuove i caratteri iniziali fino al primo carattere alfanumerico (punti elenco, simboli).
+    I valori mancanti restano mancanti.
+    """
+    return values.str.replace(r'^[\W_]+', '', regex=True).str.strip()
+
+
+def clean_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Applica le regole di pulizia a un blocco di righe.
+    @:param df: Blocco letto dal CSV (colonne di testo, coordinate numeriche)
+    @:return: Blocco pulito (nuovo DataFrame)
+    """
+    df = df.copy()
+
+    # 0. Health: se manca si usa 'health'; vuoti e null diventano 'Unknown'
+    if 'Health' not in df.columns and 'health' in df.columns:
+        df['Health'] = df['health']
+    if 'Health' in df.columns:
+        health = df['Health'].astype('string')
+        df['Health'] = health.mask(health.str.strip() == '')
     else:
-        print(f"Colonna NON trovata: {col}")
-
-# DEBUG: stampa valori grezzi come stringa per identificare i punti
-for col in ['outcome_is_dead', 'outcome_is_other', 'outcome_is_alive']:
-    if col in df.columns:
-        print(f"Valori grezzi in {col} (come stringa):")
-        print(df[col].astype(str).head(20).to_list())
-        print(df[col].astype(str).unique()[:20])
-
-# 8. Rimozione del punto o simbolo iniziale da outcome_is_dead, outcome_is_other, outcome_is_alive
-cols_to_clean = ['outcome_is_dead', 'outcome_is_other', 'outcome_is_alive']
-for col in cols_to_clean:
-    if col in df.columns:
-        # fillna to avoid errors, apply stripping function
-        df[col] = df[col].fillna('').astype(str).apply(_strip_leading_non_alnum).str.strip()
-        # se la cella risultasse vuota, mantieni stringa vuota o imposta NA a seconda delle preferenze
-        df[col] = df[col].replace({'': pd.NA})
-
-# 9. Reason for Intake: rinomina e sostituisci NULL/"NULL" con Unknown
-if 'Reason for Intake' in df.columns:
-    df = df.rename(columns={'Reason for Intake': 'reason_for_Intake'})
-    col_name = 'reason_for_Intake'
-    df[col_name] = df[col_name].fillna('Unknown')
-    df[col_name] = df[col_name].replace('NULL', 'Unknown')
-
-# Salva il risultato
-print(f"Salvataggio su {output_path}")
-# Crea la cartella di destinazione se non esiste
-Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-# Salviamo in UTF-8 per mantenere i caratteri speciali
-df.to_csv(output_path, index=False, encoding='utf-8')
-print("Pulizia completata.")
+        df['Health'] = pd.NA
+    df['Health'] = df['Health'].fillna('Unknown')
+
+    # 1. Health da Sex: Spayed/Neutered passano in Health e il sesso viene ricavato
+    if 'Sex' in df.columns:
+        mask = df['Sex'].isin(['Spayed', 'Neutered'])
+        df.loc[mask, 'Health'] = df.loc[mask, 'Sex']
+        df.loc[df['Health'] == 'Spayed', 'Sex'] = 'Female'
+        df.loc[df['Health'] == 'Neutered', 'Sex'] = 'Male'
+
+    # 2. Animal Name: null -> Unknown, senza asterisco iniziale
+    if 'Animal Name' in df.columns:
+        df['Animal Name'] = df['Animal Name'].fillna('Unknown').astype('string').str.lstrip('*').str.strip()
+
+    # 3-4, 6-7. DOB, Reason for Intake, Outcome Subtype, Secondary Color: null -> Unknown
+    for col in UNKNOWN_FILL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].fillna('Unknown')
+
+    # 5. Coordinate e geopoint: 0 -> mancante
+    for col in ZERO_AS_NA_COLUMNS:
+        if col in df.columns:
+            values = df[col]
+            zero = (values == 0) if pd.api.types.is_numeric_dtype(values) else (values.astype('string') == '0')
+            df[col] = values.mask(zero.fillna(False))
+
+    # 8. outcome_is_*: rimozione del punto o simbolo iniziale; le celle vuote diventano mancanti
+    for col in OUTCOME_COLUMNS:
+        if col in df.columns:
+            cleaned = strip_leading_non_alnum(df[col].astype('string'))
+            df[col] = cleaned.mask(cleaned == '')
+
+    # 9. Reason for Intake -> reason_for_Intake, con "NULL" -> Unknown
+    if 'Reason for Intake' in df.columns:
+        df = df.rename(columns={'Reason for Intake': 'reason_for_Intake'})
+        df['reason_for_Intake'] = df['reason_for_Intake'].replace('NULL', 'Unknown')
+
+    return df
+
+
+def read_chunks(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Legge il CSV a blocchi: colonne di testo, coordinate convertite in float."""
+    for chunk in pd.read_csv(path, dtype=str, chunksize=chunk_size):
+        for col in COORD_COLUMNS:
+            if col in chunk.columns:
+                chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+        yield chunk
+
+
+class _CsvWriter:
+    def __init__(self, path: Path):
+        self.path = path
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False, encoding='utf-8')
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class _ParquetWriter:
+    def __init__(self, path: Path, columns):
+        fields = [pa.field(c, pa.float64() if c in COORD_COLUMNS else pa.string()) for c in columns]
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(str(path), self.schema, compression='zstd')
+
+    def write(self, df: pd.DataFrame):
+        df = df.astype({c: 'float64' if c in COORD_COLUMNS else 'string' for c in df.columns})
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+
+
+def clean_file(source: Path = input_path, target: Optional[Path] = None, fmt: str = 'csv',
+               chunk_size: int = CHUNK_SIZE, workers: Optional[int] = 1) -> Path:
+    """
+    Pulisce il CSV indicato e scrive il risultato.
+    @:param source: CSV di input
+    @:param target: File di output (default: dataset/animali-rifugi-clean.csv o .parquet)
+    @:param fmt: 'csv' o 'parquet' (richiede pyarrow)
+    @:param chunk_size: Righe per blocco
+    @:param workers: Processi per la pulizia (1 = nessun pool, None = numero di CPU)
+    @:return: Percorso del file scritto
+    """
+    source = Path(source)
+    if fmt == 'parquet' and pq is None:
+        raise RuntimeError("Il formato parquet richiede pyarrow (pip install pyarrow)")
+    if target is None:
+        target = output_path.with_suffix(f'.{fmt}')
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(target.name + '.tmp')
+
+    # Colonne dell'output: le regole applicate all'intestazione del file
+    columns = list(clean_chunk(pd.read_csv(source, dtype=str, nrows=0)).columns)
+    writer = _ParquetWriter(tmp, columns) if fmt == 'parquet' else _CsvWriter(tmp)
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    try:
+        if workers == 1:
+            for chunk in read_chunks(source, chunk_size):
+                writer.write(clean_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for chunk in read_chunks(source, chunk_size):
+                    pending.append(pool.submit(clean_chunk, chunk))
+                    while len(pending) > 2 * workers:
+                        writer.write(pending.popleft().result())
+                while pending:
+                    writer.write(pending.popleft().result())
+        if isinstance(writer, _CsvWriter) and writer.header:
+            # Input senza righe: solo l'intestazione
+            pd.DataFrame(columns=columns).to_csv(tmp, index=False, encoding='utf-8')
+    finally:
+        writer.close()
+    os.replace(tmp, target)
+    return target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pulisce il dataset animali-rifugi.")
+    parser.add_argument('--input', default=str(input_path), help="CSV da pulire")
+    parser.add_argument('--output', default=None, help="File di output (default: dataset/animali-rifugi-clean.<formato>)")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help="Formato di output (parquet richiede pyarrow)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Righe per blocco")
+    parser.add_argument('--workers', type=int, default=None, help="Processi (default: numero di CPU)")
+    args = parser.parse_args()
+
+    print(f"Pulizia di {args.input}")
+    written = clean_file(Path(args.input), args.output, args.format, args.chunk_size, args.workers)
+    print(f"Pulizia completata: {written}")
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+# Copie colonnari dei CSV della cartella dataset/, condivise da script e server.
+# Ogni CSV (o ogni trasformazione di un CSV, vedi derived()) viene letto una sola volta e salvato in
+# <cartella del CSV>/.columnar/<nome>/ in formato colonnare: Parquet se pyarrow è installato, altrimenti un file
+# .npy per colonna (le stringhe come codici int32 + valori distinti in strings.json), letto in
+# memory-map. Le letture successive caricano solo le colonne richieste.
+# La copia resta valida finché il CSV non cambia: si confrontano mtime e dimensione e, se solo
+# l'mtime è diverso (es. file ricopiato o checkout), l'hash SHA-256 del contenuto, per non
+# ricostruire la copia quando il contenuto è lo stesso.
+# La copia viene scritta in una cartella temporanea e poi rinominata: un worker che la sta leggendo
+# in memory-map non vede mai file incompleti. Le copie dei CSV che non esistono più vengono
+# eliminate da prune() (chiamata dal server all'avvio).
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+DATA_DIR = Path(__file__).resolve().parents[1] / 'dataset'
+# Cartella delle copie, accanto ai CSV (es. dataset/.columnar)
+CACHE_DIRNAME = '.columnar'
+STORE_VERSION = 1
+
+# Colonna numerica (array) o di stringhe (codici, valori distinti); codice -1 = valore mancante
+Column = Union[np.ndarray, Tuple[np.ndarray, List[str]]]
+
+
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    """Hash SHA-256 del contenuto di un file, letto a blocchi."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_to_columns(df: pd.DataFrame) -> Dict[str, Column]:
+    """Converte un DataFrame nella rappresentazione colonnare (numeri come array, stringhe fattorizzate)."""
+    columns: Dict[str, Column] = {}
+    for name in df.columns:
+        values = df[name]
+        if pd.api.types.is_bool_dtype(values) or (pd.api.types.is_numeric_dtype(values)
+                                                  and not isinstance(values.dtype, pd.CategoricalDtype)):
+            columns[str(name)] = values.to_numpy(dtype=np.float64 if values.hasnans else None)
+        else:
+            text = values.where(values.isna(), values.astype(str))
+            codes, uniques = pd.factorize(text)
+            columns[str(name)] = (codes.astype(np.int32), [str(u) for u in uniques])
+    return columns
+
+
+def columns_to_frame(columns: Dict[str, Column]) -> pd.DataFrame:
+    """Ricostruisce un DataFrame dalla rappresentazione colonnare (stringhe come object, mancanti NaN)."""
+    data = {}
+    for name, col in columns.items():
+        if isinstance(col, tuple):
+            codes, uniques = col
+            data[name] = pd.Categorical.from_codes(np.asarray(codes), categories=pd.Index(uniques, dtype=object)).astype(object)
+        else:
+            data[name] = np.asarray(col)
+    return pd.DataFrame(data)
+
+
+class DatasetStore:
+    """
+    Copie colonnari dei CSV con invalidazione automatica quando il CSV cambia.
+    @:param cache_dir: Cartella delle copie (default: CACHE_DIRNAME nella cartella di ogni CSV)
+    @:param fmt: 'parquet' o 'npy' (default: parquet se pyarrow è installato)
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None, fmt: Optional[str] = None):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.fmt = fmt or ('parquet' if pq is not None else 'npy')
+        if self.fmt == 'parquet' and pq is None:
+            raise RuntimeError("Il formato parquet richiede pyarrow (pip install pyarrow)")
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    # --- API ---
+    def read(self, source: Union[str, Path], columns: Optional[Sequence[str]] = None, **csv_options) -> pd.DataFrame:
+        """
+        Legge un CSV dalla sua copia colonnare (costruita ora se manca o se il CSV è cambiato).
+        @:param source: Percorso del CSV
+        @:param columns: Colonne da leggere (default: tutte, nell'ordine del CSV)
+        @:param csv_options: Opzioni di pandas.read_csv usate per costruire la copia (es. dtype=str)
+        @:return: DataFrame con le sole colonne richieste
+        """
+        return columns_to_frame(self.columns(source, columns, **csv_options))
+
+    def columns(self, source: Union[str, Path], columns: Optional[Sequence[str]] = None,
+                **csv_options) -> Dict[str, Column]:
+        """Come read(), ma restituisce le colonne nella rappresentazione colonnare (senza copie)."""
+        options = json.dumps(csv_options, sort_keys=True, default=str)
+        return self.derived(source, 'csv', lambda path: pd.read_csv(path, low_memory=False, **csv_options),
+                            columns=columns, params=options)
+
+    def column_names(self, source: Union[str, Path], **csv_options) -> List[str]:
+        """Nomi delle colonne del CSV (dalla copia colonnare)."""
+        self.columns(source, [], **csv_options)
+        options = json.dumps(csv_options, sort_keys=True, default=str)
+        meta = self._read_meta(self._entry_dir(Path(source), 'csv', options))
+        if meta is None:
+            # Copia non salvata (cartella non scrivibile)
+            return list(self.columns(source, **csv_options))
+        return list(meta['columns'])
+
+    def derived(self, source: Union[str, Path], name: str, build: Callable[[Path], pd.DataFrame],
+                version: int = 1, columns: Optional[Sequence[str]] = None, params: str = '') -> Dict[str, Column]:
+        """
+        Copia colonnare di una trasformazione del CSV, ricostruita solo quando il CSV cambia.
+        @:param source: Percorso del CSV
+        @:param name: Nome della trasformazione (distingue più copie dello stesso CSV)
+        @:param build: Funzione (percorso del CSV) -> DataFrame
+        @:param version: Versione della trasformazione: cambiandola le copie esistenti vengono ricostruite
+        @:param columns: Colonne da leggere (default: tutte)
+        @:param params: Parametri della trasformazione che fanno parte della chiave della copia
+        @:return: dict colonna -> array o (codici, valori distinti)
+        """
+        source = Path(source)
+        entry = self._entry_dir(source, name, params)
+        with self._lock(entry.name):
+            meta = self._valid_meta(entry, source, version)
+            if meta is None:
+                stat = source.stat()
+                df = build(source)
+                meta = {'store_version': STORE_VERSION, 'version': version, 'source': str(source.resolve()),
+                        'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_sha256(source)}
+                try:
+                    self._write_entry(entry, df, meta)
+                    meta = self._read_meta(entry)
+                except OSError as e:
+                    # Cartella delle copie non scrivibile (es. dataset/ in sola lettura): si usa
+                    # il DataFrame appena costruito, senza salvarlo
+                    print(f"Attenzione: copia colonnare di {source} non salvata ({e})")
+                    meta = None
+                if meta is None:
+                    return self._select(frame_to_columns(df), str(source), columns)
+            return self._load(entry, meta, columns)
+
+    def write(self, df: pd.DataFrame, target: Union[str, Path], **csv_options) -> Path:
+        """
+        Scrive un DataFrame come CSV (sostituendo il file in modo atomico); le copie colonnari
+        del file vengono ricostruite alla lettura successiva.
+        """
+        target = Path(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + '.tmp')
+        df.to_csv(tmp, index=False, **csv_options)
+        os.replace(tmp, target)
+        return target
+
+    def prune(self, directory: Optional[Path] = None) -> int:
+        """
+        Rimuove le copie il cui CSV non esiste più (es. file temporanei o rinominati) e, con le copie
+        accanto ai CSV, quelle di CSV di altre cartelle (scritte qui da versioni precedenti).
+        @:param directory: Cartella dei CSV (default: dataset/; ignorata se il costruttore ha cache_dir)
+        @:return: Numero di copie rimosse
+        """
+        data_dir = Path(directory) if directory is not None else DATA_DIR
+        cache_dir = self.cache_dir or data_dir / CACHE_DIRNAME
+        removed = 0
+        if not cache_dir.is_dir():
+            return removed
+        for entry in cache_dir.iterdir():
+            meta = self._read_meta(entry) if entry.is_dir() else None
+            if meta is None:
+                continue
+            source = Path(meta.get('source', ''))
+            if source.exists() and (self.cache_dir is not None or source.parent == data_dir.resolve()):
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+        return removed
+
+    # --- COPIE SU DISCO ---
+    def _entry_dir(self, source: Path, name: str, params: str) -> Path:
+        key = hashlib.sha1(f"{source.resolve()}|{name}|{params}".encode('utf-8')).hexdigest()[:12]
+        cache_dir = self.cache_dir or source.resolve().parent / CACHE_DIRNAME
+        return cache_dir / f"{source.stem}.{name}.{key}"
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _read_meta(entry: Path) -> Optional[dict]:
+        try:
+            return json.loads((entry / 'meta.json').read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def _valid_meta(self, entry: Path, source: Path, version: int) -> Optional[dict]:
+        meta = self._read_meta(entry)
+        if meta is None or meta.get('store_version') != STORE_VERSION or meta.get('version') != version:
+            return None
+        # Copia scritta in un altro formato (es. parquet, e ora pyarrow non è installato): si ricostruisce
+        if meta.get('format') != self.fmt:
+            return None
+        stat = source.stat()
+        if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+            return meta
+        if meta['size'] != stat.st_size or meta.get('sha256') != file_sha256(source):
+            return None
+        # Stesso contenuto con un mtime diverso: si aggiorna solo la firma
+        meta['mtime_ns'] = stat.st_mtime_ns
+        try:
+            tmp = entry / f'meta.json.{os.getpid()}'
+            tmp.write_text(json.dumps(meta), encoding='utf-8')
+            os.replace(tmp, entry / 'meta.json')
+        except OSError:
+            pass
+        return meta
+
+    def _write_entry(self, entry: Path, df: pd.DataFrame, meta: dict):
+        tmp = entry.with_name(f"{entry.name}.tmp-{os.getpid()}-{threading.get_ident()}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            tmp.mkdir(parents=True)
+            meta = dict(meta, format=self.fmt, rows=len(df), columns=[str(c) for c in df.columns])
+            if self.fmt == 'parquet':
+                table = pa.Table.from_pandas(df.rename(columns=str), preserve_index=False)
+                pq.write_table(table, tmp / 'data.parquet')
+            else:
+                strings, files = {}, {}
+                for i, (name, col) in enumerate(frame_to_columns(df).items()):
+                    files[name] = f'c{i}.npy'
+                    if isinstance(col, tuple):
+                        np.save(tmp / files[name], col[0])
+                        strings[name] = col[1]
+                    else:
+                        np.save(tmp / files[name], col)
+                (tmp / 'strings.json').write_text(json.dumps(strings), encoding='utf-8')
+                meta['files'] = files
+            (tmp / 'meta.json').write_text(json.dumps(meta), encoding='utf-8')
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        # La copia precedente viene rimossa e sostituita (chi la sta leggendo in memory-map
+        # continua a vedere i vecchi file fino alla chiusura)
+        old = entry.with_name(f"{entry.name}.old-{os.getpid()}-{threading.get_ident()}")
+        try:
+            if entry.exists():
+                os.replace(entry, old)
+            os.replace(tmp, entry)
+        except OSError:
+            # Un altro processo ha appena scritto la stessa copia: si usa la sua
+            shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def _select(data: Dict[str, Column], source: str, columns: Optional[Sequence[str]]) -> Dict[str, Column]:
+        names = list(data) if columns is None else list(columns)
+        missing = [c for c in names if c not in data]
+        if missing:
+            raise KeyError(f"Colonne non presenti in {source}: {missing}")
+        return {name: data[name] for name in names}
+
+    @staticmethod
+    def _load(entry: Path, meta: dict, columns: Optional[Sequence[str]]) -> Dict[str, Column]:
+        names = list(meta['columns']) if columns is None else list(columns)
+        missing = [c for c in names if c not in meta['columns']]
+        if missing:
+            raise KeyError(f"Colonne non presenti in {meta['source']}: {missing}")
+        if meta['format'] == 'parquet':
+            if pq is None:
+                raise RuntimeError("La copia è in formato parquet ma pyarrow non è installato")
+            return frame_to_columns(pq.read_table(entry / 'data.parquet', columns=names).to_pandas())
+        strings = json.loads((entry / 'strings.json').read_text(encoding='utf-8')) if names else {}
+        out: Dict[str, Column] = {}
+        for name in names:
+            data = np.load(entry / meta['files'][name], mmap_mode='r')
+            out[name] = (data, strings[name]) if name in strings else data
+        return out
+
+
+# Istanza condivisa da script e server
+DATASETS = DatasetStore()
@@ -1,9 +1,12 @@
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from scripts.dataset_store import DATASETS, DatasetStore
+from scripts.upstream import TokenBucket
 
 DATA_DIR = Path(__file__).resolve().parents[2] / 'dataset'
 
@@ -29,13 +32,10 @@ def merge_streets(save_path: Path = None) -> pd.DataFrame:
     for f, city in files:
         if not f.exists():
             continue
-        try:
-            df = pd.read_csv(f, usecols=lambda c: c.lower() == 'name' or c == 'name')
-        except Exception:
-            df = pd.read_csv(f)
-            if 'name' not in df.columns:
-                continue
-            df = df[['name']]
+        # dalla copia colonnare si legge la sola colonna dei nomi
+        if 'name' not in DATASETS.column_names(f):
+            continue
+        df = DATASETS.read(f, columns=['name'])
 
         # normalize name column
         df['name'] = df['name'].astype(str).str.strip()
@@ -49,7 +49,7 @@ def merge_streets(save_path: Path = None) -> pd.DataFrame:
         result = pd.DataFrame(columns=['name', 'city', 'state'])
         if save_path is None:
             save_path = DATA_DIR / 'strade_all_unique.csv'
-        result.to_csv(save_path, index=False)
+        DATASETS.write(result, save_path)
         return result
 
     all_df = pd.DataFrame(rows)
@@ -65,102 +65,223 @@ def merge_streets(save_path: Path = None) -> pd.DataFrame:
     if save_path is None:
         save_path = DATA_DIR / 'strade_all_unique.csv'
 
-    result.to_csv(save_path, index=False)
+    DATASETS.write(result, save_path)
     return result
 
 
-def enrich_with_geocode(enriched_path: Path = None, user_agent: str = 'nook_pets_geocoder', delay: float = 1.0):
+def _street_key(df: pd.DataFrame) -> pd.Series:
+    # chiave di riga (name, city, state) usata per riprendere il lavoro da un checkpoint
+    return (df['name'].astype(str).str.strip().str.lower() + '|'
+            + df['city'].fillna('').astype(str).str.strip().str.lower() + '|'
+            + df['state'].fillna('').astype(str).str.strip().str.lower())
+
+
+def _apply_known(df: pd.DataFrame, known: pd.DataFrame) -> pd.DataFrame:
+    # copia lat/lon/postcode/status già noti (da un CSV arricchito o da un checkpoint) nelle righe di df
+    if known.empty or 'name' not in known.columns:
+        return df
+    for col in ['city', 'state', 'lat', 'lon', 'postcode', 'status']:
+        if col not in known.columns:
+            known[col] = pd.NA
+    known = known.assign(_key=_street_key(known)).drop_duplicates('_key', keep='last').set_index('_key')
+    keys = _street_key(df)
+    for col in ['lat', 'lon', 'postcode', 'status']:
+        values = keys.map(known[col])
+        df[col] = df[col].where(df[col].notna(), values)
+    return df
+
+
+def enrich_with_geocode(enriched_path: Path = None, user_agent: str = 'nook_pets_geocoder', delay: float = 1.0,
+                        workers: int = 1, rate: float = None, burst: float = 1.0, domain: str = None,
+                        scheme: str = None, checkpoint_every: int = 100, geocode=None) -> Path:
     """
     Arricchisce il CSV unificato con latitudine, longitudine e postcode per ogni strada usando Nominatim.
-    ATTENZIONE: usa il service Nominatim e rispetta le policy (rate limit). Questo script implementa un
-    semplice rate limiter (delay tra le richieste). Per dataset grandi impiega molto tempo.
+    ATTENZIONE: usa il service Nominatim e rispetta le policy (rate limit). Per dataset grandi impiega molto tempo.
+
+    La pipeline è riprendibile: ogni `checkpoint_every` risultati vengono aggiunti a un file di checkpoint
+    (<enriched_path>.checkpoint.csv). Alla ripartenza vengono saltate le righe che hanno già coordinate
+    (nel CSV arricchito o nel checkpoint) e quelle già cercate senza risultato. Le richieste sono eseguite da
+    `workers` thread che condividono un unico token bucket: con il servizio pubblico si lascia 1 req/s,
+    con un'istanza locale di Nominatim (`domain`) si può alzare il rate fino a saturarla.
 
     Parametri:
       - enriched_path: Path dove salvare il CSV arricchito (default: dataset/strade_all_enriched.csv)
       - user_agent: user agent per Nominatim
-      - delay: secondi di pausa tra le richieste (default 1.0)
+      - delay: secondi tra le richieste, usato se `rate` non è indicato (default 1.0 -> 1 req/s)
+      - workers: numero di thread che eseguono le richieste
+      - rate: richieste al secondo consentite (default 1 / delay)
+      - burst: richieste consecutive consentite senza attesa
+      - domain, scheme: host e schema di un'istanza Nominatim alternativa (es. locale)
+      - checkpoint_every: numero di risultati tra un salvataggio e l'altro
+      - geocode: funzione di geocoding alternativa (query -> location geopy), utile per i test
     """
     if enriched_path is None:
         enriched_path = DATA_DIR / 'strade_all_enriched.csv'
+    enriched_path = Path(enriched_path)
+    checkpoint_path = enriched_path.with_suffix('.checkpoint.csv')
 
     base = DATA_DIR / 'strade_all_unique.csv'
     if not base.exists():
         merge_streets(base)
 
-    df = pd.read_csv(base)
+    df = DATASETS.read(base)
     # aggiungi colonne
-    df['lat'] = pd.NA
-    df['lon'] = pd.NA
-    df['postcode'] = pd.NA
-
-    geolocator = Nominatim(user_agent=user_agent)
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=delay)
-
-    for idx, row in df.iterrows():
-        try:
-            query = f"{row['name']}, {row.get('city','')}, {row.get('state','')}"
-            location = geocode(query, addressdetails=True)
-            if location:
-                df.at[idx, 'lat'] = location.latitude
-                df.at[idx, 'lon'] = location.longitude
-                # try to extract postcode from address details
-                details = location.raw.get('address', {})
-                postcode = details.get('postcode') or details.get('postcode')
-                if postcode:
-                    df.at[idx, 'postcode'] = postcode
-            # pause is handled by RateLimiter but we keep a tiny sleep to be polite
-            time.sleep(delay * 0.1)
-        except Exception as e:
-            print(f"Geocode error idx={idx} name={row['name']}: {e}")
-            time.sleep(delay)
-
-    df.to_csv(enriched_path, index=False)
+    for col in ['lat', 'lon', 'postcode', 'status']:
+        df[col] = pd.NA
+    df['postcode'] = df['postcode'].astype(object)
+    df['status'] = df['status'].astype(object)
+
+    # riprendi da un'esecuzione precedente: CSV arricchito parziale e checkpoint
+    if enriched_path.exists():
+        df = _apply_known(df, pd.read_csv(enriched_path))
+    if checkpoint_path.exists():
+        df = _apply_known(df, pd.read_csv(checkpoint_path))
+
+    todo = df.index[df['lat'].isna() & df['status'].isna()]
+    print(f"Strade da geocodificare: {len(todo)} su {len(df)}")
+
+    if geocode is None:
+        options = {'user_agent': user_agent}
+        if domain:
+            options['domain'] = domain
+        if scheme:
+            options['scheme'] = scheme
+        geocode = Nominatim(**options).geocode
+    bucket = TokenBucket(rate if rate is not None else 1.0 / delay, capacity=burst)
+
+    # le query sono preparate prima di avviare i thread, che così non leggono df mentre viene aggiornato
+    queries = {idx: f"{df.at[idx, 'name']}, {df.at[idx, 'city']}, {df.at[idx, 'state']}" for idx in todo}
+
+    def lookup(idx):
+        query = queries[idx]
+        bucket.acquire()
+        location = geocode(query, addressdetails=True)
+        if not location:
+            return idx, None, None, None
+        # try to extract postcode from address details
+        details = (getattr(location, 'raw', {}) or {}).get('address', {})
+        return idx, location.latitude, location.longitude, details.get('postcode')
+
+    pending = []
+
+    def flush():
+        # appende i risultati al checkpoint: un'interruzione perde al massimo checkpoint_every righe
+        if not pending:
+            return
+        chunk = df.loc[pending, ['name', 'city', 'state', 'lat', 'lon', 'postcode', 'status']]
+        chunk.to_csv(checkpoint_path, mode='a', header=not checkpoint_path.exists(), index=False)
+        pending.clear()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+    try:
+        futures = {executor.submit(lookup, idx): idx for idx in queries}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                _, lat, lon, postcode = future.result()
+            except Exception as e:
+                # gli errori non vengono registrati: la riga sarà ritentata alla prossima esecuzione
+                print(f"Geocode error idx={idx} name={df.at[idx, 'name']}: {e}")
+                continue
+            if lat is None:
+                df.at[idx, 'status'] = 'not_found'
+            else:
+                df.at[idx, 'lat'] = lat
+                df.at[idx, 'lon'] = lon
+                df.at[idx, 'postcode'] = postcode
+                df.at[idx, 'status'] = 'ok'
+            pending.append(idx)
+            if len(pending) >= checkpoint_every:
+                flush()
+    finally:
+        # in caso di interruzione (es. Ctrl+C) le richieste in coda vengono annullate e i risultati salvati
+        executor.shutdown(wait=True, cancel_futures=True)
+        flush()
+
+    DATASETS.write(df.drop(columns=['status']), enriched_path)
+    # il CSV arricchito completo sostituisce il checkpoint, tranne le strade non trovate
+    # che restano registrate per non essere ritentate
+    not_found = df[df['status'] == 'not_found']
+    checkpoint_path.unlink(missing_ok=True)
+    if not not_found.empty:
+        not_found[['name', 'city', 'state', 'lat', 'lon', 'postcode', 'status']].to_csv(checkpoint_path, index=False)
     return enriched_path
 
 
-def load_street_names() -> List[dict]:
+# Copia colonnare delle strade (vedi scripts/dataset_store.py): colonne numpy in memory-map,
+# con le stringhe fattorizzate. Versione della trasformazione _street_frame.
+STREETS_VERSION = 2
+_STRING_COLS = ['name', 'city', 'state', 'postcode', 'display']
+_FLOAT_COLS = ['lat', 'lon']
+
+
+def _street_frame(path: Path) -> pd.DataFrame:
     """
-    Carica (o genera) il CSV unificato e restituisce la lista di dict con campi:
-      { 'name', 'city', 'state', 'display', 'lat', 'lon', 'postcode' }
-    Se esiste `strade_all_enriched.csv` lo userà per includere lat/lon/postcode.
+    Legge il CSV delle strade in modo vettoriale: stringhe senza valori mancanti ('' al loro posto),
+    lat/lon float e la colonna display = "name, city, state" (omettendo le parti vuote).
     """
+    df = pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''])
+    for col in ['name', 'city', 'state', 'postcode']:
+        df[col] = df[col].fillna('').str.strip() if col in df.columns else ''
+
+    display = df['name'].copy()
+    for part in ('city', 'state'):
+        has = df[part] != ''
+        display[has] = display[has] + ', ' + df.loc[has, part]
+    df['display'] = display
+
+    for col in _FLOAT_COLS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+        else:
+            df[col] = np.full(len(df), np.nan)
+    return df[_STRING_COLS + _FLOAT_COLS]
+
+
+def load_street_columns(store: Optional[DatasetStore] = None) -> dict:
+    """
+    Carica le colonne delle strade dalla copia colonnare, ricostruita dal CSV
+    (strade_all_enriched.csv o, in mancanza, strade_all_unique.csv) solo se il CSV è cambiato.
+    @:param store: Archivio delle copie colonnari (default: DATASETS)
+    @:return: dict colonna -> array (float) o (codici, valori distinti) per le stringhe
+    """
+    store = store or DATASETS
     out = DATA_DIR / 'strade_all_enriched.csv'
     if not out.exists():
         out = DATA_DIR / 'strade_all_unique.csv'
         if not out.exists():
             merge_streets(out)
+    return store.derived(out, 'strade', _street_frame, version=STREETS_VERSION)
 
+
+def load_street_names() -> List[dict]:
+    """
+    Carica (o genera) il CSV unificato e restituisce la lista di dict con campi:
+      { 'name', 'city', 'state', 'display', 'lat', 'lon', 'postcode' }
+    Se esiste `strade_all_enriched.csv` lo userà per includere lat/lon/postcode.
+    Il CSV viene letto solo la prima volta (o quando cambia): le esecuzioni successive
+    usano la copia colonnare in dataset/.columnar.
+    """
     try:
-        df = pd.read_csv(out)
-        entries = []
-        if 'name' in df.columns:
-            for _, r in df.iterrows():
-                name = str(r['name']).strip()
-                city = str(r.get('city', '')).strip()
-                state = str(r.get('state', '')).strip()
-                display = name
-                if city:
-                    display = f"{display}, {city}"
-                if state:
-                    display = f"{display}, {state}"
-
-                lat = None
-                lon = None
-                postcode = None
-                if 'lat' in r and not pd.isna(r['lat']):
-                    try:
-                        lat = float(r['lat'])
-                    except Exception:
-                        lat = None
-                if 'lon' in r and not pd.isna(r['lon']):
-                    try:
-                        lon = float(r['lon'])
-                    except Exception:
-                        lon = None
-                if 'postcode' in r and not pd.isna(r['postcode']):
-                    postcode = str(r['postcode']).strip()
-
-                entries.append({'name': name, 'city': city, 'state': state, 'display': display, 'lat': lat, 'lon': lon, 'postcode': postcode})
-        return entries
+        columns = load_street_columns()
     except Exception:
         return []
+
+    def strings(col):
+        codes, uniques = columns[col]
+        return np.asarray(uniques, dtype=object)[codes] if len(uniques) else np.full(len(codes), '', dtype=object)
+
+    names, cities, states, postcodes, display = (strings(c) for c in _STRING_COLS)
+    keep = names != ''
+
+    lat = np.asarray(columns['lat'])
+    lon = np.asarray(columns['lon'])
+    lat_obj = np.where(np.isnan(lat), None, lat.astype(object))
+    lon_obj = np.where(np.isnan(lon), None, lon.astype(object))
+    post_obj = np.where(postcodes == '', None, postcodes)
+
+    return [
+        {'name': n, 'city': c, 'state': s, 'display': d, 'lat': la, 'lon': lo, 'postcode': pc}
+        for n, c, s, d, la, lo, pc in zip(names[keep], cities[keep], states[keep], display[keep],
+                                          lat_obj[keep], lon_obj[keep], post_obj[keep])
+    ]
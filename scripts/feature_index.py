@@ -0,0 +1,159 @@
+import json
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from scripts.geojson_optimize import geometry_coords
+
+# Indice spaziale delle feature di un layer GeoJSON, per rispondere alle richieste
+# ?bbox=minx,miny,maxx,maxy con le sole feature visibili.
+# L'indice è un R-tree impacchettato con l'algoritmo STR (Sort-Tile-Recursive): le bounding box
+# delle feature vengono ordinate per x, divise in fasce verticali, ordinate per y all'interno di
+# ogni fascia e raggruppate in nodi da `node_size` elementi; i nodi vengono poi raggruppati allo
+# stesso modo fino alla radice. Ogni livello è un array numpy, quindi la visita dell'albero procede un
+# livello alla volta con operazioni vettoriali.
+# Le feature sono serializzate una sola volta alla costruzione: la risposta a una query è
+# la concatenazione dei frammenti JSON delle feature selezionate.
+
+Bounds = Tuple[float, float, float, float]
+
+
+def geometry_bounds(geometry: Optional[dict]) -> Optional[Bounds]:
+    """
+    Bounding box (minx, miny, maxx, maxy) di una geometria GeoJSON.
+    @:return: Tuple o None se la geometria è vuota
+    """
+    arrays = [a for a in geometry_coords(geometry or {}) if len(a)]
+    if not arrays:
+        return None
+    pts = np.concatenate(arrays)
+    mins, maxs = pts.min(axis=0), pts.max(axis=0)
+    return float(mins[0]), float(mins[1]), float(maxs[0]), float(maxs[1])
+
+
+def parse_bbox(text: Optional[str]) -> Optional[Bounds]:
+    """
+    Interpreta il parametro bbox "minx,miny,maxx,maxy" (lon/lat).
+    @:return: Tuple di float o None se il parametro è assente
+    @:raise ValueError: Se il parametro non è una bounding box valida
+    """
+    if text is None or not text.strip():
+        return None
+    parts = text.split(',')
+    if len(parts) != 4:
+        raise ValueError("bbox deve avere 4 valori: minx,miny,maxx,maxy")
+    minx, miny, maxx, maxy = (float(p) for p in parts)
+    if not all(np.isfinite([minx, miny, maxx, maxy])) or minx > maxx or miny > maxy:
+        raise ValueError("bbox non valida")
+    return minx, miny, maxx, maxy
+
+
+def _str_pack(boxes: np.ndarray, node_size: int) -> np.ndarray:
+    """Ordine STR delle bounding box (n, 4): fasce per centro x, poi centro y dentro la fascia."""
+    n = len(boxes)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    n_nodes = -(-n // node_size)
+    slab = node_size * int(np.ceil(np.sqrt(n_nodes)))
+    by_x = np.argsort(cx, kind='stable')
+    # Chiave di ordinamento: (fascia, y)
+    slabs = np.empty(n, dtype=np.int64)
+    slabs[by_x] = np.arange(n) // slab
+    return np.lexsort((cy, slabs))
+
+
+def _node_bounds(boxes: np.ndarray, node_size: int) -> np.ndarray:
+    """Bounding box dei nodi che raggruppano `node_size` elementi consecutivi."""
+    starts = np.arange(0, len(boxes), node_size)
+    return np.column_stack([
+        np.minimum.reduceat(boxes[:, 0], starts),
+        np.minimum.reduceat(boxes[:, 1], starts),
+        np.maximum.reduceat(boxes[:, 2], starts),
+        np.maximum.reduceat(boxes[:, 3], starts),
+    ])
+
+
+class STRTree:
+    """
+    R-tree statico impacchettato con STR.
+    @:param boxes: Array (n, 4) di bounding box (minx, miny, maxx, maxy)
+    @:param ids: Identificativi restituiti dalle query (default: posizione in boxes)
+    @:param node_size: Numero massimo di figli per nodo
+    """
+
+    def __init__(self, boxes, ids: Optional[Sequence[int]] = None, node_size: int = 16):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        ids = np.arange(len(boxes)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.node_size = node_size
+
+        order = _str_pack(boxes, node_size) if len(boxes) else np.empty(0, dtype=np.int64)
+        self.ids = ids[order]
+        # levels[0] = foglie (le bounding box delle feature), levels[-1] = radice.
+        # I figli del nodo i del livello k sono gli elementi [i*node_size, (i+1)*node_size) del livello k-1.
+        self.levels: List[np.ndarray] = [boxes[order]]
+        while len(self.levels[-1]) > node_size:
+            # I nodi consecutivi sono già vicini (stessa fascia): si raggruppano senza riordinare
+            self.levels.append(_node_bounds(self.levels[-1], node_size))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def query(self, bbox: Bounds) -> np.ndarray:
+        """
+        Elementi la cui bounding box interseca quella indicata.
+        @:param bbox: (minx, miny, maxx, maxy)
+        @:return: Array degli identificativi, nell'ordine dell'indice
+        """
+        if not len(self.ids):
+            return np.empty(0, dtype=np.int64)
+        minx, miny, maxx, maxy = bbox
+        candidates = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth][candidates]
+            hit = ((boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx)
+                   & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny))
+            candidates = candidates[hit]
+            if depth == 0 or not len(candidates):
+                break
+            # Espansione vettoriale dei nodi nei loro figli
+            size_below = len(self.levels[depth - 1])
+            starts = candidates * self.node_size
+            counts = np.minimum(starts + self.node_size, size_below) - starts
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = np.repeat(starts, counts) + offsets
+        return self.ids[candidates] if depth == 0 else np.empty(0, dtype=np.int64)
+
+
+class FeatureIndex:
+    """
+    Indice delle feature di una FeatureCollection, con le feature già serializzate.
+    Le feature senza geometria non vengono mai restituite dalle query per bbox.
+    @:param collection: FeatureCollection GeoJSON
+    """
+
+    def __init__(self, collection: dict, node_size: int = 16):
+        features = collection.get('features') or []
+        self.name = collection.get('name')
+        self.fragments = [json.dumps(f, ensure_ascii=False, separators=(',', ':')) for f in features]
+        ids, boxes = [], []
+        for i, f in enumerate(features):
+            bounds = geometry_bounds(f.get('geometry'))
+            if bounds is not None:
+                ids.append(i)
+                boxes.append(bounds)
+        self.tree = STRTree(boxes, ids, node_size=node_size)
+
+    def __len__(self) -> int:
+        return len(self.fragments)
+
+    def query(self, bbox: Bounds) -> np.ndarray:
+        """Indici (ordinati) delle feature che intersecano la bbox."""
+        return np.sort(self.tree.query(bbox))
+
+    def collection_bytes(self, indices) -> bytes:
+        """FeatureCollection serializzata con le sole feature indicate."""
+        head = '{"type":"FeatureCollection",'
+        if self.name is not None:
+            head += f'"name":{json.dumps(self.name, ensure_ascii=False)},'
+        body = ','.join(self.fragments[i] for i in indices)
+        return f'{head}"features":[{body}]}}'.encode('utf-8')
@@ -0,0 +1,226 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+# Cache dei risultati di geocoding condivisa dal server.
+# È composta da due livelli:
+#   1. un livello in memoria (LRU) limitato sia nel numero di voci sia nella memoria occupata;
+#   2. un archivio SQLite su disco, condiviso tra tutti i worker (gunicorn) e persistente
+#      tra un riavvio e l'altro.
+# Ogni voce ha una scadenza (TTL). Anche i risultati negativi (indirizzo non trovato) vengono
+# memorizzati, con una scadenza più breve, per non ripetere ad ogni richiesta una chiamata a
+# Nominatim che fallirà di nuovo; gli errori del servizio non vengono memorizzati dai chiamanti.
+# peek() legge solo il livello in memoria, senza accessi al disco e senza aggiornare le statistiche:
+# serve per gli arricchimenti facoltativi (es. i suggerimenti dell'autocompletamento).
+
+# Scadenze di default (secondi)
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 6 * 3600
+
+
+def is_negative(value: dict) -> bool:
+    """Un risultato è negativo se non contiene coordinate."""
+    return value.get('lat') is None or value.get('lon') is None
+
+
+class GeocodeCache:
+    """
+    Cache LRU/TTL con archivio SQLite opzionale.
+    @:param path: Percorso del file SQLite (None = solo memoria)
+    @:param max_entries: Numero massimo di voci in memoria
+    @:param max_bytes: Memoria massima (stimata) occupata dalle voci in memoria
+    @:param ttl: Scadenza dei risultati positivi in secondi
+    @:param negative_ttl: Scadenza dei risultati negativi in secondi
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, max_entries: int = 10000,
+                 max_bytes: int = 16 * 1024 * 1024, ttl: float = DEFAULT_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL):
+        self.path = Path(path) if path is not None else None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # chiave -> (valore, scadenza, dimensione stimata)
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Contatori degli eventi della cache (esposti da /metrics), aggiornati sotto self._lock
+        self.stats = {'hit_memory': 0, 'hit_disk': 0, 'miss': 0, 'set': 0, 'eviction': 0, 'expired': 0}
+        # La connessione SQLite è condivisa tra i thread del processo: accesso serializzato
+        self._disk_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+
+        if self.path is not None:
+            try:
+                with self._disk_lock:
+                    self._connect()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Attenzione: cache geocoding su disco non disponibile ({e}), uso solo la memoria.")
+                self.path = None
+
+    # --- ARCHIVIO SU DISCO ---
+    def _connect(self) -> sqlite3.Connection:
+        # Una connessione per processo: dopo un fork il worker ne apre una propria
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False, isolation_level=None)
+        # WAL permette letture concorrenti da più processi mentre un altro scrive
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._conn = conn
+        self._conn_pid = os.getpid()
+        return conn
+
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        if self.path is None:
+            return None
+        try:
+            with self._disk_lock:
+                row = self._connect().execute(
+                    "SELECT value, expires_at FROM geocode_cache WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Errore lettura cache geocoding: {e}")
+            return None
+        if row is None:
+            return None
+        value, expires_at = json.loads(row[0]), row[1]
+        if expires_at < time.time():
+            return None
+        return value, expires_at
+
+    def _disk_set(self, key: str, value: dict, expires_at: float):
+        if self.path is None:
+            return
+        try:
+            with self._disk_lock:
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO geocode_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires_at)
+                )
+        except sqlite3.Error as e:
+            print(f"Errore scrittura cache geocoding: {e}")
+
+    def purge_expired(self) -> int:
+        """
+        Rimuove le voci scadute dalla memoria e dal disco.
+        @:return: Numero di voci rimosse dal disco
+        """
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, exp, _) in self._memory.items() if exp < now]:
+                self._drop(key)
+                self.stats['expired'] += 1
+        if self.path is None:
+            return 0
+        try:
+            with self._disk_lock:
+                cur = self._connect().execute("DELETE FROM geocode_cache WHERE expires_at < ?", (now,))
+                return cur.rowcount
+        except sqlite3.Error as e:
+            print(f"Errore pulizia cache geocoding: {e}")
+            return 0
+
+    # --- LIVELLO IN MEMORIA ---
+    def _drop(self, key: str):
+        _, _, size = self._memory.pop(key)
+        self._bytes -= size
+
+    def _remember(self, key: str, value: dict, expires_at: float):
+        size = len(key) + len(json.dumps(value)) + 100
+        if key in self._memory:
+            self._drop(key)
+        self._memory[key] = (value, expires_at, size)
+        self._bytes += size
+        # Evizione LRU finché non si rientra nei limiti
+        while self._memory and (len(self._memory) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._memory)))
+            self.stats['eviction'] += 1
+
+    # --- API ---
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Restituisce il risultato memorizzato per la chiave, cercando prima in memoria e poi su disco.
+        @:param key: Chiave normalizzata della richiesta
+        @:return: Dizionario del risultato (anche negativo) o None se assente/scaduto
+        """
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if item[1] >= now:
+                    self._memory.move_to_end(key)
+                    self.stats['hit_memory'] += 1
+                    return item[0]
+                self._drop(key)
+                self.stats['expired'] += 1
+
+        found = self._disk_get(key)
+        with self._lock:
+            if found is None:
+                self.stats['miss'] += 1
+                return None
+            self.stats['hit_disk'] += 1
+            self._remember(key, found[0], found[1])
+        return found[0]
+
+    def peek(self, key: str) -> Optional[dict]:
+        """
+        Restituisce il risultato solo se è nel livello in memoria e non è scaduto: nessuna lettura
+        dal disco, nessun aggiornamento dell'ordine LRU né delle statistiche.
+        @:param key: Chiave normalizzata della richiesta
+        @:return: Dizionario del risultato o None
+        """
+        with self._lock:
+            item = self._memory.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def set(self, key: str, value: dict, ttl: Optional[float] = None):
+        """
+        Memorizza un risultato. Se ttl non è indicato, i risultati negativi usano negative_ttl.
+        @:param key: Chiave normalizzata della richiesta
+        @:param value: Dizionario del risultato
+        @:param ttl: Scadenza opzionale in secondi
+        """
+        if ttl is None:
+            ttl = self.negative_ttl if is_negative(value) else self.ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self.stats['set'] += 1
+            self._remember(key, value, expires_at)
+        self._disk_set(key, value, expires_at)
+
+    def stats_snapshot(self) -> Dict[str, int]:
+        """Copia coerente dei contatori degli eventi della cache."""
+        with self._lock:
+            return dict(self.stats)
+
+    def memory_usage(self) -> tuple:
+        """
+        @:return: (voci, byte stimati) del livello in memoria
+        """
+        with self._lock:
+            return len(self._memory), self._bytes
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._memory)
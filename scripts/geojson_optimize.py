@@ -0,0 +1,422 @@
+import argparse
+import hashlib
+import json
+import math
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+# Preparazione offline dei layer GeoJSON esportati da QGIS per la mappa web.
+# Per ogni file della cartella animali_qgis/geojson vengono prodotti, nella sottocartella "lod":
+#   - <layer>.full.geojson: geometrie complete, riproiettate in WGS84 e quantizzate (~10 cm);
+#   - <layer>.z<zoom>.geojson: geometrie semplificate con Douglas-Peucker alla tolleranza di
+#     circa un pixel al livello di zoom indicato, con un numero di decimali adeguato.
+# In tutte le versioni vengono eliminate le proprietà che il frontend non usa e il membro "crs"
+# (GeoJSON RFC 7946 prevede solo WGS84).
+# Il server sceglie la versione in base al parametro ?zoom= (vedi lod_candidates()).
+# Ogni versione riporta nel membro "source_sha256" l'hash SHA-256 del file sorgente da cui è stata
+# generata: il server la usa solo se l'hash coincide con quello del file corrente (le date di
+# modifica non sono affidabili, es. dopo un checkout git).
+#
+# Uso (dalla root del progetto):
+#   python -m scripts.geojson_optimize [--input animali_qgis/geojson] [--zooms 8 10 12 14]
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+GEOJSON_DIR = BASE_DIR / 'animali_qgis' / 'geojson'
+LOD_DIRNAME = 'lod'
+
+# Livelli di zoom per cui si genera una versione semplificata
+LOD_ZOOMS = (8, 10, 12, 14)
+# Decimali della versione completa (1e-6 gradi ~ 11 cm)
+FULL_DECIMALS = 6
+
+# Proprietà effettivamente usate dal frontend (app.js) per i layer noti.
+# Per gli altri layer si scartano solo i campi tecnici aggiunti da QGIS/ArcGIS.
+PROPRIETA_LAYER: Dict[str, Sequence[str]] = {
+    'animali_difficili': ('city', 'Name', 'intake_dur_mean', 'intake_duration_mean', 'intake_dur'),
+    'zone_rosse': ('CLUSTER_ID', 'id', 'name'),
+}
+_CAMPI_TECNICI = {'fid', 'OBJECTID', 'Shape__Are', 'Shape__Len', 'Shape_Area', 'Shape_Leng'}
+
+# Ellissoide WGS84 e parametri UTM
+_A = 6378137.0
+_F = 1 / 298.257223563
+_E2 = _F * (2 - _F)
+_EP2 = _E2 / (1 - _E2)
+_K0 = 0.9996
+_EPSG_UTM = re.compile(r'EPSG:{1,2}(32[67])(\d{2})$')
+# Membro "source_sha256" scritto all'inizio di ogni versione (letto senza decodificare tutto il file)
+_SOURCE_SHA256 = re.compile(rb'^\{"type":"FeatureCollection","source_sha256":"([0-9a-f]{64})"')
+
+
+# ==============================================================================
+# PROIEZIONE
+# ==============================================================================
+
+def crs_name(collection: dict) -> Optional[str]:
+    """Restituisce il nome del CRS dichiarato dal file (es. 'urn:ogc:def:crs:EPSG::32611') o None."""
+    crs = collection.get('crs') or {}
+    return (crs.get('properties') or {}).get('name')
+
+
+def utm_zone(name: Optional[str]):
+    """
+    Interpreta un CRS UTM WGS84 (EPSG:326xx nord, EPSG:327xx sud).
+    @:return: Tuple (zona, emisfero nord) o None se il CRS non è UTM
+    """
+    match = _EPSG_UTM.search(name or '')
+    if match is None:
+        return None
+    return int(match.group(2)), match.group(1) == '326'
+
+
+def utm_to_wgs84(x: np.ndarray, y: np.ndarray, zone: int, north: bool = True):
+    """
+    Conversione inversa UTM -> lon/lat (formule di Snyder, precisione sub-metrica nella zona).
+    @:param x: Easting in metri
+    @:param y: Northing in metri
+    @:return: Tuple (lon, lat) in gradi
+    """
+    x = np.asarray(x, dtype=np.float64) - 500000.0
+    y = np.asarray(y, dtype=np.float64)
+    if not north:
+        y = y - 10000000.0
+
+    e1 = (1 - math.sqrt(1 - _E2)) / (1 + math.sqrt(1 - _E2))
+    mu = (y / _K0) / (_A * (1 - _E2 / 4 - 3 * _E2 ** 2 / 64 - 5 * _E2 ** 3 / 256))
+    phi1 = (mu
+            + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu)
+            + (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu)
+            + (151 * e1 ** 3 / 96) * np.sin(6 * mu)
+            + (1097 * e1 ** 4 / 512) * np.sin(8 * mu))
+
+    sin1, cos1, tan1 = np.sin(phi1), np.cos(phi1), np.tan(phi1)
+    c1 = _EP2 * cos1 ** 2
+    t1 = tan1 ** 2
+    n1 = _A / np.sqrt(1 - _E2 * sin1 ** 2)
+    r1 = _A * (1 - _E2) / (1 - _E2 * sin1 ** 2) ** 1.5
+    d = x / (n1 * _K0)
+
+    lat = phi1 - (n1 * tan1 / r1) * (
+        d ** 2 / 2
+        - (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * _EP2) * d ** 4 / 24
+        + (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * _EP2 - 3 * c1 ** 2) * d ** 6 / 720)
+    lon = (d
+           - (1 + 2 * t1 + c1) * d ** 3 / 6
+           + (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * _EP2 + 24 * t1 ** 2) * d ** 5 / 120) / cos1
+    lon0 = math.radians(zone * 6 - 183)
+    return np.degrees(lon0 + lon), np.degrees(lat)
+
+
+def _xy(seq) -> np.ndarray:
+    """Sequenza di posizioni GeoJSON come array (n, 2), ignorando l'eventuale quota."""
+    arr = np.asarray(seq, dtype=np.float64)
+    return arr[:, :2] if arr.ndim == 2 else np.empty((0, 2))
+
+
+def geometry_coords(geometry: dict) -> Iterable[np.ndarray]:
+    """Tutte le sequenze di coordinate di una geometria come array (n, 2)."""
+    gtype = geometry.get('type')
+    coords = geometry.get('coordinates')
+    if gtype == 'GeometryCollection':
+        for g in geometry.get('geometries') or []:
+            yield from geometry_coords(g)
+    elif gtype == 'Point':
+        yield _xy([coords])
+    elif gtype in ('MultiPoint', 'LineString'):
+        yield _xy(coords)
+    elif gtype in ('MultiLineString', 'Polygon'):
+        for line in coords:
+            yield _xy(line)
+    elif gtype == 'MultiPolygon':
+        for poly in coords:
+            for ring in poly:
+                yield _xy(ring)
+
+
+def is_wgs84(collection: dict) -> bool:
+    """
+    Verifica se le coordinate sono già in gradi lon/lat, indipendentemente dal CRS dichiarato.
+    Gli export di QGIS dichiarano spesso EPSG:32611 pur contenendo coordinate geografiche.
+    """
+    for feature in collection.get('features') or []:
+        for arr in geometry_coords(feature.get('geometry') or {}):
+            if len(arr) and (np.abs(arr[:, 0]).max() > 180 or np.abs(arr[:, 1]).max() > 90):
+                return False
+    return True
+
+
+# ==============================================================================
+# SEMPLIFICAZIONE E QUANTIZZAZIONE
+# ==============================================================================
+
+def tolerance_for_zoom(zoom: int) -> float:
+    """Dimensione in gradi di longitudine di un pixel (tile da 256 px) al livello di zoom indicato."""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def decimals_for_zoom(zoom: int) -> int:
+    """Decimali sufficienti a rappresentare un decimo di pixel al livello di zoom indicato."""
+    return min(FULL_DECIMALS, int(math.ceil(-math.log10(tolerance_for_zoom(zoom)))) + 1)
+
+
+def douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Semplificazione Douglas-Peucker di una linea (versione iterativa, distanze calcolate con numpy).
+    @:param points: Array (n, 2) dei vertici
+    @:param tolerance: Distanza massima (in unità delle coordinate) dalla linea originale
+    @:return: Array dei vertici mantenuti (primo e ultimo sempre inclusi)
+    """
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        seg = end - start
+        inner = points[first + 1:last] - start
+        length = math.hypot(seg[0], seg[1])
+        if length == 0:
+            # Estremi coincidenti (anello chiuso): distanza dal punto iniziale
+            dist = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            dist = np.abs(seg[0] * inner[:, 1] - seg[1] * inner[:, 0]) / length
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            split = first + 1 + idx
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def _dedup(points: np.ndarray) -> np.ndarray:
+    # Dopo l'arrotondamento vertici consecutivi possono coincidere
+    if len(points) < 2:
+        return points
+    mask = np.ones(len(points), dtype=bool)
+    mask[1:] = np.any(points[1:] != points[:-1], axis=1)
+    return points[mask]
+
+
+def _linea(points: np.ndarray, tolerance: float, decimals: int, ring: bool) -> Optional[list]:
+    simplified = _dedup(np.round(douglas_peucker(points, tolerance), decimals))
+    if ring:
+        # Un anello valido ha almeno 4 vertici (il primo ripetuto in fondo)
+        if len(simplified) < 4:
+            return None
+        if np.any(simplified[0] != simplified[-1]):
+            simplified = np.vstack([simplified, simplified[:1]])
+    elif len(simplified) < 2:
+        return None
+    return simplified.tolist()
+
+
+def _poligono(rings: list, tolerance: float, decimals: int) -> Optional[list]:
+    out = []
+    for i, ring in enumerate(rings):
+        simplified = _linea(_xy(ring), tolerance, decimals, ring=True)
+        if simplified is None:
+            if i == 0:
+                # Senza anello esterno il poligono sparisce a questo livello di zoom
+                return None
+            continue
+        out.append(simplified)
+    return out
+
+
+def simplify_geometry(geometry: Optional[dict], tolerance: float, decimals: int) -> Optional[dict]:
+    """
+    Semplifica e quantizza una geometria GeoJSON già in WGS84.
+    Gli anelli che collassano sotto la tolleranza vengono eliminati; se una geometria sparirebbe
+    del tutto si conserva la sua versione solo quantizzata, per non perdere la feature.
+    @:param geometry: Geometria GeoJSON
+    @:param tolerance: Tolleranza in gradi (0 = nessuna semplificazione)
+    @:param decimals: Decimali delle coordinate in uscita
+    @:return: Nuova geometria
+    """
+    if not geometry:
+        return geometry
+    gtype = geometry.get('type')
+    coords = geometry.get('coordinates')
+
+    if gtype == 'GeometryCollection':
+        return {'type': gtype, 'geometries': [simplify_geometry(g, tolerance, decimals)
+                                               for g in geometry.get('geometries') or []]}
+    if gtype == 'Point':
+        return {'type': gtype, 'coordinates': [round(float(c), decimals) for c in coords[:2]]}
+    if gtype == 'MultiPoint':
+        return {'type': gtype, 'coordinates': np.round(_xy(coords), decimals).tolist()}
+
+    if gtype == 'LineString':
+        out = _linea(_xy(coords), tolerance, decimals, ring=False)
+    elif gtype == 'MultiLineString':
+        out = [line for line in (_linea(_xy(c), tolerance, decimals, ring=False)
+                                 for c in coords) if line is not None] or None
+    elif gtype == 'Polygon':
+        out = _poligono(coords, tolerance, decimals)
+    elif gtype == 'MultiPolygon':
+        out = [poly for poly in (_poligono(p, tolerance, decimals) for p in coords) if poly is not None] or None
+    else:
+        return geometry
+
+    if out is None and tolerance > 0:
+        return simplify_geometry(geometry, 0.0, decimals)
+    return {'type': gtype, 'coordinates': out if out is not None else coords}
+
+
+def reproject_geometry(geometry: Optional[dict], transform: Callable) -> Optional[dict]:
+    """
+    Applica una trasformazione di coordinate (x, y array -> lon, lat array) a una geometria.
+    """
+    if not geometry:
+        return geometry
+    gtype = geometry.get('type')
+    if gtype == 'GeometryCollection':
+        return {'type': gtype, 'geometries': [reproject_geometry(g, transform)
+                                               for g in geometry.get('geometries') or []]}
+
+    def conv(seq, depth):
+        # depth = livelli di annidamento sopra la sequenza di posizioni
+        if depth > 0:
+            return [conv(part, depth - 1) for part in seq]
+        arr = _xy(seq)
+        lon, lat = transform(arr[:, 0], arr[:, 1])
+        return np.stack([lon, lat], axis=-1).tolist()
+
+    depths = {'MultiPoint': 0, 'LineString': 0, 'MultiLineString': 1, 'Polygon': 1, 'MultiPolygon': 2}
+    coords = geometry.get('coordinates')
+    if gtype == 'Point':
+        return {'type': gtype, 'coordinates': conv([coords], 0)[0]}
+    if gtype in depths:
+        return {'type': gtype, 'coordinates': conv(coords, depths[gtype])}
+    return geometry
+
+
+# ==============================================================================
+# LAYER
+# ==============================================================================
+
+def strip_properties(properties: Optional[dict], keep: Optional[Sequence[str]]) -> dict:
+    """Mantiene solo le proprietà in `keep` (o, se None, tutte tranne i campi tecnici)."""
+    properties = properties or {}
+    if keep is None:
+        return {k: v for k, v in properties.items() if k not in _CAMPI_TECNICI}
+    return {k: properties[k] for k in keep if k in properties}
+
+
+def to_wgs84(collection: dict) -> dict:
+    """
+    Restituisce la FeatureCollection con coordinate lon/lat WGS84, riproiettando da UTM se
+    necessario, senza il membro "crs".
+    @:raise ValueError: Se le coordinate non sono in gradi e il CRS non è un UTM WGS84
+    """
+    out = {k: v for k, v in collection.items() if k != 'crs'}
+    if is_wgs84(collection):
+        return out
+    zone = utm_zone(crs_name(collection))
+    if zone is None:
+        raise ValueError(f"CRS non supportato: {crs_name(collection)}")
+    transform = lambda x, y: utm_to_wgs84(x, y, zone[0], zone[1])
+    out['features'] = [dict(f, geometry=reproject_geometry(f.get('geometry'), transform))
+                       for f in collection.get('features') or []]
+    return out
+
+
+def build_lod(collection: dict, zoom: Optional[int], keep: Optional[Sequence[str]] = None,
+              source_sha256: Optional[str] = None) -> dict:
+    """
+    Costruisce una versione del layer (già in WGS84) per un livello di zoom.
+    @:param collection: FeatureCollection in WGS84
+    @:param zoom: Livello di zoom (None = versione completa, senza semplificazione)
+    @:param keep: Proprietà da mantenere (None = tutte tranne i campi tecnici)
+    @:param source_sha256: Hash del file sorgente, scritto nel membro "source_sha256"
+    """
+    tolerance = 0.0 if zoom is None else tolerance_for_zoom(zoom)
+    decimals = FULL_DECIMALS if zoom is None else decimals_for_zoom(zoom)
+    features = []
+    for f in collection.get('features') or []:
+        features.append({
+            'type': 'Feature',
+            'properties': strip_properties(f.get('properties'), keep),
+            'geometry': simplify_geometry(f.get('geometry'), tolerance, decimals),
+        })
+    out = {'type': 'FeatureCollection'}
+    if source_sha256:
+        out['source_sha256'] = source_sha256
+    if 'name' in collection:
+        out['name'] = collection['name']
+    out['features'] = features
+    return out
+
+
+def lod_path(directory: Path, stem: str, zoom: Optional[int]) -> Path:
+    """Percorso della versione di un layer per il livello di zoom indicato (None = completa)."""
+    suffix = 'full' if zoom is None else f'z{zoom}'
+    return Path(directory) / LOD_DIRNAME / f'{stem}.{suffix}.geojson'
+
+
+def lod_candidates(zoom: Optional[float], zooms: Sequence[int] = LOD_ZOOMS) -> List[Optional[int]]:
+    """
+    Versioni da provare (in ordine) per un livello di zoom richiesto dal client:
+    il livello semplificato più dettagliato non superiore allo zoom, poi la versione completa.
+    Oltre l'ultimo livello si usa direttamente la versione completa.
+    """
+    if zoom is None or zoom > max(zooms):
+        return [None]
+    usable = [z for z in sorted(zooms) if z <= zoom] or [min(zooms)]
+    return [usable[-1], None]
+
+
+def lod_source_sha256(data: bytes) -> Optional[str]:
+    """Hash del file sorgente dichiarato da una versione generata da optimize_file() (None se assente)."""
+    match = _SOURCE_SHA256.match(data[:200])
+    return match.group(1).decode('ascii') if match else None
+
+
+def _write_json(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    tmp.replace(path)
+
+
+def optimize_file(path: Path, zooms: Sequence[int] = LOD_ZOOMS, out_dir: Optional[Path] = None) -> Dict[str, int]:
+    """
+    Genera tutte le versioni di un file GeoJSON.
+    @:param path: File sorgente
+    @:param zooms: Livelli di zoom semplificati da generare
+    @:param out_dir: Cartella base di output (default: la cartella del file)
+    @:return: dict nome del file generato -> dimensione in byte
+    """
+    path = Path(path)
+    raw = path.read_bytes()
+    collection = to_wgs84(json.loads(raw.decode('utf-8')))
+    source_sha256 = hashlib.sha256(raw).hexdigest()
+    keep = PROPRIETA_LAYER.get(path.stem)
+    sizes = {}
+    for zoom in [None, *zooms]:
+        target = lod_path(out_dir or path.parent, path.stem, zoom)
+        _write_json(target, build_lod(collection, zoom, keep, source_sha256))
+        sizes[target.name] = target.stat().st_size
+    return sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Genera le versioni ottimizzate (LOD) dei layer GeoJSON.")
+    parser.add_argument('--input', default=str(GEOJSON_DIR), help="Cartella dei file .geojson")
+    parser.add_argument('--zooms', type=int, nargs='+', default=list(LOD_ZOOMS), help="Livelli di zoom")
+    args = parser.parse_args()
+
+    for source in sorted(Path(args.input).glob('*.geojson')):
+        print(f"{source.name} ({source.stat().st_size} byte)")
+        for name, size in optimize_file(source, args.zooms).items():
+            print(f"  -> {LOD_DIRNAME}/{name}: {size} byte")
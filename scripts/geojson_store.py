@@ -0,0 +1,109 @@
+import json
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from scripts.precompressed import Precompressed
+
+# Archivio in memoria dei layer GeoJSON serviti dal server.
+# Ogni file viene letto una sola volta e tenuto in forma precompressa (gzip/brotli) con ETag forte;
+# un controllo di mtime/dimensione ad ogni richiesta fa ricaricare il layer quando il file cambia.
+# I dati derivati da un layer (es. indici o aggregazioni) sono memorizzati con derived() e
+# vengono scartati automaticamente insieme alla versione del layer a cui si riferiscono.
+
+
+class GeoJSONLayer:
+    """
+    Versione caricata di un file GeoJSON.
+    @:param path: Percorso del file
+    @:param signature: (mtime_ns, dimensione) del file al momento della lettura
+    @:param raw: Contenuto del file
+    """
+
+    def __init__(self, path: Path, signature: Tuple[int, int], raw: bytes):
+        self.path = path
+        self.signature = signature
+        # Le varianti gzip/brotli sono calcolate subito, al caricamento del layer
+        self.payload = Precompressed(raw).precompute()
+        # Identificativo del contenuto: cambia solo se cambia il file
+        self.version = self.payload.etags['identity'].strip('"')
+        self._data: Optional[dict] = None
+        self._derived: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def data(self) -> dict:
+        """FeatureCollection decodificata (calcolata alla prima richiesta)."""
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = json.loads(self.payload.data.decode('utf-8'))
+        return self._data
+
+    def derived(self, key: str, builder: Callable[['GeoJSONLayer'], Any]) -> Any:
+        """
+        Restituisce un dato derivato dal layer, calcolandolo con builder(layer) solo la prima volta.
+        @:param key: Nome del dato derivato
+        @:param builder: Funzione che calcola il dato a partire dal layer
+        """
+        if key not in self._derived:
+            with self._lock:
+                if key not in self._derived:
+                    self._derived[key] = builder(self)
+        return self._derived[key]
+
+
+class GeoJSONStore:
+    """
+    Cache dei layer GeoJSON di una cartella.
+    @:param directory: Cartella che contiene i file .geojson
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._layers: Dict[Path, GeoJSONLayer] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> Optional[GeoJSONLayer]:
+        """
+        Restituisce il layer del file indicato, ricaricandolo se il file è cambiato.
+        @:param path: Percorso del file (già validato dal chiamante)
+        @:return: GeoJSONLayer o None se il file non esiste
+        """
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        layer = self._layers.get(path)
+        if layer is not None and layer.signature == signature:
+            return layer
+
+        with self._lock:
+            layer = self._layers.get(path)
+            if layer is None or layer.signature != signature:
+                layer = GeoJSONLayer(path, signature, path.read_bytes())
+                self._layers[path] = layer
+        return layer
+
+    def preload(self, pattern: str = '*.geojson') -> int:
+        """
+        Carica (e precomprime) tutti i layer della cartella.
+        @:return: Numero di layer caricati
+        """
+        count = 0
+        for path in sorted(self.directory.glob(pattern)):
+            if self.get(path) is not None:
+                count += 1
+        return count
+
+    def layers(self) -> List[GeoJSONLayer]:
+        """Layer attualmente caricati."""
+        with self._lock:
+            return list(self._layers.values())
+
+    def layer(self, filename: str) -> Optional[GeoJSONLayer]:
+        """Scorciatoia per un file della cartella dell'archivio."""
+        return self.get(self.directory / filename)
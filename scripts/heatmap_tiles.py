@@ -0,0 +1,173 @@
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from scripts.feature_index import STRTree
+from scripts.point_cluster import lonlat_to_mercator, point_coords
+
+# Heatmap calcolata lato server e servita come tile PNG (schema XYZ, 256 px).
+# Per ogni tile i punti della tile (più un margine pari al raggio del kernel) vengono accumulati
+# in una griglia di pixel con numpy (histogram2d) e la griglia viene convoluta con un kernel
+# gaussiano separabile (due prodotti matriciali con una matrice a banda).
+# Alla costruzione i punti vengono anche aggregati in griglie a più risoluzioni (pixel dei livelli
+# GRID_ZOOMS, con il numero di punti per pixel): una tile usa la griglia più grossolana che abbia
+# almeno la sua risoluzione, quindi a basso zoom il costo dipende dai pixel occupati e non dai punti.
+# L'intensità segue la resa di leaflet.heat usata finora dal frontend: ogni punto vale `weight`,
+# ridotto di un fattore 2 per ogni livello sotto max_zoom, e il valore è saturato a 1.
+# Così la scala dei colori non dipende dalla tile e il costo di disegno nel browser è lo stesso
+# con mille o con un milione di avvistamenti. Le tile calcolate restano in una cache LRU legata
+# alla versione del layer.
+
+TILE_SIZE = 256
+# Livelli di zoom delle griglie di aggregazione precalcolate
+GRID_ZOOMS = (6, 10, 14)
+# Gradiente di default di leaflet.heat (posizione -> colore RGB)
+GRADIENT = ((0.4, (0, 0, 255)), (0.6, (0, 255, 255)), (0.7, (0, 255, 0)),
+            (0.8, (255, 255, 0)), (1.0, (255, 0, 0)))
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """
+    Codifica un'immagine RGBA (altezza, larghezza, 4) uint8 in PNG (solo libreria standard).
+    """
+    height, width = rgba.shape[:2]
+    # Ogni riga è preceduta dal byte del filtro (0 = nessun filtro)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def _palette() -> np.ndarray:
+    """Tabella di 256 colori RGB del gradiente, indicizzata per intensità."""
+    t = np.linspace(0, 1, 256)
+    stops = np.array([s for s, _ in GRADIENT])
+    colors = np.array([c for _, c in GRADIENT], dtype=np.float64)
+    return np.stack([np.interp(t, stops, colors[:, i]) for i in range(3)], axis=1).astype(np.uint8)
+
+
+def _kernel_matrix(size: int, sigma: float, radius: int) -> np.ndarray:
+    """Matrice a banda che applica una convoluzione gaussiana 1D (picco 1) a vettori di lunghezza size."""
+    idx = np.arange(size)
+    diff = idx[:, None] - idx[None, :]
+    kernel = np.exp(-(diff ** 2) / (2 * sigma ** 2))
+    kernel[np.abs(diff) > radius] = 0.0
+    return kernel
+
+
+EMPTY_TILE = encode_png(np.zeros((1, 1, 4), dtype=np.uint8))
+
+
+class HeatmapTiles:
+    """
+    Generatore di tile heatmap per i punti di una FeatureCollection.
+    @:param collection: FeatureCollection GeoJSON (di ogni feature si usa il primo vertice)
+    @:param radius: Raggio del kernel in pixel
+    @:param blur: Deviazione standard del kernel in pixel
+    @:param weight: Intensità di un punto a max_zoom
+    @:param max_zoom: Livello di zoom oltre il quale l'intensità dei punti non cresce più
+    @:param min_opacity: Opacità minima dei pixel non vuoti
+    @:param cache_size: Numero di tile tenute in cache
+    """
+
+    def __init__(self, collection: dict, radius: int = 25, blur: float = 15, weight: float = 0.6,
+                 max_zoom: int = 17, min_opacity: float = 0.05, cache_size: int = 512):
+        self.radius = radius
+        self.weight = weight
+        self.max_zoom = max_zoom
+        self.min_opacity = min_opacity
+        lon, lat = [], []
+        for f in collection.get('features') or []:
+            pos = point_coords(f.get('geometry'))
+            if pos is not None:
+                lon.append(pos[0])
+                lat.append(pos[1])
+        mx, my = lonlat_to_mercator(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        self.count = len(mx)
+
+        # Griglie dalla più fine alla più grossolana, poi i punti originali (peso 1)
+        self._sources = [(None, mx, my, np.ones(len(mx)), STRTree(np.column_stack([mx, my, mx, my])))]
+        for zoom in sorted(GRID_ZOOMS, reverse=True):
+            side = TILE_SIZE * 2 ** zoom
+            cx = np.minimum((mx * side).astype(np.int64), side - 1)
+            cy = np.minimum((my * side).astype(np.int64), side - 1)
+            cells, counts = np.unique(cx * side + cy, return_counts=True)
+            gx, gy = (cells // side + 0.5) / side, (cells % side + 0.5) / side
+            self._sources.insert(0, (zoom, gx, gy, counts.astype(np.float64),
+                                     STRTree(np.column_stack([gx, gy, gx, gy]))))
+
+        size = TILE_SIZE + 2 * radius
+        self._kernel = _kernel_matrix(size, blur, radius)
+        self._palette = _palette()
+        self._cache: "OrderedDict[Tuple[int, int, int], bytes]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _source(self, z: int):
+        # Griglia più grossolana con risoluzione almeno pari a quella della tile
+        for source in self._sources:
+            if source[0] is None or source[0] >= z:
+                return source
+
+    def density(self, z: int, x: int, y: int) -> Optional[np.ndarray]:
+        """
+        Intensità (0-1) dei pixel di una tile.
+        @:return: Array (256, 256) o None se la tile non contiene punti
+        """
+        scale = TILE_SIZE * 2 ** z
+        margin = self.radius / scale
+        x0, y0 = x / 2 ** z, y / 2 ** z
+        x1, y1 = (x + 1) / 2 ** z, (y + 1) / 2 ** z
+        _, mx, my, weights, tree = self._source(z)
+        ids = tree.query((x0 - margin, y0 - margin, x1 + margin, y1 + margin))
+        if not len(ids):
+            return None
+
+        # Coordinate in pixel rispetto all'angolo della tile allargata con il margine
+        px = (mx[ids] - x0) * scale + self.radius
+        py = (my[ids] - y0) * scale + self.radius
+        size = TILE_SIZE + 2 * self.radius
+        grid, _, _ = np.histogram2d(py, px, bins=size, range=((0, size), (0, size)), weights=weights[ids])
+
+        point_weight = self.weight / 2 ** max(0, min(self.max_zoom - z, 12))
+        smoothed = self._kernel @ grid @ self._kernel.T
+        r = self.radius
+        return np.minimum(1.0, smoothed[r:r + TILE_SIZE, r:r + TILE_SIZE] * point_weight)
+
+    def render(self, z: int, x: int, y: int) -> bytes:
+        """Tile PNG (trasparente se vuota), dalla cache se già calcolata."""
+        key = (z, x, y)
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                return png
+
+        intensity = self.density(z, x, y)
+        if intensity is None or not intensity.any():
+            png = EMPTY_TILE
+        else:
+            rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+            level = (intensity * 255).astype(np.uint8)
+            rgba[..., :3] = self._palette[level]
+            alpha = np.where(intensity >= 1 / 255, np.maximum(intensity, self.min_opacity), 0.0)
+            rgba[..., 3] = (alpha * 255).astype(np.uint8)
+            png = encode_png(rgba)
+
+        with self._lock:
+            self._cache[key] = png
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return png
@@ -1,34 +1,227 @@
+import argparse
+import io
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
 import pandas as pd
 import numpy as np
 
-# Percorsi dei file (corretti per esecuzione dalla root del progetto)
-intakes_path = '../dataset/animal-shelter-intakes-and-outcomes.csv'
-rifugi_path = '../dataset/rifugi_locations.csv'
-output_path = '../dataset/animali-rifugi.csv'
+# Associazione di ogni ingresso (intake) al rifugio più vicino (o ai k più vicini).
+# Il CSV degli ingressi viene letto a blocchi di circa block_size byte, tagliati a fine record (un a capo
+# preceduto da un numero pari di virgolette, così i campi tra virgolette che contengono a capo restano
+# interi): la memoria usata non dipende dalla lunghezza dello storico. Il processo principale legge solo
+# i byte; ogni processo del pool analizza il proprio blocco, ne estrae le coordinate in modo vettoriale,
+# cerca i rifugi più vicini con SphericalKDTree.query_batch (l'indice è costruito una sola volta per
+# processo, all'avvio), affianca le colonne dei rifugi e restituisce il blocco già in formato CSV.
+# I blocchi vengono scritti nell'ordine di lettura, con al più 2 blocchi per processo in lavorazione.
+# Gli ingressi senza coordinate valide restano nel file, con le colonne del rifugio vuote.
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.dataset_store import DATASETS
+from scripts.spatial_index import SphericalKDTree
+
+# Percorsi di default dei file
+intakes_path = BASE_DIR / 'dataset' / 'animal-shelter-intakes-and-outcomes.csv'
+rifugi_path = BASE_DIR / 'dataset' / 'rifugi_locations.csv'
+output_path = BASE_DIR / 'dataset' / 'animali-rifugi.csv'
+
+# Byte letti per blocco (circa 200.000 righe degli ingressi)
+BLOCK_SIZE = 32 << 20
+# Nomi possibili delle colonne delle coordinate negli ingressi; 'geopoint' è "lat, lon"
+LAT_COLUMNS = ('latitude', 'Latitude', 'lat', 'Lat')
+LON_COLUMNS = ('longitude', 'Longitude', 'lon', 'Lon', 'lng')
+GEOPOINT_COLUMN = 'geopoint'
+DISTANCE_COLUMN = 'Distance_km'
+
+
+def _numeric_column(df: pd.DataFrame, names) -> np.ndarray:
+    for name in names:
+        if name in df.columns:
+            return pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=float)
+    return np.full(len(df), np.nan)
+
+
+def intake_coords(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Coordinate degli ingressi di un blocco. Gli zeri valgono come coordinate mancanti (come in
+    clean_animali_rifugi.py) e le righe senza latitudine/longitudine usano la colonna geopoint.
+    @:return: Tuple (lat, lon) di array float con NaN dove le coordinate mancano
+    """
+    lat = _numeric_column(df, LAT_COLUMNS)
+    lon = _numeric_column(df, LON_COLUMNS)
+    missing = ~(np.isfinite(lat) & np.isfinite(lon)) | ((lat == 0) & (lon == 0))
+    if missing.any() and GEOPOINT_COLUMN in df.columns:
+        parts = df[GEOPOINT_COLUMN].astype('string').str.strip('()[] ').str.split(',', n=1, expand=True)
+        if parts.shape[1] == 2:
+            lat = np.where(missing, pd.to_numeric(parts[0], errors='coerce').to_numpy(dtype=float), lat)
+            lon = np.where(missing, pd.to_numeric(parts[1], errors='coerce').to_numpy(dtype=float), lon)
+    invalid = (np.abs(lat) > 90) | (np.abs(lon) > 180) | ((lat == 0) & (lon == 0))
+    return np.where(invalid, np.nan, lat), np.where(invalid, np.nan, lon)
+
+
+def read_header(f) -> bytes:
+    """Primo record (intestazione) di un CSV aperto in binario."""
+    header = f.readline()
+    while header.count(b'"') % 2:
+        line = f.readline()
+        if not line:
+            break
+        header += line
+    return header
+
+
+def read_blocks(f, block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    """
+    Blocchi di record completi di un CSV aperto in binario (dopo l'intestazione).
+    @:param block_size: Byte letti per volta; un record più lungo finisce in un blocco più grande
+    """
+    carry = b''
+    while True:
+        data = f.read(block_size)
+        if not data:
+            if carry.strip():
+                yield carry
+            return
+        block = carry + data
+        # Ultimo a capo fuori dalle virgolette: i byte successivi passano al blocco seguente
+        cut = block.rfind(b'\n')
+        while cut >= 0 and block.count(b'"', 0, cut) % 2:
+            cut = block.rfind(b'\n', 0, cut)
+        if cut < 0:
+            carry = block
+            continue
+        yield block[:cut + 1]
+        carry = block[cut + 1:]
+
+
+# Rifugi e relativo indice nei processi del pool
+_worker_index: Optional[SphericalKDTree] = None
+_worker_rifugi: Optional[pd.DataFrame] = None
+_worker_shelters: Optional[pd.DataFrame] = None
+
+
+def _init_worker(rifugi: pd.DataFrame, lat: np.ndarray, lon: np.ndarray, ids: np.ndarray):
+    global _worker_index, _worker_rifugi, _worker_shelters
+    _worker_index = SphericalKDTree(lat, lon, ids=ids)
+    _worker_rifugi = rifugi
+    _worker_shelters = None
+
+
+def _process_block(header: bytes, block: bytes, k: int, with_header: bool) -> Tuple[bytes, int, int]:
+    """
+    Lavoro di un processo del pool su un blocco: lettura, ricerca dei rifugi e unione.
+    @:return: Tuple (blocco unito in formato CSV, righe, righe associate a un rifugio)
+    """
+    global _worker_shelters
+    chunk = pd.read_csv(io.BytesIO(header + block), low_memory=False)
+    if _worker_shelters is None:
+        _worker_shelters = _shelter_frame(_worker_rifugi, set(chunk.columns))
+    dist, ids = _worker_index.query_batch(*intake_coords(chunk), k)
+    joined = join_chunk(chunk, _worker_shelters, ids, dist)
+    associated = int((ids[:, 0] >= 0).sum()) if ids.shape[1] else 0
+    return joined.to_csv(index=False, header=with_header).encode('utf-8'), len(chunk), associated
+
+
+def _shelter_frame(rifugi: pd.DataFrame, intake_columns) -> pd.DataFrame:
+    # Le colonne dei rifugi con lo stesso nome di una colonna degli ingressi prendono il suffisso _rifugio
+    return rifugi.rename(columns={c: f"{c}_rifugio" for c in rifugi.columns if c in intake_columns})
+
+
+def join_chunk(chunk: pd.DataFrame, rifugi: pd.DataFrame, ids: np.ndarray, dist: np.ndarray) -> pd.DataFrame:
+    """
+    Affianca a un blocco di ingressi le colonne dei rifugi assegnati.
+    @:param chunk: Blocco di ingressi
+    @:param rifugi: Rifugi (indice 0..n-1, colonne già rinominate)
+    @:param ids: Array (righe, k) delle posizioni dei rifugi, -1 se la riga non ha coordinate
+    @:param dist: Array (righe, k) delle distanze in km
+    @:return: Blocco con, per il j-esimo rifugio, le colonne del rifugio e Distance_km (suffisso _j per j > 1)
+    """
+    parts = [chunk.reset_index(drop=True)]
+    for j in range(ids.shape[1]):
+        # reindex con -1 produce una riga vuota
+        shelter = rifugi.reindex(ids[:, j]).reset_index(drop=True)
+        shelter[DISTANCE_COLUMN] = np.round(dist[:, j], 3)
+        if j:
+            shelter = shelter.add_suffix(f"_{j + 1}")
+        parts.append(shelter)
+    return pd.concat(parts, axis=1)
+
 
-# Carica i dati
-intakes = pd.read_csv(intakes_path)
-rifugi = pd.read_csv(rifugi_path)
+def merge(intakes: Path = intakes_path, rifugi_csv: Path = rifugi_path, output: Path = output_path,
+          k: int = 1, block_size: int = BLOCK_SIZE, workers: Optional[int] = None) -> dict:
+    """
+    Scrive il CSV degli ingressi con i k rifugi più vicini a ciascuno.
+    @:param intakes: CSV degli ingressi
+    @:param rifugi_csv: CSV dei rifugi (colonne Latitude e Longitude)
+    @:param output: CSV di output (scritto in un file temporaneo e sostituito alla fine)
+    @:param k: Numero di rifugi per ingresso
+    @:param block_size: Byte degli ingressi letti per blocco
+    @:param workers: Processi del pool (default: numero di CPU; 1 = nessun pool)
+    @:return: dict con il numero di righe scritte e di righe associate a un rifugio
+    """
+    rifugi = DATASETS.read(rifugi_csv)
+    lat = pd.to_numeric(rifugi['Latitude'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(rifugi['Longitude'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    if not valid.any():
+        raise ValueError(f"Nessun rifugio con coordinate valide in {rifugi_csv}")
+    worker_args = (rifugi, lat[valid], lon[valid], np.flatnonzero(valid))
 
-n_intakes = len(intakes)
-n_rifugi = len(rifugi)
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    output = Path(output)
+    tmp = output.with_name(output.name + '.tmp')
+    stats = {'righe': 0, 'associate': 0}
 
-# Crea una lista di indici di rifugi distribuiti uniformemente
-rifugi_indices = np.tile(np.arange(n_rifugi), n_intakes // n_rifugi)
-rest = n_intakes % n_rifugi
-if rest:
-    rifugi_indices = np.concatenate([rifugi_indices, np.random.choice(n_rifugi, rest, replace=False)])
+    with open(intakes, 'rb') as source, open(tmp, 'wb') as out:
+        header = read_header(source)
 
-np.random.shuffle(rifugi_indices)
+        def write(result):
+            data, rows, associated = result
+            out.write(data)
+            stats['righe'] += rows
+            stats['associate'] += associated
 
-# Assegna i rifugi alle righe del dataset principale
-rifugi_expanded = rifugi.iloc[rifugi_indices].reset_index(drop=True)
+        blocks = enumerate(read_blocks(source, block_size))
+        if workers == 1:
+            _init_worker(*worker_args)
+            for i, block in blocks:
+                write(_process_block(header, block, k, i == 0))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=worker_args) as pool:
+                pending = deque()
+                for i, block in blocks:
+                    pending.append(pool.submit(_process_block, header, block, k, i == 0))
+                    while len(pending) > 2 * workers:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
 
-# Unisci i dati
-merged = pd.concat([intakes.reset_index(drop=True), rifugi_expanded], axis=1)
+    if stats['righe'] == 0:
+        # CSV vuoto: si scrive comunque l'intestazione
+        empty = pd.read_csv(intakes, nrows=0)
+        join_chunk(empty, _shelter_frame(rifugi, set(empty.columns)),
+                   np.empty((0, k), dtype=np.intp), np.empty((0, k))).to_csv(tmp, index=False)
+    os.replace(tmp, output)
+    return stats
 
-# Salva il risultato
-merged.to_csv(output_path, index=False)
 
-print(f"File salvato in {output_path}")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Associa a ogni ingresso il rifugio più vicino.")
+    parser.add_argument('--intakes', default=str(intakes_path), help="CSV degli ingressi")
+    parser.add_argument('--rifugi', default=str(rifugi_path), help="CSV dei rifugi")
+    parser.add_argument('--output', default=str(output_path), help="CSV di output")
+    parser.add_argument('-k', type=int, default=1, help="Rifugi più vicini per ingresso")
+    parser.add_argument('--block-mb', type=int, default=BLOCK_SIZE >> 20, help="MB degli ingressi letti per blocco")
+    parser.add_argument('--workers', type=int, default=None, help="Processi (default: numero di CPU)")
+    args = parser.parse_args()
 
+    stats = merge(args.intakes, args.rifugi, args.output, k=args.k, block_size=args.block_mb << 20,
+                  workers=args.workers)
+    print(f"File salvato in {args.output}: {stats['righe']} righe, {stats['associate']} associate a un rifugio")
@@ -0,0 +1,286 @@
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Metriche del server nel formato di esposizione testuale di Prometheus (endpoint /metrics).
+# Contatori e istogrammi sono tenuti in memoria con un lock per metrica: il costo per richiesta è
+# una ricerca binaria sui bucket e qualche incremento. Le statistiche già tenute da altri oggetti
+# (es. la cache del geocoding) vengono lette solo al momento dell'esposizione, tramite collector.
+# Con più processi worker (scripts/serve.py) ogni processo scrive periodicamente un'istantanea
+# delle proprie metriche in METRICS_DIR e /metrics restituisce la somma di tutte le istantanee,
+# indipendentemente dal worker che risponde. Quando un worker termina, contatori e istogrammi della
+# sua ultima istantanea vengono sommati in RETIRED_FILE, così i totali restano monotoni.
+
+# Bucket di default per le latenze (secondi)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Secondi tra due istantanee scritte in METRICS_DIR
+SNAPSHOT_INTERVAL = 5.0
+# Istantanea con i totali dei processi terminati (vedi retire_snapshot())
+RETIRED_FILE = 'retired.json'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Famiglia di metriche esportata: tipo, descrizione, nomi delle etichette, bucket e campioni.
+# Campioni: {valori delle etichette: valore} per counter/gauge, {valori: [conteggi per bucket, somma]}
+# per gli istogrammi (conteggi non cumulativi, l'ultimo bucket è +Inf).
+Family = dict
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), registry: 'Registry' = None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def family(self) -> Family:
+        with self._lock:
+            samples = {k: (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+        return {'name': self.name, 'type': self.kind, 'help': self.help, 'labels': list(self.labelnames),
+                'samples': samples}
+
+
+class Counter(_Metric):
+    """Contatore monotono, con etichette opzionali."""
+    kind = 'counter'
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        """
+        Incrementa il contatore per i valori delle etichette indicati (nell'ordine di labelnames).
+        """
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+class Histogram(_Metric):
+    """
+    Istogramma con bucket fissi.
+    @:param buckets: Limiti superiori dei bucket (il bucket +Inf è aggiunto automaticamente)
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: 'Registry' = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, registry)
+
+    def observe(self, value: float, *labelvalues: str):
+        """Registra un valore per i valori delle etichette indicati."""
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # Conteggi per bucket (+Inf in fondo) e somma dei valori
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[pos] += 1
+            state[-1] += value
+
+    def family(self) -> Family:
+        family = super().family()
+        family['buckets'] = list(self.buckets)
+        return family
+
+
+class Registry:
+    """Insieme delle metriche e dei collector esposti da /metrics."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+        self._lock = threading.Lock()
+        self._writer_pid: Optional[int] = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"Metrica già registrata: {metric.name}")
+            self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        """
+        Registra una funzione chiamata ad ogni esposizione, che restituisce famiglie di metriche
+        calcolate al momento (es. statistiche di una cache).
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[Family]:
+        """Famiglie di metriche del processo corrente."""
+        families = [m.family() for m in self._metrics]
+        for collector in list(self._collectors):
+            try:
+                families.extend(collector())
+            except Exception as e:
+                print(f"Errore nel collector delle metriche: {e}")
+        return families
+
+    # --- PIÙ PROCESSI ---
+    @staticmethod
+    def _snapshot_dir() -> Optional[Path]:
+        directory = os.environ.get('METRICS_DIR')
+        return Path(directory) if directory else None
+
+    def write_snapshot(self, directory: Path):
+        """Scrive l'istantanea delle metriche del processo in directory/<pid>.json."""
+        families = self.collect()
+        for family in families:
+            family['samples'] = [[list(k), v] for k, v in family['samples'].items()]
+        target = directory / f"{os.getpid()}.json"
+        tmp = directory / f".{os.getpid()}.json.tmp"
+        tmp.write_text(json.dumps(families), encoding='utf-8')
+        os.replace(tmp, target)
+
+    def flush(self):
+        """Aggiorna subito l'istantanea del processo (es. prima che un worker termini)."""
+        directory = self._snapshot_dir()
+        if directory is not None and self._writer_pid == os.getpid():
+            try:
+                self.write_snapshot(directory)
+            except OSError:
+                pass
+
+    def _after_fork(self):
+        # Il worker riparte da zero (i valori ereditati sono del processo principale) e, se le
+        # metriche sono condivise tra processi, scrive periodicamente la propria istantanea
+        directory = self._snapshot_dir()
+        if directory is None or self._writer_pid == os.getpid():
+            return
+        for metric in self._metrics:
+            metric._reset()
+        self._writer_pid = os.getpid()
+        threading.Thread(target=self._snapshot_loop, args=(directory,), daemon=True,
+                         name='metrics-snapshot').start()
+
+    def _snapshot_loop(self, directory: Path):
+        while True:
+            try:
+                self.write_snapshot(directory)
+            except OSError:
+                pass
+            time.sleep(SNAPSHOT_INTERVAL)
+
+    def gather(self) -> List[Family]:
+        """
+        Famiglie da esporre: quelle del processo o, con METRICS_DIR, la somma delle istantanee
+        di tutti i processi (aggiornando prima quella del processo corrente).
+        """
+        directory = self._snapshot_dir()
+        if directory is None:
+            return self.collect()
+        self.write_snapshot(directory)
+        snapshots = []
+        for path in directory.glob('*.json'):
+            try:
+                snapshots.append(json.loads(path.read_text(encoding='utf-8')))
+            except (OSError, ValueError):
+                continue
+        return merge_snapshots(snapshots)
+
+    def render(self) -> str:
+        return render(self.gather())
+
+
+def merge_snapshots(snapshots: List[List[Family]]) -> List[Family]:
+    """Somma le istantanee di più processi (campioni come liste [etichette, valore])."""
+    merged: Dict[str, Family] = {}
+    for families in snapshots:
+        for family in families:
+            target = merged.setdefault(family['name'], dict(family, samples={}))
+            for labels, value in family['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['samples'][key] = current + value
+    return list(merged.values())
+
+
+def retire_snapshot(directory: Path, pid: int):
+    """
+    Somma contatori e istogrammi dell'istantanea di un processo terminato in directory/RETIRED_FILE
+    e rimuove l'istantanea: i totali esposti da /metrics non diminuiscono quando un worker viene
+    ricreato. I gauge del processo terminato non hanno più significato e vengono scartati.
+    @:param directory: Cartella delle istantanee (METRICS_DIR)
+    @:param pid: Processo terminato
+    """
+    source = directory / f"{pid}.json"
+    target = directory / RETIRED_FILE
+    snapshots = []
+    for path in (target, source):
+        try:
+            snapshots.append(json.loads(path.read_text(encoding='utf-8')))
+        except (OSError, ValueError):
+            continue
+    families = [f for f in merge_snapshots(snapshots) if f['type'] != 'gauge']
+    for family in families:
+        family['samples'] = [[list(k), v] for k, v in family['samples'].items()]
+    tmp = directory / f".{RETIRED_FILE}.tmp"
+    tmp.write_text(json.dumps(families), encoding='utf-8')
+    os.replace(tmp, target)
+    source.unlink(missing_ok=True)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render(families: List[Family]) -> str:
+    """Testo nel formato di esposizione di Prometheus (versione 0.0.4)."""
+    lines = []
+    for family in families:
+        name, kind, names = family['name'], family['type'], family['labels']
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {kind}")
+        samples = family['samples']
+        items = samples.items() if isinstance(samples, dict) else ((tuple(k), v) for k, v in samples)
+        for values, value in sorted(items):
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(list(family['buckets']) + [math.inf], value[:-1]):
+                    cumulative += count
+                    le = 'le="' + _number(bound) + '"'
+                    lines.append(f"{name}_bucket{_labels(names, values, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(names, values)} {_number(value[-1])}")
+                lines.append(f"{name}_count{_labels(names, values)} {cumulative}")
+            else:
+                lines.append(f"{name}{_labels(names, values)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def family(name: str, kind: str, help_text: str, samples: Dict[Tuple[str, ...], float],
+           labelnames: Sequence[str] = ()) -> Family:
+    """Costruisce una famiglia di metriche per i collector."""
+    return {'name': name, 'type': kind, 'help': help_text, 'labels': list(labelnames), 'samples': dict(samples)}
+
+
+REGISTRY = Registry()
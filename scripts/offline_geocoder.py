@@ -0,0 +1,163 @@
+import difflib
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from scripts.address_normalizer import DEFAULT_STATE, canonical_street, normalize_city, normalize_state, parse_address
+from scripts.spatial_index import SphericalKDTree
+
+_DIGITS = re.compile(r'\d')
+
+# Geocoder locale basato sul dataset arricchito delle strade (strade_all_enriched.csv).
+# Le voci prodotte da load_street_names() contengono già lat/lon/postcode per ogni strada:
+# una query del tipo "via, città" viene risolta da qui in pochi microsecondi, e solo in caso di
+# mancata corrispondenza si ricorre a Nominatim (limitato a 1 richiesta al secondo).
+# Le coordinate del dataset sono quelle della strada (non del numero civico): le query con il civico
+# non vengono risolte qui, perché un punto per tutta la via può distare chilometri dall'indirizzo.
+# Si accetta solo la via nella città indicata (mai la stessa via di un'altra città) o, senza città,
+# una via presente in una sola città; le corrispondenze approssimate devono conservare tutte le parti
+# numeriche del nome ("w 1st st" non diventa "w 21st st"). Una query con uno stato diverso da quelli
+# del dataset (es. "Pine Ave, Long Beach, NY") passa a Nominatim.
+# ReverseGeocoder risolve il percorso inverso (coordinate -> strada più vicina) con un KD-tree
+# sferico sulle stesse voci.
+
+
+def parti_numeriche(via: str) -> Tuple[str, ...]:
+    """Parole del nome di via che contengono cifre (es. 'w 21st st' -> ('21st',))."""
+    return tuple(w for w in via.split() if _DIGITS.search(w))
+
+
+class OfflineGeocoder:
+    """
+    Geocoder in memoria costruito sulle voci di load_street_names().
+    Vengono indicizzate solo le strade con coordinate valide.
+    @:param entries: Lista di dict con 'name', 'city', 'lat', 'lon', 'postcode'
+    @:param fuzzy_cutoff: Soglia di somiglianza (0-1) per le corrispondenze approssimate
+    """
+
+    def __init__(self, entries: List[dict], fuzzy_cutoff: float = 0.88):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        # (via, città) -> voci; via -> voci (per le query senza città)
+        self._per_via_citta: Dict[Tuple[str, str], List[dict]] = defaultdict(list)
+        self._per_via: Dict[str, List[dict]] = defaultdict(list)
+        # via -> città in cui compare (una query senza città è risolta solo se la via è in una sola città)
+        self._citta_per_via: Dict[str, set] = defaultdict(set)
+        # (città, iniziale) -> nomi di via, per limitare il confronto approssimato
+        self._bucket: Dict[Tuple[Optional[str], str], List[str]] = defaultdict(list)
+        # Stati delle voci (codici di due lettere; DEFAULT_STATE se mancante)
+        self._stati = set()
+
+        for e in entries:
+            if e.get('lat') is None or e.get('lon') is None:
+                continue
+            via = canonical_street(e.get('name') or '')
+            citta = normalize_city(e.get('city') or '')
+            if not via:
+                continue
+            if not self._per_via[via]:
+                self._bucket[(None, via[0])].append(via)
+            if not self._per_via_citta[(via, citta)]:
+                self._bucket[(citta, via[0])].append(via)
+            self._per_via_citta[(via, citta)].append(e)
+            self._per_via[via].append(e)
+            self._citta_per_via[via].add(citta)
+            self._stati.add(self._stato(e))
+
+    def __len__(self) -> int:
+        return len(self._per_via_citta)
+
+    @staticmethod
+    def _stato(e: dict) -> str:
+        return normalize_state(e.get('state') or '') or DEFAULT_STATE
+
+    def _scegli(self, voci: List[dict], cap: Optional[str]) -> dict:
+        # A parità di nome, preferisce la voce con il CAP indicato dall'utente
+        if cap:
+            for e in voci:
+                if str(e.get('postcode') or '').startswith(cap):
+                    return e
+        return voci[0]
+
+    def _trova_via(self, via: str, citta: Optional[str]) -> Optional[List[dict]]:
+        if citta is not None:
+            return self._per_via_citta.get((via, citta))
+        if len(self._citta_per_via.get(via, ())) != 1:
+            return None
+        return self._per_via.get(via)
+
+    def geocode(self, query: str) -> Optional[dict]:
+        """
+        Risolve una query testuale.
+        @:param query: Indirizzo del tipo "via, città[, stato][, CAP]"
+        @:return: Dizionario {'lat', 'lon', 'postcode', 'display'} o None se non trovato
+                  (sempre None se la query contiene il numero civico)
+        """
+        indirizzo = parse_address(query)
+        if indirizzo.number:
+            return None
+        if indirizzo.state is not None and indirizzo.state not in self._stati:
+            return None
+        via, citta, cap = indirizzo.street(with_number=False), indirizzo.city, indirizzo.zip
+        if not via:
+            return None
+
+        voci = self._trova_via(via, citta)
+
+        # Corrispondenza approssimata, limitata alle vie della stessa città con la stessa iniziale
+        # e le stesse parti numeriche
+        if voci is None:
+            numeri = parti_numeriche(via)
+            candidati = [c for c in self._bucket.get((citta, via[0]), []) if parti_numeriche(c) == numeri]
+            simili = difflib.get_close_matches(via, candidati, n=1, cutoff=self.fuzzy_cutoff)
+            if simili:
+                voci = self._trova_via(simili[0], citta)
+
+        if voci and indirizzo.state is not None:
+            voci = [e for e in voci if self._stato(e) == indirizzo.state]
+        if not voci:
+            return None
+        e = self._scegli(voci, cap)
+        return {
+            'lat': float(e['lat']),
+            'lon': float(e['lon']),
+            'postcode': e.get('postcode'),
+            'display': e.get('display') or query,
+        }
+
+
+class ReverseGeocoder:
+    """
+    Geocoding inverso in memoria: strada più vicina a un punto.
+    Vengono indicizzate solo le voci con coordinate valide.
+    @:param entries: Lista di dict prodotti da load_street_names()
+    """
+
+    def __init__(self, entries: List[dict]):
+        self.entries = entries
+        ids, lat, lon = [], [], []
+        for i, e in enumerate(entries):
+            if e.get('lat') is None or e.get('lon') is None:
+                continue
+            ids.append(i)
+            lat.append(float(e['lat']))
+            lon.append(float(e['lon']))
+        self._tree = SphericalKDTree(lat, lon, ids=ids)
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def reverse(self, lat: float, lon: float, max_km: Optional[float] = None) -> Optional[Tuple[dict, float]]:
+        """
+        Trova la strada più vicina alle coordinate.
+        @:param lat: Latitudine
+        @:param lon: Longitudine
+        @:param max_km: Distanza massima accettata (None = nessun limite)
+        @:return: Tuple (voce di load_street_names, distanza in km) o None se nessuna strada è abbastanza vicina
+        """
+        found = self._tree.nearest(lat, lon)
+        if found is None:
+            return None
+        km, idx = found
+        if max_km is not None and km > max_km:
+            return None
+        return self.entries[int(idx)], float(km)
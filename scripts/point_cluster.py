@@ -0,0 +1,167 @@
+import json
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from scripts.feature_index import Bounds, STRTree
+
+# Clustering gerarchico dei layer di punti, precalcolato una volta per versione del layer.
+# I punti vengono proiettati in Web Mercator (coordinate 0-1) e assegnati a una griglia allineata
+# alle tile: al livello di zoom z la griglia ha 2^(z + CELL_BITS) celle per lato, cioè celle da
+# 256 / 2^CELL_BITS pixel. Le celle di un livello contengono esattamente quattro celle del livello
+# successivo, quindi i cluster formano una gerarchia (come in supercluster): ogni cluster al livello z
+# è l'unione di cluster al livello z + 1, e si ottiene con uno shift degli indici di cella.
+# Il centro di un cluster è la media dei suoi punti; per ogni livello i centri sono indicizzati
+# con un STRTree per le query per bbox. Oltre max_zoom si restituiscono i singoli punti.
+
+DEFAULT_MAX_ZOOM = 16
+# Celle da 64 pixel (256 / 2^2)
+CELL_BITS = 2
+
+
+def lonlat_to_mercator(lon: np.ndarray, lat: np.ndarray):
+    """Coordinate Web Mercator normalizzate in [0, 1] (x verso est, y verso sud)."""
+    lat = np.clip(lat, -85.05112878, 85.05112878)
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0
+    sin = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return np.clip(x, 0.0, 1.0), np.clip(y, 0.0, 1.0)
+
+
+def point_coords(geometry: Optional[dict]):
+    """Posizione (lon, lat) di una feature puntuale: il punto o il primo vertice, come extractCoords()."""
+    if not geometry or not geometry.get('coordinates'):
+        return None
+    coords = geometry['coordinates']
+    try:
+        while isinstance(coords[0], (list, tuple)):
+            coords = coords[0]
+        lon, lat = float(coords[0]), float(coords[1])
+    except (IndexError, TypeError, ValueError):
+        return None
+    if not (math.isfinite(lon) and math.isfinite(lat)):
+        return None
+    return lon, lat
+
+
+def _abbrevia(count: int) -> str:
+    if count >= 1000000:
+        return f"{count / 1000000:.1f}M"
+    if count >= 10000:
+        return f"{round(count / 1000)}k"
+    if count >= 1000:
+        return f"{count / 1000:.1f}k"
+    return str(count)
+
+
+class _Livello:
+    """Cluster di un livello di zoom: centri, conteggi e primo punto di ciascun cluster."""
+
+    def __init__(self, zoom: int, lon, lat, counts, first, parent_of_points):
+        self.zoom = zoom
+        self.lon = lon
+        self.lat = lat
+        self.counts = counts
+        self.first = first
+        # Per ogni punto, il cluster di questo livello a cui appartiene
+        self.member = parent_of_points
+        self.expansion = np.full(len(counts), zoom + 1, dtype=np.int64)
+        self.tree = STRTree(np.column_stack([lon, lat, lon, lat]))
+
+
+class PointClusterer:
+    """
+    Clustering gerarchico a griglia delle feature puntuali di una FeatureCollection.
+    Le feature senza una posizione valida vengono ignorate.
+    @:param collection: FeatureCollection GeoJSON
+    @:param max_zoom: Ultimo livello di zoom in cui i punti vengono raggruppati
+    """
+
+    def __init__(self, collection: dict, max_zoom: int = DEFAULT_MAX_ZOOM):
+        self.max_zoom = max_zoom
+        self.fragments: List[str] = []
+        lon, lat = [], []
+        for f in collection.get('features') or []:
+            pos = point_coords(f.get('geometry'))
+            if pos is None:
+                continue
+            self.fragments.append(json.dumps(f, ensure_ascii=False, separators=(',', ':')))
+            lon.append(pos[0])
+            lat.append(pos[1])
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.levels: Dict[int, _Livello] = {}
+        self.points_tree = STRTree(np.column_stack([self.lon, self.lat, self.lon, self.lat]))
+        if len(self.lon):
+            self._build()
+
+    def __len__(self) -> int:
+        return len(self.fragments)
+
+    def _build(self):
+        mx, my = lonlat_to_mercator(self.lon, self.lat)
+        side = 2 ** (self.max_zoom + CELL_BITS)
+        cx = np.minimum((mx * side).astype(np.int64), side - 1)
+        cy = np.minimum((my * side).astype(np.int64), side - 1)
+
+        for zoom in range(self.max_zoom, -1, -1):
+            shift = self.max_zoom - zoom
+            keys = ((cx >> shift) << (zoom + CELL_BITS)) | (cy >> shift)
+            uniq, first, member = np.unique(keys, return_index=True, return_inverse=True)
+            counts = np.bincount(member)
+            lon = np.bincount(member, weights=self.lon) / counts
+            lat = np.bincount(member, weights=self.lat) / counts
+            self.levels[zoom] = _Livello(zoom, lon, lat, counts, first, member)
+
+        # Zoom a cui un cluster si divide: il primo livello in cui i suoi punti occupano più celle
+        for zoom in range(self.max_zoom - 1, -1, -1):
+            level, child = self.levels[zoom], self.levels[zoom + 1]
+            # Cluster del livello successivo (uno per punto) -> cluster padre
+            parent = np.empty(len(child.counts), dtype=np.int64)
+            parent[child.member] = level.member
+            n_children = np.bincount(parent, minlength=len(level.counts))
+            single = n_children == 1
+            # Un cluster con un solo figlio si divide allo stesso zoom del figlio
+            only_child = np.empty(len(level.counts), dtype=np.int64)
+            only_child[parent] = np.arange(len(parent))
+            level.expansion[single] = child.expansion[only_child[single]]
+
+    def _cluster_id(self, zoom: int, idx: int) -> int:
+        # Identificativo stabile per versione del layer: (indice, zoom) in un unico intero
+        return (int(idx) << 5) | zoom
+
+    def clusters(self, bbox: Bounds, zoom: float) -> bytes:
+        """
+        Cluster e punti visibili nella bbox al livello di zoom indicato.
+        I cluster sono Point con proprietà cluster/cluster_id/point_count/expansion_zoom;
+        i cluster di un solo punto e tutti i punti oltre max_zoom sono le feature originali.
+        @:param bbox: (minx, miny, maxx, maxy) in lon/lat
+        @:param zoom: Livello di zoom della mappa
+        @:return: FeatureCollection serializzata
+        """
+        zoom = int(math.floor(max(0.0, zoom)))
+        parts = []
+        if zoom > self.max_zoom or not len(self.lon):
+            parts = [self.fragments[i] for i in np.sort(self.points_tree.query(bbox))]
+        else:
+            level = self.levels[zoom]
+            for idx in np.sort(level.tree.query(bbox)):
+                count = int(level.counts[idx])
+                if count == 1:
+                    parts.append(self.fragments[level.first[idx]])
+                    continue
+                parts.append(json.dumps({
+                    'type': 'Feature',
+                    'id': self._cluster_id(zoom, idx),
+                    'properties': {
+                        'cluster': True,
+                        'cluster_id': self._cluster_id(zoom, idx),
+                        'point_count': count,
+                        'point_count_abbreviated': _abbrevia(count),
+                        'expansion_zoom': int(level.expansion[idx]),
+                    },
+                    'geometry': {'type': 'Point', 'coordinates': [round(float(level.lon[idx]), 6),
+                                                                  round(float(level.lat[idx]), 6)]},
+                }, separators=(',', ':')))
+        return f'{{"type":"FeatureCollection","features":[{",".join(parts)}]}}'.encode('utf-8')
@@ -2,15 +2,27 @@ import pandas as pd
 import numpy as np
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+import sys
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+
+# Avviato come script (python scripts/posizione_utente.py) il pacchetto scripts va cercato nella
+# cartella del progetto
+BASE_DIR = Path(__file__).resolve().parents[1]
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.address_normalizer import NAMESPACE_NEAREST, canonical_key, parse_address
+from scripts.dataset_store import DATASETS
+from scripts.offline_geocoder import OfflineGeocoder
+from scripts.spatial_index import SphericalKDTree
 
 # In questo snippet di codice, è stata implementata la logica
 # per trovare il rifugio per animali. Di seguito sono elencati i passaggi principali:
 #   1. Caricare il database dei rifugi dal file CSV.
 #   2. Geocodificare l'indirizzo fornito dall'utente, con gli opportuni controlli.
-#   3. Calcolare la distanza tra l'utente e ciascun rifugio.
-#   4. Restituire il rifugio più vicino.
+#   3. Interrogare l'indice spaziale dei rifugi (costruito una sola volta al caricamento).
+#   4. Restituire il rifugio più vicino (ed eventualmente le alternative).
 
 # ==========================================
 # 1. CARICAMENTO DATI E INIZIALIZZAZIONE SERVIZI
@@ -18,9 +30,18 @@ from typing import Optional, Tuple
 
 # Inizializzazione variabili globali.
 # rifugi_db conterrà il DataFrame dei rifugi.
+# rifugi_index è l'indice spaziale costruito sulle coordinate dei rifugi.
 # geolocator è l'istanza condivisa di Nominatim.
+# offline_geocoder è il geocoder locale (dataset delle strade), consultato prima di Nominatim.
+# geocode_cache è la cache dei risultati (GeocodeCache del server), con chiavi canoniche.
 rifugi_db: Optional[pd.DataFrame] = None
+rifugi_index: Optional[SphericalKDTree] = None
 _geolocator: Optional[Nominatim] = None
+_offline_geocoder: Optional[OfflineGeocoder] = None
+_geocode_cache = None
+
+# Colonne necessarie nel dataset dei rifugi
+REQUIRED_COLS = {"Latitude", "Longitude", "Shelter_Name", "Address", "City"}
 
 
 # Funzione per caricare il database dei rifugi
@@ -32,7 +53,7 @@ def load_rifugi_db(path: Optional[str] = None) -> pd.DataFrame:
     @:return: DataFrame pandas con i dati dei rifugi
     """
 
-    global rifugi_db
+    global rifugi_db, rifugi_index
     # Viene caricato il dataset. Se non specificato, si assume il percorso di default.
     if path is None:
         base = Path(__file__).resolve().parents[1]
@@ -44,11 +65,33 @@ def load_rifugi_db(path: Optional[str] = None) -> pd.DataFrame:
     if not default_path.exists():
         raise FileNotFoundError(f"Impossibile trovare il file dei rifugi: {default_path}")
 
-    # Caricamento del DataFrame e assegnazione alla variabile globale
-    rifugi_db = pd.read_csv(default_path)
+    # Caricamento del DataFrame (dalla copia colonnare del CSV) e assegnazione alla variabile globale.
+    # L'indice spaziale viene costruito una sola volta, qui, e riusato da ogni richiesta.
+    rifugi_db = DATASETS.read(default_path)
+    rifugi_index = build_rifugi_index(rifugi_db)
     return rifugi_db
 
 
+# Funzione per costruire l'indice spaziale dei rifugi
+def build_rifugi_index(rifugi_df: pd.DataFrame) -> SphericalKDTree:
+    """
+    Costruisce il KD-tree sulle coordinate dei rifugi. Le righe senza coordinate valide
+    vengono escluse: l'indice restituisce sempre la posizione della riga nel DataFrame originale.
+    @:param rifugi_df: DataFrame dei rifugi
+    @:return: Indice spaziale dei rifugi
+    """
+    if not REQUIRED_COLS.issubset(set(rifugi_df.columns)):
+        missing = REQUIRED_COLS - set(rifugi_df.columns)
+        raise KeyError(f"Colonne mancanti nel dataset dei rifugi: {missing}")
+
+    lat = pd.to_numeric(rifugi_df['Latitude'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(rifugi_df['Longitude'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+
+    # Gli identificativi dell'indice sono le posizioni delle righe nel DataFrame
+    return SphericalKDTree(lat[valid], lon[valid], ids=np.flatnonzero(valid))
+
+
 # Funzione per ottenere l'istanza condivisa di Nominatim
 def get_geolocator() -> Nominatim:
     """
@@ -63,6 +106,27 @@ def get_geolocator() -> Nominatim:
     return _geolocator
 
 
+# Funzione per impostare il geocoder locale
+def set_offline_geocoder(geocoder: Optional[OfflineGeocoder]):
+    """
+    Registra il geocoder locale usato da calcola_coordinate prima di ricorrere a Nominatim.
+    Il server lo costruisce una sola volta a partire dai nomi delle strade già caricati.
+    @:param geocoder: Istanza di OfflineGeocoder (None per disattivarlo)
+    """
+    global _offline_geocoder
+    _offline_geocoder = geocoder
+
+
+def set_geocode_cache(cache):
+    """
+    Registra la cache dei risultati di geocoding usata da calcola_coordinate (la stessa del server,
+    con le chiavi canoniche di canonical_key() nel namespace NAMESPACE_NEAREST).
+    @:param cache: Istanza di GeocodeCache (None per disattivarla)
+    """
+    global _geocode_cache
+    _geocode_cache = cache
+
+
 # ==========================================
 # 2. GEOCODING & CALCOLI MATEMATICI
 # ==========================================
@@ -98,6 +162,25 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return R * c
 
 
+# Funzione per risolvere un indirizzo senza chiamate di rete
+def coordinate_note(indirizzo_input: str) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    """
+    Risolve l'indirizzo solo con il geocoder locale e la cache, senza interrogare Nominatim.
+    @:param indirizzo_input: Indirizzo testuale
+    @:return: Tuple (latitudine, longitudine), (None, None) se in cache come non trovato,
+              None se l'indirizzo richiede una chiamata al servizio di geocoding
+    """
+    if _offline_geocoder is not None:
+        trovato = _offline_geocoder.geocode(indirizzo_input)
+        if trovato is not None:
+            return trovato['lat'], trovato['lon']
+    if _geocode_cache is not None:
+        trovato = _geocode_cache.get(canonical_key(indirizzo_input, NAMESPACE_NEAREST))
+        if trovato is not None:
+            return trovato.get('lat'), trovato.get('lon')
+    return None
+
+
 # Funzione per calcolare le coordinate geografiche da un indirizzo testuale
 def calcola_coordinate(indirizzo_input: str, geolocator: Optional[Nominatim] = None) -> Tuple[Optional[float], Optional[float]]:
     """
@@ -105,22 +188,32 @@ def calcola_coordinate(indirizzo_input: str, geolocator: Optional[Nominatim] = N
     L'input è fornito dall'utente tramite l'interfaccia web, ed essendo quest'ultimo poco
     esperto, l'indirizzo potrebbe essere incompleto o ambiguo. La funzione tenta di gestire questi casi
     perfezionando l'input prima di inviarlo al servizio di geocoding.
+    Se è registrato un geocoder locale, questo viene consultato per primo.
     @:param indirizzo_input: Indirizzo testuale fornito dall'utente
     @:param geolocator: opzionale geolocator (utile per i test)
     @:return: Tuple (latitudine, longitudine) o (None, None) se non trovato
     """
 
+    # --- GEOCODER LOCALE E CACHE ---
+    # Se la strada è presente nel dataset arricchito o l'indirizzo è in cache, si evita la chiamata
+    # di rete. Indirizzi equivalenti ("4000 E Anaheim St" / "4000 East Anaheim Street") hanno la stessa
+    # chiave; il namespace separa questi risultati (limitati a LA County) da quelli di /api/geocode-street
+    trovato = coordinate_note(indirizzo_input)
+    if trovato is not None:
+        return trovato
+    chiave = canonical_key(indirizzo_input, NAMESPACE_NEAREST)
+
     if geolocator is None:
         geolocator = get_geolocator()
 
     # --- GESTIONE AMBIGUITÀ ---
     suffisso_default = ", Los Angeles County, CA, USA"
 
-    # Controlla se l'indirizzo contiene già "CA" o "USA" (case insensitive)
-    indirizzo_input_upper = indirizzo_input.upper()
-
-    # Se manca, aggiunge il suffisso di default per Los Angeles County
-    if "CA" not in indirizzo_input_upper and "USA" not in indirizzo_input_upper:
+    # Se l'indirizzo non indica lo stato né il paese, aggiunge il suffisso di default per
+    # Los Angeles County (lo stato è riconosciuto come parte dell'indirizzo, non come sottostringa:
+    # "Cabrillo" non contiene lo stato "CA")
+    indirizzo = parse_address(indirizzo_input)
+    if indirizzo.state is None and indirizzo.country is None:
         indirizzo_da_cercare = f"{indirizzo_input}{suffisso_default}"
 
     # Altrimenti, usa l'indirizzo così com'è
@@ -135,34 +228,122 @@ def calcola_coordinate(indirizzo_input: str, geolocator: Optional[Nominatim] = N
             timeout=10
         )
 
-        # Se la localizzazione è trovata, restituisce latitudine e longitudine, altrimenti None
-        if location:
-            return location.latitude, location.longitude
-        else:
-            return None, None
-
-    # Gestione errori di connessione al servizio di geocoding
+    # Gestione errori di connessione al servizio di geocoding (non memorizzati in cache)
     except (GeocoderTimedOut, GeocoderServiceError) as e:
         print(f" Errore di connessione al servizio mappe: {e}")
         return None, None
 
+    # Se la localizzazione è trovata, restituisce latitudine e longitudine, altrimenti None
+    lat, lon = (location.latitude, location.longitude) if location else (None, None)
+    if _geocode_cache is not None:
+        _geocode_cache.set(chiave, {'lat': lat, 'lon': lon, 'postcode': None, 'display': indirizzo_input})
+    return lat, lon
+
 
 # ==========================================
 # 3. LOGICA APPLICATIVA
 # ==========================================
 
+# Funzione per ottenere l'indice spaziale da usare
+def _get_index(rifugi_df: Optional[pd.DataFrame] = None) -> Tuple[pd.DataFrame, SphericalKDTree]:
+    """
+    Restituisce la coppia (DataFrame, indice) su cui effettuare la ricerca.
+    Se non viene fornito un DataFrame usa il database globale e il suo indice precostruito,
+    altrimenti costruisce al volo l'indice per il DataFrame fornito (utile per i test).
+    """
+    if rifugi_df is None:
+        if rifugi_db is None or rifugi_index is None:
+            raise ValueError("Database dei rifugi non caricato. Chiama load_rifugi_db() prima di usare questa funzione.")
+        return rifugi_db, rifugi_index
+    return rifugi_df, build_rifugi_index(rifugi_df)
+
+
+# Funzione per convertire una riga del dataset nel formato restituito all'interfaccia
+def _formatta_rifugio(rifugio, distanza_km: float) -> dict:
+    """
+    Converte una riga del DataFrame dei rifugi in un dizionario con tipi nativi Python.
+    @:param rifugio: Riga (Series) del DataFrame dei rifugi
+    @:param distanza_km: Distanza dell'utente dal rifugio
+    @:return: Dizionario con i dati del rifugio
+    """
+    return {
+        "nome": str(rifugio['Shelter_Name']),
+        "indirizzo": f"{rifugio['Address']}, {rifugio['City']}",
+        "distanza_km": float(round(distanza_km, 2)),
+        "posizione_rifugio": (float(rifugio['Latitude']), float(rifugio['Longitude']))
+    }
+
+
+# Funzione per trovare i k rifugi più vicini a delle coordinate
+def rifugi_vicini(lat: float, lon: float, k: int = 1, rifugi_df: Optional[pd.DataFrame] = None) -> List[dict]:
+    """
+    Restituisce i k rifugi più vicini alle coordinate indicate, ordinati per distanza.
+    @:param lat: Latitudine del punto
+    @:param lon: Longitudine del punto
+    @:param k: Numero di rifugi richiesti
+    @:param rifugi_df: Opzionale DataFrame dei rifugi
+    @:return: Lista di dizionari con i dati dei rifugi
+    """
+    df, index = _get_index(rifugi_df)
+    distanze, pos = index.query(lat, lon, k=k)
+    righe = df.iloc[pos]
+    return [_formatta_rifugio(r, d) for (_, r), d in zip(righe.iterrows(), distanze)]
+
+
+# Funzione per trovare tutti i rifugi entro un raggio
+def rifugi_entro_raggio(lat: float, lon: float, raggio_km: float, rifugi_df: Optional[pd.DataFrame] = None) -> List[dict]:
+    """
+    Restituisce tutti i rifugi entro raggio_km dalle coordinate indicate, ordinati per distanza.
+    @:param lat: Latitudine del punto
+    @:param lon: Longitudine del punto
+    @:param raggio_km: Raggio di ricerca in chilometri
+    @:param rifugi_df: Opzionale DataFrame dei rifugi
+    @:return: Lista di dizionari con i dati dei rifugi
+    """
+    df, index = _get_index(rifugi_df)
+    distanze, pos = index.query_radius(lat, lon, raggio_km)
+    righe = df.iloc[pos]
+    return [_formatta_rifugio(r, d) for (_, r), d in zip(righe.iterrows(), distanze)]
+
+
+# Funzione per calcolare in blocco il rifugio più vicino a più punti
+def rifugi_piu_vicini_batch(lat, lon, rifugi_df: Optional[pd.DataFrame] = None) -> List[Optional[dict]]:
+    """
+    Calcola il rifugio più vicino per un insieme di punti in modo vettoriale, con
+    SphericalKDTree.query_batch (che limita da sé la dimensione della matrice punti x rifugi).
+    @:param lat: Sequenza di latitudini dei punti (NaN per i punti non geocodificati)
+    @:param lon: Sequenza di longitudini dei punti
+    @:param rifugi_df: Opzionale DataFrame dei rifugi
+    @:return: Lista (una voce per punto) di dizionari con i dati del rifugio, None se il punto non è valido
+    """
+    df, index = _get_index(rifugi_df)
+    lat = np.asarray(lat, dtype=float).ravel()
+    lon = np.asarray(lon, dtype=float).ravel()
+    risultati: List[Optional[dict]] = [None] * len(lat)
+    if len(index) == 0:
+        return risultati
+
+    distanze, ids = index.query_batch(lat, lon, k=1)
+    validi = np.flatnonzero(ids[:, 0] >= 0)
+    righe = df.iloc[ids[validi, 0]].to_dict('records')
+    for i, rifugio, d in zip(validi, righe, distanze[validi, 0]):
+        risultati[i] = _formatta_rifugio(rifugio, float(d))
+    return risultati
+
+
 # Funzione principale per trovare il rifugio più vicino
-def trova_rifugio_piu_vicino(indirizzo_utente: str, rifugi_df: Optional[pd.DataFrame] = None, geolocator: Optional[Nominatim] = None) -> dict:
+def trova_rifugio_piu_vicino(indirizzo_utente: str, rifugi_df: Optional[pd.DataFrame] = None, geolocator: Optional[Nominatim] = None, k: int = 1) -> dict:
     """
     Funzione principale chiamata dall'interfaccia utente.
     1. Geocodifica l'indirizzo.
-    2. Calcola le distanze.
-    3. Restituisce il rifugio migliore.
+    2. Interroga l'indice spaziale dei rifugi.
+    3. Restituisce il rifugio migliore (e, se richieste, le alternative).
 
     Accetta opzionalmente un DataFrame dei rifugi (utile per test e per evitare variabili globali).
     @:param indirizzo_utente: Indirizzo testuale fornito dall'utente
     @:param rifugi_df: Opzionale DataFrame dei rifugi
     @:param geolocator: Opzionale geolocator (utile per i test
+    @:param k: Numero di rifugi da restituire (il primo è il più vicino, gli altri sono alternative)
     @:return: Dizionario con i dati del rifugio più vicino o messaggio di errore
     """
 
@@ -176,49 +357,36 @@ def trova_rifugio_piu_vicino(indirizzo_utente: str, rifugi_df: Optional[pd.DataF
             "messaggio": "Indirizzo non trovato. Prova ad inserire anche la Città o il CAP."
         }
 
-    # Ricerca del DataFrame da usare per il calcolo, se non fornito usa la variabile globale rifugi_db
-    if rifugi_df is None:
-        if rifugi_db is None:
-            raise ValueError("Database dei rifugi non caricato. Chiama load_rifugi_db() prima di usare questa funzione.")
-        df_calcolo = rifugi_db.copy()
-    else:
-        df_calcolo = rifugi_df.copy()
-
     print(f"📍 Posizione Utente identificata: {lat_utente}, {lon_utente}")
+    return trova_rifugio_da_coordinate(lat_utente, lon_utente, rifugi_df=rifugi_df, k=k)
 
-    # Check per assicurarsi che le colonne necessarie siano presenti
-    required_cols = {"Latitude", "Longitude", "Shelter_Name", "Address", "City"}
-    if not required_cols.issubset(set(df_calcolo.columns)):
-        missing = required_cols - set(df_calcolo.columns)
-        raise KeyError(f"Colonne mancanti nel dataset dei rifugi: {missing}")
-
-    # Calcolo delle distanze tra l'utente e tutti i rifugi
-    df_calcolo['distanza_km'] = haversine_distance(
-        lat_utente, lon_utente,
-        df_calcolo['Latitude'], df_calcolo['Longitude']
-    )
 
-    # Trovare il rifugio più vicino, ordinando per distanza
-    rifugio_top = df_calcolo.sort_values('distanza_km').iloc[0]
-
-    # Conversione dei dati in tipi nativi Python per l'output
-    lat_rif = float(rifugio_top['Latitude'])
-    lon_rif = float(rifugio_top['Longitude'])
-    lat_u = float(lat_utente)
-    lon_u = float(lon_utente)
-    distanza = float(round(rifugio_top['distanza_km'], 2))
+# Funzione per trovare il rifugio più vicino a coordinate già note (es. un punto scelto sulla mappa)
+def trova_rifugio_da_coordinate(lat_utente: float, lon_utente: float, rifugi_df: Optional[pd.DataFrame] = None, k: int = 1) -> dict:
+    """
+    Come trova_rifugio_piu_vicino, ma senza geocoding: la posizione dell'utente è già nota.
+    @:param lat_utente: Latitudine dell'utente
+    @:param lon_utente: Longitudine dell'utente
+    @:param rifugi_df: Opzionale DataFrame dei rifugi
+    @:param k: Numero di rifugi da restituire (il primo è il più vicino, gli altri sono alternative)
+    @:return: Dizionario con i dati del rifugio più vicino o messaggio di errore
+    """
+    # Ricerca dei k rifugi più vicini tramite l'indice spaziale
+    vicini = rifugi_vicini(lat_utente, lon_utente, k=max(1, int(k)), rifugi_df=rifugi_df)
+    if not vicini:
+        return {
+            "successo": False,
+            "messaggio": "Nessun rifugio disponibile nel database."
+        }
 
     # Costruzione del dizionario di risultato, che sarà restituito all'interfaccia utente in formato JSON
     risultato = {
         "successo": True,
-        "dati_rifugio": {
-            "nome": str(rifugio_top['Shelter_Name']),
-            "indirizzo": f"{rifugio_top['Address']}, {rifugio_top['City']}",
-            "distanza_km": distanza,
-            "posizione_rifugio": (lat_rif, lon_rif)
-        },
-        "coordinate_utente": (lat_u, lon_u)
+        "dati_rifugio": vicini[0],
+        "coordinate_utente": (float(lat_utente), float(lon_utente))
     }
+    if k > 1:
+        risultato["alternative"] = vicini[1:]
     return risultato
 
 
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+
+# Brotli è opzionale: se il pacchetto non è installato si servono solo gzip e identity
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Contenuti serviti in forma precompressa con ETag forte.
+# Le varianti compresse vengono calcolate una sola volta (con precompute() o alla prima
+# richiesta che le accetta) e riutilizzate finché il contenuto non cambia.
+
+# Codifiche supportate in ordine di preferenza
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+_ETAG_SUFFIX = {'identity': '', 'gzip': '-gz', 'br': '-br'}
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """
+    Interpreta l'header Accept-Encoding.
+    @:param header: Valore dell'header (es. "gzip, deflate, br;q=0.9")
+    @:return: dict codifica -> qualità
+    """
+    accepted = {}
+    for part in (header or '').split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header: Optional[str]) -> str:
+    """
+    Sceglie la codifica migliore tra quelle disponibili e accettate dal client.
+    @:param header: Valore dell'header Accept-Encoding
+    @:return: 'br', 'gzip' o 'identity'
+    """
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get('*', 0.0)
+    best, best_q = 'identity', 0.0
+    for coding in ENCODINGS:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def etag_matches(if_none_match: Optional[str], etags) -> bool:
+    """
+    Verifica se l'header If-None-Match corrisponde a uno degli ETag indicati.
+    Il confronto è debole (come richiesto per If-None-Match): il prefisso W/ viene ignorato.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return any(tag in candidates for tag in etags)
+
+
+class Precompressed:
+    """
+    Contenuto binario con varianti gzip/brotli calcolate su richiesta e ETag forte per variante.
+    @:param data: Contenuto non compresso
+    @:param gzip_level: Livello di compressione gzip
+    @:param brotli_quality: Qualità di compressione brotli
+    """
+
+    def __init__(self, data: bytes, gzip_level: int = 9, brotli_quality: int = 11):
+        self.data = data
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        digest = hashlib.sha256(data).hexdigest()[:20]
+        self.etags = {coding: f'"{digest}{suffix}"' for coding, suffix in _ETAG_SUFFIX.items()}
+        self._variants: Dict[str, bytes] = {'identity': data}
+        self._lock = threading.Lock()
+
+    def variant(self, coding: str) -> bytes:
+        """Restituisce il contenuto nella codifica richiesta, comprimendolo solo la prima volta."""
+        body = self._variants.get(coding)
+        if body is not None:
+            return body
+        with self._lock:
+            body = self._variants.get(coding)
+            if body is None:
+                if coding == 'gzip':
+                    # mtime=0 rende l'output deterministico (stesso contenuto -> stessi byte)
+                    body = gzip.compress(self.data, compresslevel=self.gzip_level, mtime=0)
+                elif coding == 'br' and brotli is not None:
+                    body = brotli.compress(self.data, quality=self.brotli_quality)
+                else:
+                    raise ValueError(f"Codifica non supportata: {coding}")
+                self._variants[coding] = body
+        return body
+
+    def precompute(self) -> 'Precompressed':
+        """Calcola subito tutte le varianti compresse disponibili."""
+        for coding in ENCODINGS:
+            self.variant(coding)
+        return self
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Tuple[str, bytes, str]:
+        """
+        Sceglie la variante per il client.
+        @:param accept_encoding: Valore dell'header Accept-Encoding
+        @:return: Tuple (codifica, contenuto, ETag)
+        """
+        coding = choose_encoding(accept_encoding)
+        body = self.variant(coding)
+        # se la compressione non riduce la dimensione si invia il contenuto originale
+        if coding != 'identity' and len(body) >= len(self.data):
+            coding, body = 'identity', self.data
+        return coding, body, self.etags[coding]
@@ -0,0 +1,187 @@
+import json
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+import pandas as pd
+
+from scripts.precompressed import Precompressed
+
+# Aggregazione per mese del layer animali_randagi, calcolata una volta per versione del layer.
+# Replica lato server la logica che il frontend (loadRandagiData in app.js) applicava ad ogni
+# caricamento: lettura delle proprietà con nomi alternativi (getVal), mese UTC della data di
+# ingresso, identificativo composto nome-specie-data-rifugio e deduplicazione.
+# Per ogni mese vengono precalcolati i conteggi (per specie, rifugio e sesso) e le feature
+# deduplicate, servite in forma precompressa una fetta alla volta.
+
+MESE_SCONOSCIUTO = 'Unknown'
+
+# Stessi nomi alternativi delle proprietà usati in app.js
+NAME_KEYS = ('Animal Nam', 'Animal Name', 'Animal_Name', 'name', 'Name')
+DATE_KEYS = ('Intake Dat', 'Intake Date', 'intake_date', 'date_found', 'Date')
+TYPE_KEYS = ('Animal Typ', 'Animal Type', 'species', 'type')
+SHELTER_KEYS = ('Shelter_Na', 'Shelter_Name', 'Shelter Name', 'shelter', 'Location', 'Kennel',
+                'Jurisdicti', 'Jurisdiction')
+SEX_KEYS = ('Sex', 'Gender', 'sesso')
+
+# Specie riconosciute dal frontend (getAnimalInfo), nell'ordine in cui vengono verificate
+_SPECIE = (('dog', ('dog', 'cane')), ('cat', ('cat', 'gatto')), ('bird', ('bird', 'uccello')),
+           ('rabbit', ('rabbit', 'coniglio')))
+_NON_ALFANUMERICI = re.compile(r'[^a-z0-9]')
+
+
+def get_val(props: Optional[dict], keys: Sequence[str]):
+    """
+    Legge la prima proprietà disponibile tra i nomi indicati, come getVal() in app.js:
+    nome esatto, poi senza distinzione di maiuscole, poi ignorando i caratteri non alfanumerici.
+    """
+    if not props:
+        return None
+    for key in keys:
+        if props.get(key) is not None:
+            return props[key]
+        lower = key.lower()
+        for k, v in props.items():
+            if k.lower() == lower and v:
+                return v
+        clean = _NON_ALFANUMERICI.sub('', lower)
+        for k, v in props.items():
+            if _NON_ALFANUMERICI.sub('', k.lower()) == clean and v:
+                return v
+    return None
+
+
+def specie_key(props: Optional[dict]) -> str:
+    """Categoria della specie ('dog', 'cat', 'bird', 'rabbit', 'other') come getAnimalInfo()."""
+    tipo = str(get_val(props, TYPE_KEYS) or 'Other').lower()
+    for key, parole in _SPECIE:
+        if any(p in tipo for p in parole):
+            return key
+    return 'other'
+
+
+def sesso_key(props: Optional[dict]) -> str:
+    """Sesso normalizzato ('Male', 'Female', 'Unknown') come updateChartFromFeatures()."""
+    s = str(get_val(props, SEX_KEYS) or '').strip().lower()
+    if s.startswith('m'):
+        return 'Male'
+    if s.startswith('f'):
+        return 'Female'
+    return 'Unknown'
+
+
+def _parse_dates(values: List) -> pd.Series:
+    """Converte le date grezze in timestamp UTC (NaT se non interpretabili); i numeri sono epoch in ms."""
+    raw = pd.Series(values, dtype=object)
+    # Ogni valore distinto viene interpretato una sola volta
+    codes, uniques = pd.factorize(raw)
+    parsed = []
+    for value in uniques:
+        try:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                parsed.append(pd.Timestamp(int(value), unit='ms', tz='UTC'))
+            else:
+                ts = pd.Timestamp(str(value))
+                parsed.append(ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC'))
+        except (ValueError, TypeError, OverflowError):
+            parsed.append(pd.NaT)
+    lookup = pd.Series(parsed + [pd.NaT], dtype='datetime64[ns, UTC]')
+    # factorize usa -1 per i valori mancanti: puntano al NaT in fondo
+    codes[codes < 0] = len(uniques)
+    return lookup.iloc[codes].reset_index(drop=True)
+
+
+class RandagiTimeline:
+    """
+    Serie mensile del layer animali_randagi.
+    @:param collection: FeatureCollection GeoJSON del layer
+    """
+
+    def __init__(self, collection: dict):
+        features = collection.get('features') or []
+        props = [f.get('properties') or {} for f in features]
+        dates = _parse_dates([get_val(p, DATE_KEYS) for p in props])
+
+        mesi = dates.dt.strftime('%Y-%m').where(dates.notna(), MESE_SCONOSCIUTO).tolist()
+        giorni = dates.dt.strftime('%Y-%m-%d').where(dates.notna(), 'nodate').tolist()
+
+        self._fragments: List[str] = []
+        self._per_mese: Dict[str, List[int]] = {}
+        self._nuovi: Dict[str, List[int]] = {}
+        self._riepilogo: Dict[str, dict] = {}
+        ids = []
+        for i, (f, p) in enumerate(zip(features, props)):
+            nome = get_val(p, NAME_KEYS) or 'unknown'
+            specie = get_val(p, TYPE_KEYS) or 'unknown'
+            rifugio = get_val(p, SHELTER_KEYS) or 'unknown'
+            safe_id = _NON_ALFANUMERICI.sub('', f"{nome}-{specie}-{giorni[i]}-{rifugio}".lower())
+            ids.append(safe_id)
+            # L'identificativo viaggia nel membro "id" della feature
+            self._fragments.append(json.dumps(dict(f, id=safe_id), ensure_ascii=False, separators=(',', ':')))
+
+        # Mesi in ordine cronologico, con le date sconosciute in fondo
+        self.mesi = sorted(set(mesi) - {MESE_SCONOSCIUTO})
+        if MESE_SCONOSCIUTO in mesi:
+            self.mesi.append(MESE_SCONOSCIUTO)
+
+        visti_mese: Dict[str, set] = {m: set() for m in self.mesi}
+        totali = Counter(mesi)
+        for i, mese in enumerate(mesi):
+            if ids[i] in visti_mese[mese]:
+                continue
+            visti_mese[mese].add(ids[i])
+            self._per_mese.setdefault(mese, []).append(i)
+
+        # Animali comparsi per la prima volta in ciascun mese (per l'animazione cumulativa)
+        visti = set()
+        for mese in self.mesi:
+            nuovi = [i for i in self._per_mese[mese] if ids[i] not in visti]
+            visti.update(ids[i] for i in nuovi)
+            self._nuovi[mese] = nuovi
+
+        for mese in self.mesi:
+            unici = self._per_mese[mese]
+            self._riepilogo[mese] = {
+                'mese': mese,
+                'totale': totali[mese],
+                'unici': len(unici),
+                'nuovi': len(self._nuovi[mese]),
+                'specie': dict(Counter(specie_key(props[i]) for i in unici)),
+                'rifugi': dict(Counter(str(get_val(props[i], SHELTER_KEYS) or 'unknown') for i in unici)),
+                'sesso': dict(Counter(sesso_key(props[i]) for i in unici)),
+            }
+
+        self._payloads: Dict[tuple, Precompressed] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._fragments)
+
+    def riepilogo(self) -> List[dict]:
+        """Conteggi per mese, in ordine cronologico."""
+        return [self._riepilogo[m] for m in self.mesi]
+
+    def feature_indices(self, mese: str, solo_nuovi: bool = False) -> Optional[List[int]]:
+        """
+        Indici delle feature deduplicate di un mese.
+        @:param mese: Chiave 'YYYY-MM' o 'Unknown'
+        @:param solo_nuovi: Se True, solo gli animali non comparsi nei mesi precedenti
+        @:return: Lista di indici o None se il mese non esiste
+        """
+        source = self._nuovi if solo_nuovi else self._per_mese
+        return source.get(mese)
+
+    def payload(self, mese: str, solo_nuovi: bool = False) -> Optional[Precompressed]:
+        """FeatureCollection del mese in forma precompressa (calcolata alla prima richiesta)."""
+        key = (mese, solo_nuovi)
+        found = self._payloads.get(key)
+        if found is not None:
+            return found
+        indices = self.feature_indices(mese, solo_nuovi)
+        if indices is None:
+            return None
+        body = ','.join(self._fragments[i] for i in indices)
+        data = f'{{"type":"FeatureCollection","features":[{body}]}}'.encode('utf-8')
+        with self._lock:
+            return self._payloads.setdefault(key, Precompressed(data).precompute())
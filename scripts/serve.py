@@ -0,0 +1,204 @@
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# Avvio in produzione: server prefork con i dati caricati una sola volta.
+# Il processo principale crea l'app con create_app() (dataset, indici e strutture derivate dei layer),
+# apre il socket in ascolto e solo dopo crea i worker con fork(): i worker ereditano i dati già in
+# memoria, condivisi copy-on-write con il processo principale, e accettano le connessioni sullo
+# stesso socket. Prima del fork gli oggetti vengono spostati nella generazione permanente del garbage
+# collector (gc.freeze), così le raccolte nei worker non toccano le pagine condivise.
+# Ogni worker serve le richieste con un thread per connessione (werkzeug). Il processo principale
+# sorveglia i worker, ricrea quelli terminati e inoltra SIGTERM/SIGINT per l'arresto.
+# Quando tutti i worker sono partiti il server segnala di essere pronto: messaggio su stdout,
+# file READY_FILE (se indicato) e notifica READY=1 a systemd (se NOTIFY_SOCKET è definito).
+# Le metriche di /metrics sono sommate su tutti i worker tramite le istantanee scritte in METRICS_DIR
+# (default: una cartella temporanea creata all'avvio e rimossa all'arresto); i totali dei worker
+# terminati vengono conservati (vedi metrics.retire_snapshot).
+# Nella stessa cartella i worker condividono il limite di chiamate a Nominatim (UPSTREAM_RATE al
+# secondo per l'intero server, vedi UpstreamClient.share_rate).
+#
+# Uso: python scripts/serve.py [--host 0.0.0.0] [--port 5000] [--workers 4]
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from werkzeug.serving import make_server
+
+from scripts import metrics
+from scripts.server import UPSTREAM, create_app
+
+# File (in METRICS_DIR) del limite di chiamate a Nominatim condiviso dai worker
+UPSTREAM_RATE_FILE = 'upstream-rate'
+
+
+def sd_notify(message: str) -> bool:
+    """
+    Invia una notifica di stato a systemd (Type=notify), se NOTIFY_SOCKET è definito.
+    @:return: True se la notifica è stata inviata
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Socket nello spazio dei nomi astratto
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode('utf-8'), address)
+        return True
+    except OSError as e:
+        print(f"Attenzione: notifica a systemd non riuscita ({e})")
+        return False
+
+
+def _run_worker(app, listener: socket.socket, host: str, port: int):
+    """Corpo di un worker: serve le richieste sul socket ereditato fino a SIGTERM."""
+    server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+
+    def _stop(signum, frame):
+        # shutdown() attende la fine di serve_forever: va chiamato da un altro thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever()
+    # Ultima istantanea delle metriche, sommata ai totali dal processo principale (vedi retire_snapshot)
+    metrics.REGISTRY.flush()
+
+
+class PreforkServer:
+    """
+    Processo principale: crea e sorveglia i worker.
+    @:param app: Applicazione WSGI già inizializzata
+    @:param host: Indirizzo di ascolto
+    @:param port: Porta di ascolto
+    @:param workers: Numero di processi worker
+    @:param ready_file: File creato quando il server è pronto (rimosso all'arresto)
+    """
+
+    def __init__(self, app, host: str, port: int, workers: int, ready_file: str = None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.ready_file = Path(ready_file) if ready_file else None
+        self.children = set()
+        self.stopping = False
+        self.listener = None
+        self.metrics_dir = None
+        self._own_metrics_dir = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(self.app, self.listener, self.host, self.port)
+            except Exception as e:
+                print(f"Worker {os.getpid()} terminato con errore: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        self.children.add(pid)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.discard(pid)
+
+    def _prepare_metrics_dir(self):
+        # Va definita prima del fork: ogni worker vi scrive le proprie metriche (vedi scripts/metrics.py)
+        directory = os.environ.get('METRICS_DIR')
+        if not directory:
+            directory = tempfile.mkdtemp(prefix='metrics-')
+            self._own_metrics_dir = True
+            os.environ['METRICS_DIR'] = directory
+        self.metrics_dir = Path(directory)
+        self.metrics_dir.mkdir(parents=True, exist_ok=True)
+        # Istantanee di un'esecuzione precedente
+        for path in self.metrics_dir.glob('*.json'):
+            path.unlink()
+
+    def _signal_ready(self):
+        print(f"Server pronto su http://{self.host}:{self.port} ({self.workers} worker, pid {os.getpid()})",
+              flush=True)
+        if self.ready_file is not None:
+            self.ready_file.write_text(str(os.getpid()))
+        sd_notify(f"READY=1\nMAINPID={os.getpid()}")
+
+    def run(self):
+        self.listener = socket.create_server((self.host, self.port), backlog=1024)
+        self.listener.set_inheritable(True)
+
+        # Gli oggetti creati finora (i dati) non vengono più visitati dal garbage collector
+        gc.collect()
+        gc.freeze()
+
+        self._prepare_metrics_dir()
+        # UPSTREAM_RATE vale per l'intero server, non per ogni worker
+        if not UPSTREAM.share_rate(self.metrics_dir / UPSTREAM_RATE_FILE):
+            print("Attenzione: limite di chiamate a Nominatim non condiviso tra i worker", file=sys.stderr)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.workers):
+            self._spawn()
+        self._signal_ready()
+
+        try:
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                except InterruptedError:
+                    continue
+                self.children.discard(pid)
+                # I totali del worker terminato restano nelle metriche esposte
+                try:
+                    metrics.retire_snapshot(self.metrics_dir, pid)
+                except OSError as e:
+                    print(f"Attenzione: metriche del worker {pid} non conservate ({e})", file=sys.stderr)
+                if not self.stopping:
+                    print(f"Worker {pid} terminato (stato {status}), ne avvio un altro", file=sys.stderr)
+                    # Evita un ciclo di riavvii troppo rapido se il worker fallisce subito
+                    time.sleep(1)
+                    if not self.stopping:
+                        self._spawn()
+        finally:
+            sd_notify("STOPPING=1")
+            self.listener.close()
+            if self.ready_file is not None and self.ready_file.exists():
+                self.ready_file.unlink()
+            if self._own_metrics_dir:
+                shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Avvia il server in produzione (prefork).")
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', os.cpu_count() or 1)),
+                        help="Numero di processi worker (default: WORKERS o numero di CPU)")
+    parser.add_argument('--ready-file', default=os.environ.get('READY_FILE'),
+                        help="File creato quando il server è pronto a ricevere richieste")
+    args = parser.parse_args()
+
+    app = create_app()
+    PreforkServer(app, args.host, args.port, args.workers, args.ready_file).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
+import hashlib
+import json
+from concurrent.futures import TimeoutError as UpstreamTimeout
 from pathlib import Path
 import sys
 import os
+import time
 
 # ==============================================================================
 # CONFIGURAZIONE AMBIENTE E PATH
@@ -11,7 +15,7 @@ if str(BASE_DIR) not in sys.path:
     sys.path.insert(0, str(BASE_DIR))
 
 try:
-    from flask import Flask, request, jsonify, send_from_directory, send_file, make_response
+    from flask import Blueprint, Flask, current_app, request, jsonify, send_file, make_response
     from flask_cors import CORS
 except Exception as e:
     raise RuntimeError("Dipendenze mancanti: installa Flask e flask_cors (vedi requirements.txt)") from e
@@ -19,228 +23,426 @@ except Exception as e:
 # Import script personalizzati (se presenti)
 try:
     from scripts.posizione_utente import trova_rifugio_piu_vicino, load_rifugi_db, get_geolocator, calcola_coordinate
+    from scripts.posizione_utente import trova_rifugio_da_coordinate
+    from scripts.posizione_utente import rifugi_piu_vicini_batch, coordinate_note
+    from scripts.posizione_utente import set_offline_geocoder, set_geocode_cache, _formatta_rifugio
 except ImportError:
     print("Warning: scripts.posizione_utente non trovato. Alcune funzioni saranno limitate.")
     trova_rifugio_piu_vicino = None
+    trova_rifugio_da_coordinate = None
     load_rifugi_db = lambda: None
     get_geolocator = lambda: None
     calcola_coordinate = None
+    rifugi_piu_vicini_batch = None
+    coordinate_note = None
+    set_offline_geocoder = None
+    set_geocode_cache = None
+    _formatta_rifugio = None
+
+# Moduli del progetto
+from scripts import metrics
+from scripts.address_normalizer import NAMESPACE_GEOCODE, NAMESPACE_NEAREST, canonical_key
+from scripts.dataset_store import DATASETS
+from scripts.feature_index import FeatureIndex, parse_bbox
+from scripts.geocode_cache import GeocodeCache
+from scripts.geojson_optimize import LOD_DIRNAME, lod_candidates, lod_path, lod_source_sha256
+from scripts.geojson_store import GeoJSONStore
+from scripts.heatmap_tiles import EMPTY_TILE, HeatmapTiles
+from scripts.offline_geocoder import OfflineGeocoder, ReverseGeocoder
+from scripts.point_cluster import PointClusterer
+from scripts.precompressed import Precompressed, etag_matches
+from scripts.randagi_timeseries import RandagiTimeline
+from scripts.service_areas import ServiceAreaStore
+from scripts.static_assets import AssetManifest, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from scripts.street_autocomplete import StreetAutocomplete
+from scripts.upstream import UpstreamBusy, UpstreamClient
 
 # ==============================================================================
 # RILEVAMENTO CARTELLA FRONT-END
 # ==============================================================================
-STATIC_ROOT = BASE_DIR / 'front-end'
-if not STATIC_ROOT.exists():
-    # Tentativi alternativi
-    for folder_name in ['frontend', 'front_end']:
-        if (BASE_DIR / folder_name).exists():
-            STATIC_ROOT = BASE_DIR / folder_name
-            break
-
-# Cerca index.html
-index_file = None
-if STATIC_ROOT.exists():
-    matches = list(STATIC_ROOT.rglob('index.html'))
-    if matches:
-        index_file = matches[0]
-
-FRONTEND_DIR = str(STATIC_ROOT) if STATIC_ROOT.exists() else None
-INDEX_FULL_PATH = str(index_file) if index_file is not None else None
-INDEX_PARENT = str(index_file.parent) if index_file is not None else None
-
-print(f"[server] Static root: {FRONTEND_DIR}")
-print(f"[server] Index file resolved: {index_file}")
-
-# Creazione App
-app = Flask(__name__, static_folder=FRONTEND_DIR if FRONTEND_DIR else None, static_url_path='')
-CORS(app)
-
-
-# Helper sicuro per inviare file
-def safe_send_from_directory(base_dir: str, filename: str):
-    if not base_dir: return None
-    filename_normalized = filename.lstrip('/\\')
-    filename_normalized = os.path.normpath(filename_normalized)
-    base = Path(base_dir)
-    target = base / filename_normalized
-    try:
-        base_res = base.resolve()
-        target_res = target.resolve()
-        target_res.relative_to(base_res)
-    except Exception:
-        return None
-    if not target_res.exists():
-        return None
-    rel = str(target_res.relative_to(base_res))
-    return send_from_directory(str(base_res), rel)
+# Valorizzati da create_app() con _resolve_frontend()
+FRONTEND_DIR = None
+INDEX_FULL_PATH = None
+INDEX_PARENT = None
+# Manifest dei file statici (in memoria, con URL con impronta): vedi scripts/static_assets.py
+STATIC_ASSETS = AssetManifest()
+
+
+def _resolve_frontend():
+    """
+    Individua la cartella del front-end e il file index.html.
+    @:return: Tuple (cartella statica, percorso di index.html, cartella di index.html), ciascuno str o None
+    """
+    static_root = BASE_DIR / 'front-end'
+    if not static_root.exists():
+        # Tentativi alternativi
+        for folder_name in ['frontend', 'front_end']:
+            if (BASE_DIR / folder_name).exists():
+                static_root = BASE_DIR / folder_name
+                break
+
+    # Cerca index.html
+    index_file = None
+    if static_root.exists():
+        matches = list(static_root.rglob('index.html'))
+        if matches:
+            index_file = matches[0]
+
+    print(f"[server] Static root: {static_root if static_root.exists() else None}")
+    print(f"[server] Index file resolved: {index_file}")
+    return (str(static_root) if static_root.exists() else None,
+            str(index_file) if index_file is not None else None,
+            str(index_file.parent) if index_file is not None else None)
+
+
+# Le route sono registrate su un blueprint: l'applicazione viene creata da create_app()
+bp = Blueprint('nook_pets', __name__)
 
 
 # ==============================================================================
 # CARICAMENTO DATI IN MEMORIA
 # ==============================================================================
-# 1. DB Rifugi
-if load_rifugi_db:
-    try:
-        load_rifugi_db()
-        print("Database rifugi caricato in memoria.")
-    except Exception as e:
-        print(f"Attenzione: impossibile caricare il database dei rifugi: {e}")
-
-# 2. Nomi Strade (per Autocomplete)
+# I dati vengono caricati una sola volta per processo da load_data(), chiamata da create_app().
+# In produzione (scripts/serve.py) il caricamento avviene nel processo principale prima del fork:
+# i worker condividono le strutture in sola lettura (copy-on-write) e partono già pronti.
 STREET_NAMES = []
-try:
-    from scripts.db_queries.queries import load_street_names
+STREET_INDEX = StreetAutocomplete([], limit=20)
+OFFLINE_GEOCODER = OfflineGeocoder([])
+REVERSE_GEOCODER = ReverseGeocoder([])
+GEOCODE_CACHE = GeocodeCache(None)
+DATA_LOADED = False
 
-    STREET_NAMES = load_street_names()
-    print(f"Caricate {len(STREET_NAMES)} nomi di strade per suggerimenti.")
-except Exception as e:
-    print(f"Impossibile caricare nomi strade: {e}")
+# Oltre questa distanza la strada più vicina del dataset non è considerata attendibile
+REVERSE_MAX_KM = float(os.environ.get('REVERSE_MAX_KM', 0.5))
+GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', str(BASE_DIR / 'dataset' / 'geocode_cache.sqlite'))
 
-GEOCODE_CACHE = {}
+
+def _load_street_data():
+    global STREET_NAMES, STREET_INDEX, OFFLINE_GEOCODER, REVERSE_GEOCODER
+    # 1. DB Rifugi
+    if load_rifugi_db:
+        try:
+            load_rifugi_db()
+            print("Database rifugi caricato in memoria.")
+        except Exception as e:
+            print(f"Attenzione: impossibile caricare il database dei rifugi: {e}")
+
+    # 2. Nomi Strade (per Autocomplete)
+    try:
+        from scripts.db_queries.queries import load_street_names
+
+        STREET_NAMES = load_street_names()
+        print(f"Caricate {len(STREET_NAMES)} nomi di strade per suggerimenti.")
+    except Exception as e:
+        print(f"Impossibile caricare nomi strade: {e}")
+
+    # Indice di autocompletamento
+    STREET_INDEX = StreetAutocomplete(STREET_NAMES, limit=20)
+
+    # Geocoder locale sulle strade con coordinate: evita la chiamata a Nominatim quando possibile
+    OFFLINE_GEOCODER = OfflineGeocoder(STREET_NAMES)
+    if set_offline_geocoder:
+        set_offline_geocoder(OFFLINE_GEOCODER)
+    print(f"Geocoder locale: {len(OFFLINE_GEOCODER)} strade con coordinate.")
+
+    # Geocoding inverso (click sulla mappa) sulla stessa lista di strade
+    REVERSE_GEOCODER = ReverseGeocoder(STREET_NAMES)
+
+
+def _open_geocode_cache():
+    global GEOCODE_CACHE
+    # 3. Cache del geocoding: LRU/TTL in memoria + SQLite su disco condiviso tra i worker
+    GEOCODE_CACHE = GeocodeCache(GEOCODE_CACHE_PATH)
+    GEOCODE_CACHE.purge_expired()
+    # La stessa cache (con le stesse chiavi canoniche) serve anche calcola_coordinate (/api/nearest)
+    if set_geocode_cache:
+        set_geocode_cache(GEOCODE_CACHE)
+
+
+# 4. Chiamate a Nominatim: pool limitato con coalescenza delle richieste identiche e al massimo
+#    UPSTREAM_RATE chiamate al secondo (la policy di Nominatim pubblico è 1 al secondo); con
+#    scripts/serve.py il limite è condiviso da tutti i worker (UpstreamClient.share_rate)
+UPSTREAM = UpstreamClient(
+    max_concurrency=int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 2)),
+    max_pending=int(os.environ.get('UPSTREAM_MAX_PENDING', 32)),
+    rate=float(os.environ.get('UPSTREAM_RATE', 1.0)) or None,
+)
+# Attesa massima di una richiesta HTTP per la risposta del servizio esterno (secondi)
+UPSTREAM_WAIT = float(os.environ.get('UPSTREAM_WAIT', 12))
+
+# 5. Metriche esposte su /metrics (formato Prometheus)
+HTTP_LATENCY = metrics.Histogram('http_request_duration_seconds', 'Durata delle richieste HTTP',
+                                 ['method', 'route', 'status'])
+UPSTREAM_LATENCY = metrics.Histogram('upstream_request_duration_seconds', 'Durata delle chiamate a Nominatim',
+                                     ['operation', 'outcome'])
+UPSTREAM_REJECTED = metrics.Counter('upstream_rejected_total',
+                                    'Richieste senza risposta dal servizio esterno (pool occupato o attesa scaduta)',
+                                    ['operation', 'reason'])
+
+
+def _collect_service_stats():
+    # Letti al momento dell'esposizione: nessun costo sul percorso delle richieste
+    entries, size = GEOCODE_CACHE.memory_usage()
+    cache_events = {(event,): n for event, n in GEOCODE_CACHE.stats_snapshot().items()}
+    upstream_calls = {(kind,): n for kind, n in UPSTREAM.stats_snapshot().items()}
+    return [
+        metrics.family('geocode_cache_events_total', 'counter', 'Eventi della cache del geocoding',
+                       cache_events, ['event']),
+        metrics.family('geocode_cache_entries', 'gauge', 'Voci nel livello in memoria della cache del geocoding',
+                       {(): entries}),
+        metrics.family('geocode_cache_bytes', 'gauge', 'Memoria stimata del livello in memoria della cache',
+                       {(): size}),
+        metrics.family('upstream_calls_total', 'counter', 'Chiamate al pool del servizio esterno',
+                       upstream_calls, ['result']),
+        metrics.family('upstream_pending', 'gauge', 'Chiamate al servizio esterno in esecuzione o in coda',
+                       {(): UPSTREAM.pending()}),
+    ]
+
+
+metrics.REGISTRY.add_collector(_collect_service_stats)
+
+
+def _timed_upstream(operation: str, fn, *args) -> dict:
+    """Esegue una chiamata a Nominatim registrandone durata ed esito (ok, not_found, error)."""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        result = fn(*args)
+        outcome = 'ok' if result.get('lat') is not None else 'not_found'
+        return result
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, operation, outcome)
+
+# Numero massimo di rifugi restituibili da /api/nearest
+MAX_NEAREST_K = 20
+# Numero massimo di elementi accettati da /api/nearest/batch
+MAX_BATCH_SIZE = 10000
+# Indirizzi non in cache inviati a Nominatim per ogni richiesta batch (gli altri restano non risolti)
+MAX_BATCH_UPSTREAM = int(os.environ.get('MAX_BATCH_UPSTREAM', 5))
 
 
 # ==============================================================================
 # ROUTES FRONTEND
 # ==============================================================================
 
-@app.route('/')
+def _send_asset(url: str):
+    """
+    Invia un file del manifest STATIC_ASSETS (nessun accesso al filesystem per i file in memoria).
+    Gli URL con impronta sono immutabili; gli URL originali vanno rivalidati (ETag).
+    """
+    found = STATIC_ASSETS.lookup(url)
+    if found is None:
+        return '', 404
+    asset, immutable = found
+    cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    if asset.compressible and asset.in_memory:
+        return _send_precompressed(asset.payload, asset.mimetype, cache_control)
+    if etag_matches(request.headers.get('If-None-Match'), [asset.etag]):
+        resp = make_response('', 304)
+    elif asset.in_memory:
+        resp = make_response(asset.payload.data)
+        resp.headers['Content-Type'] = asset.mimetype
+    else:
+        # File grandi: letti dal disco dal percorso risolto all'avvio
+        resp = send_file(asset.path, mimetype=asset.mimetype, conditional=False, etag=False)
+    resp.headers['ETag'] = asset.etag
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+@bp.route('/')
 def index():
     if INDEX_FULL_PATH:
-        try:
-            return send_file(INDEX_FULL_PATH)
-        except Exception:
-            pass
-    if FRONTEND_DIR:
-        return app.send_static_file('index.html')
+        return _send_asset('/' + Path(INDEX_FULL_PATH).name)
     return "Index not found", 404
 
 
-def try_send_static(filename):
-    fn = filename.lstrip('/\\')
-    if FRONTEND_DIR:
-        res = safe_send_from_directory(FRONTEND_DIR, fn)
-        if res: return res
-    if INDEX_PARENT:
-        res = safe_send_from_directory(INDEX_PARENT, fn)
-        if res: return res
-    return None
-
-
-@app.route('/app.js')
-def app_js():
-    res = try_send_static('app.js')
-    return res if res else ('', 404)
-
-
-@app.route('/css/<path:filename>')
-def css_file(filename):
-    res = None
-    if FRONTEND_DIR:
-        res = safe_send_from_directory(os.path.join(FRONTEND_DIR, 'css'), filename)
-        if res: return res
-    if INDEX_PARENT:
-        res = safe_send_from_directory(os.path.join(INDEX_PARENT, 'css'), filename)
-        if res: return res
-    return ('', 404)
-
-
-@app.route('/js/<path:filename>')
-def js_file(filename):
-    res = None
-    if FRONTEND_DIR:
-        res = safe_send_from_directory(os.path.join(FRONTEND_DIR, 'js'), filename)
-        if res: return res
-    if INDEX_PARENT:
-        res = safe_send_from_directory(os.path.join(INDEX_PARENT, 'js'), filename)
-        if res: return res
-    return ('', 404)
-
-
-@app.route('/assets/<path:filename>')
-def assets_file(filename):
-    res = None
-    if FRONTEND_DIR:
-        res = safe_send_from_directory(os.path.join(FRONTEND_DIR, 'assets'), filename)
-        if res: return res
-    if INDEX_PARENT:
-        res = safe_send_from_directory(os.path.join(INDEX_PARENT, 'assets'), filename)
-        if res: return res
-    return ('', 404)
-
-
-@app.route('/<path:filename>')
+@bp.route('/<path:filename>')
 def static_proxy(filename):
-    res = try_send_static(filename)
-    return res if res else ('', 404)
+    return _send_asset('/' + filename.lstrip('/\\'))
 
 
 # ==============================================================================
 # API ENDPOINTS
 # ==============================================================================
 
-@app.route('/api/nearest', methods=['POST'])
+@bp.route('/api/nearest', methods=['POST'])
 def api_nearest():
     if not trova_rifugio_piu_vicino:
         return jsonify({"successo": False, "messaggio": "Funzionalità non disponibile lato server."}), 501
 
     data = request.get_json(force=True)
-    if not data or 'indirizzo' not in data:
+    # Coordinate già note (punto scelto sulla mappa): nessun geocoding
+    coordinate = isinstance(data, dict) and data.get('lat') is not None and data.get('lon') is not None
+    if not data or ('indirizzo' not in data and not coordinate):
         return jsonify({"successo": False, "messaggio": "Parametro 'indirizzo' mancante."}), 400
 
+    # Numero opzionale di rifugi da restituire (il più vicino + alternative)
+    try:
+        k = int(data.get('k', 1))
+    except (TypeError, ValueError):
+        return jsonify({"successo": False, "messaggio": "Parametro 'k' non valido."}), 400
+    k = min(max(k, 1), MAX_NEAREST_K)
+
+    if coordinate:
+        try:
+            lat, lon = float(data['lat']), float(data['lon'])
+        except (TypeError, ValueError):
+            return jsonify({"successo": False, "messaggio": "Coordinate non valide."}), 400
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({"successo": False, "messaggio": "Coordinate non valide."}), 400
+        try:
+            return jsonify(trova_rifugio_da_coordinate(lat, lon, k=k))
+        except Exception as e:
+            return jsonify({"successo": False, "messaggio": str(e)}), 500
+
     indirizzo = data.get('indirizzo')
     if not isinstance(indirizzo, str) or indirizzo.strip() == '':
         return jsonify({"successo": False, "messaggio": "Indirizzo non valido."}), 400
 
     try:
         locator = get_geolocator() if get_geolocator else None
-        risultato = trova_rifugio_piu_vicino(indirizzo, geolocator=locator)
+        risultato = trova_rifugio_piu_vicino(indirizzo, geolocator=locator, k=k)
         return jsonify(risultato)
     except Exception as e:
         return jsonify({"successo": False, "messaggio": str(e)}), 500
 
 
-@app.route('/api/suggest-street')
+@bp.route('/api/nearest/batch', methods=['POST'])
+def api_nearest_batch():
+    """
+    Rifugio più vicino per una lista di indirizzi e/o coordinate.
+    Ogni elemento di 'items' può essere una stringa (indirizzo), un oggetto {'indirizzo': ...}
+    oppure un oggetto {'lat': ..., 'lon': ...}. L'ordine dei risultati segue quello degli elementi.
+    Gli indirizzi sono risolti con il geocoder locale e la cache; solo i primi MAX_BATCH_UPSTREAM
+    indirizzi distinti mancanti vengono inviati a Nominatim (tramite il pool UPSTREAM), gli altri
+    sono restituiti come non risolti ('risolto': False) e possono essere inviati di nuovo più tardi.
+    """
+    if not rifugi_piu_vicini_batch:
+        return jsonify({"successo": False, "messaggio": "Funzionalità non disponibile lato server."}), 501
+
+    data = request.get_json(force=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"successo": False, "messaggio": "Parametro 'items' mancante o vuoto."}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"successo": False, "messaggio": f"Massimo {MAX_BATCH_SIZE} elementi per richiesta."}), 400
+
+    n = len(items)
+    lat = [float('nan')] * n
+    lon = [float('nan')] * n
+    errori = [None] * n
+    da_geocodificare = []  # (posizione, indirizzo)
+
+    # Separazione tra coordinate già note e indirizzi da geocodificare
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and item.get('lat') is not None and item.get('lon') is not None:
+            try:
+                lat[i], lon[i] = float(item['lat']), float(item['lon'])
+            except (TypeError, ValueError):
+                errori[i] = "Coordinate non valide."
+            continue
+        indirizzo = item.get('indirizzo') if isinstance(item, dict) else item
+        if not isinstance(indirizzo, str) or indirizzo.strip() == '':
+            errori[i] = "Indirizzo non valido."
+            continue
+        da_geocodificare.append((i, indirizzo))
+
+    non_risolti = set()
+    try:
+        # Indirizzi equivalenti (stessa chiave canonica) sono risolti una sola volta
+        per_chiave = {}
+        for i, indirizzo in da_geocodificare:
+            per_chiave.setdefault(canonical_key(indirizzo, NAMESPACE_NEAREST), (indirizzo, []))[1].append(i)
+
+        coordinate = {}
+        chiamate = {}
+        for chiave, (indirizzo, _) in per_chiave.items():
+            noto = coordinate_note(indirizzo)
+            if noto is not None:
+                coordinate[chiave] = noto
+            elif len(chiamate) < MAX_BATCH_UPSTREAM:
+                try:
+                    chiamate[chiave] = UPSTREAM.submit(
+                        ('nearest', chiave), lambda q=indirizzo: _timed_upstream('nearest', _nominatim_nearest, q))
+                except UpstreamBusy:
+                    UPSTREAM_REJECTED.inc('nearest', 'busy')
+        scadenza = time.monotonic() + UPSTREAM_WAIT
+        for chiave, future in chiamate.items():
+            try:
+                trovato = future.result(timeout=max(0.0, scadenza - time.monotonic()))
+                coordinate[chiave] = (trovato['lat'], trovato['lon'])
+            except UpstreamTimeout:
+                UPSTREAM_REJECTED.inc('nearest', 'timeout')
+
+        for chiave, (_, posizioni) in per_chiave.items():
+            la, lo = coordinate.get(chiave, (None, None))
+            for i in posizioni:
+                if chiave not in coordinate:
+                    non_risolti.add(i)
+                    errori[i] = "Indirizzo non ancora geocodificato, riprova più tardi."
+                elif la is None:
+                    errori[i] = "Indirizzo non trovato. Prova ad inserire anche la Città o il CAP."
+                else:
+                    lat[i], lon[i] = float(la), float(lo)
+
+        rifugi = rifugi_piu_vicini_batch(lat, lon)
+    except Exception as e:
+        return jsonify({"successo": False, "messaggio": str(e)}), 500
+
+    risultati = []
+    for i in range(n):
+        if errori[i] is None and rifugi[i] is None:
+            errori[i] = "Coordinate non valide."
+        if i in non_risolti:
+            risultati.append({"successo": False, "risolto": False, "messaggio": errori[i]})
+        elif errori[i] is not None:
+            risultati.append({"successo": False, "messaggio": errori[i]})
+        else:
+            risultati.append({"successo": True, "dati_rifugio": rifugi[i], "coordinate_utente": (lat[i], lon[i])})
+    return jsonify({"successo": True, "risultati": risultati})
+
+
+@bp.route('/api/suggest-street')
 def suggest_street():
     """Autocompletamento indirizzi"""
     q = (request.args.get('q') or '').strip()
     if not q: return jsonify({'suggestions': []})
-    q_low = q.lower()
 
-    # Logica di filtro semplice
-    prefix_matches = [s for s in STREET_NAMES if
-                      s['display'].lower().startswith(q_low) or s['name'].lower().startswith(q_low)]
-    contains_matches = [s for s in STREET_NAMES if
-                        (q_low in s['display'].lower() or q_low in s['name'].lower()) and s not in prefix_matches]
-    results = (prefix_matches + contains_matches)[:20]
-
-    # Arricchimento con cache (se disponibile)
+    # Posizione opzionale dell'utente (?lat=&lon=): favorisce le strade vicine
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            lat = lon = None
+    except (KeyError, ValueError):
+        lat = lon = None
+
+    # Ricerca sull'indice: prima i match per prefisso, poi quelli per sottostringa e infine quelli
+    # approssimati (errori di battitura), max 20
+    results = STREET_INDEX.suggest(q, lat=lat, lon=lon)
+
+    # Arricchimento con i risultati di /api/geocode-street già in memoria: una sola chiave per
+    # suggerimento (la stessa che userà geocode-street con q = display), senza letture dal disco
     enriched = []
     try:
         for s in results:
             item = dict(s)
-            keys = []
-            if item.get('display'): keys.append(item['display'].strip().lower())
-            name = (item.get('name') or '').strip()
-            city = (item.get('city') or '').strip()
-            if name:
-                keys.append(name.lower())
-                if city: keys.append(f"{name}, {city}".lower())
-
-            for k in keys:
-                if k in GEOCODE_CACHE:
-                    cached = GEOCODE_CACHE.get(k, {})
-                    if cached.get('postcode'): item['postcode'] = cached.get('postcode')
-                    if cached.get('lat') is not None:
-                        item['lat'] = cached.get('lat')
-                        item['lon'] = cached.get('lon')
-                    break
+            text = item.get('display') or ', '.join(
+                p for p in (item.get('name'), item.get('city'), item.get('state')) if p)
+            cached = GEOCODE_CACHE.peek(canonical_key(text, NAMESPACE_GEOCODE)) if text else None
+            if cached is not None:
+                if cached.get('postcode'): item['postcode'] = cached.get('postcode')
+                if cached.get('lat') is not None:
+                    item['lat'] = cached.get('lat')
+                    item['lon'] = cached.get('lon')
             enriched.append(item)
     except Exception:
         enriched = results
     return jsonify({'suggestions': enriched})
 
 
-@app.route('/api/geocode-street', methods=['POST'])
+@bp.route('/api/geocode-street', methods=['POST'])
 def geocode_street():
     """Geocodifica on-demand per selezione autocomplete"""
     data = request.get_json(force=True) or {}
@@ -255,10 +457,39 @@ def geocode_street():
         if state: parts.append(state)
         q = ', '.join(parts)
 
-    key = q.strip().lower()
-    if key in GEOCODE_CACHE:
-        return jsonify(GEOCODE_CACHE[key])
+    # Chiave canonica: indirizzi equivalenti condividono la voce in cache e la chiamata a Nominatim
+    key = canonical_key(q, NAMESPACE_GEOCODE)
+    cached = GEOCODE_CACHE.get(key)
+    if cached is not None:
+        return jsonify(cached)
+
+    # Geocoder locale: nessuna chiamata di rete se la strada è nel dataset
+    local = OFFLINE_GEOCODER.geocode(q)
+    if local is not None:
+        local['display'] = q
+        return jsonify(local)
+
+    # Le richieste concorrenti per la stessa chiave attendono un'unica chiamata a Nominatim
+    try:
+        result = UPSTREAM.call(('geocode', key), lambda: _timed_upstream('geocode', _nominatim_geocode, q, key),
+                               timeout=UPSTREAM_WAIT)
+    except UpstreamBusy:
+        UPSTREAM_REJECTED.inc('geocode', 'busy')
+        return jsonify({'error': 'Servizio di geocoding occupato, riprova tra poco'}), 503
+    except UpstreamTimeout:
+        UPSTREAM_REJECTED.inc('geocode', 'timeout')
+        return jsonify({'error': 'Servizio di geocoding lento, riprova tra poco'}), 504
+    except Exception as e:
+        return jsonify({'error': f'Geocoding failed: {e}'}), 500
+    return jsonify(result)
 
+
+def _nominatim_geocode(q: str, key: str) -> dict:
+    """
+    Geocodifica q con Nominatim (eseguita nel pool UPSTREAM) e salva il risultato in cache.
+    @:return: Risultato {'lat', 'lon', 'postcode', 'display'} (lat/lon None se non trovato)
+    @:raise Exception: Se il servizio non risponde (errore non memorizzato: la richiesta successiva ritenta)
+    """
     try:
         geolocator = get_geolocator() if get_geolocator else None
         if not geolocator: raise Exception("Geolocator not initialized")
@@ -281,20 +512,91 @@ def geocode_street():
             except Exception:
                 pass
 
-        GEOCODE_CACHE[key] = result
-        return jsonify(result)
-    except Exception as e:
-        # Fallback a calcola_coordinate se disponibile
+        GEOCODE_CACHE.set(key, result)
+        return result
+    except Exception:
+        # Fallback a calcola_coordinate se disponibile (che usa la cache nel proprio namespace)
         if calcola_coordinate:
             try:
                 lat, lon = calcola_coordinate(q, geolocator=get_geolocator())
                 if lat is not None:
-                    result = {'lat': float(lat), 'lon': float(lon), 'postcode': None, 'display': q}
-                    GEOCODE_CACHE[key] = result
-                    return jsonify(result)
+                    return {'lat': float(lat), 'lon': float(lon), 'postcode': None, 'display': q}
             except Exception:
                 pass
-        return jsonify({'error': f'Geocoding failed: {e}'}), 500
+        raise
+
+
+@bp.route('/api/reverse-geocode')
+def reverse_geocode():
+    """
+    Strada più vicina alle coordinate (?lat=&lon=), nel formato di load_street_names().
+    Se nel dataset non c'è una strada entro REVERSE_MAX_KM si interroga Nominatim (con cache).
+    """
+    try:
+        lat = float(request.args.get('lat'))
+        lon = float(request.args.get('lon'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Parametri lat e lon obbligatori'}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'Coordinate non valide'}), 400
+
+    found = REVERSE_GEOCODER.reverse(lat, lon, max_km=REVERSE_MAX_KM)
+    if found is not None:
+        entry, km = found
+        return jsonify(dict(entry, distanza_km=round(km, 3), fonte='locale'))
+
+    # Chiave arrotondata a ~10 m: click vicini condividono la stessa risposta
+    key = f"reverse:{lat:.4f},{lon:.4f}"
+    cached = GEOCODE_CACHE.get(key)
+    if cached is None:
+        try:
+            cached = UPSTREAM.call(('reverse', key),
+                                   lambda: _timed_upstream('reverse', _nominatim_reverse, lat, lon, key),
+                                   timeout=UPSTREAM_WAIT)
+        except UpstreamBusy:
+            UPSTREAM_REJECTED.inc('reverse', 'busy')
+            return jsonify({'error': 'Servizio di geocoding occupato, riprova tra poco'}), 503
+        except UpstreamTimeout:
+            UPSTREAM_REJECTED.inc('reverse', 'timeout')
+            return jsonify({'error': 'Servizio di geocoding lento, riprova tra poco'}), 504
+        except Exception as e:
+            # Errore del servizio: non memorizzato, la prossima richiesta ritenta
+            return jsonify({'error': f'Reverse geocoding failed: {e}'}), 502
+
+    if cached.get('display') is None:
+        return jsonify({'error': 'Nessun indirizzo trovato'}), 404
+    return jsonify(cached)
+
+
+def _nominatim_nearest(indirizzo: str) -> dict:
+    """Geocodifica per /api/nearest/batch (eseguita nel pool UPSTREAM): calcola_coordinate salva in cache."""
+    locator = get_geolocator() if get_geolocator else None
+    lat, lon = calcola_coordinate(indirizzo, geolocator=locator)
+    return {'lat': lat, 'lon': lon}
+
+
+def _nominatim_reverse(lat: float, lon: float, key: str) -> dict:
+    """Geocoding inverso con Nominatim (eseguito nel pool UPSTREAM), con salvataggio in cache."""
+    geolocator = get_geolocator() if get_geolocator else None
+    if not geolocator: raise Exception("Geolocator not initialized")
+    location = geolocator.reverse((lat, lon), exactly_one=True, addressdetails=True, timeout=10)
+
+    result = {'name': None, 'city': None, 'state': None, 'display': None,
+              'lat': None, 'lon': None, 'postcode': None, 'fonte': 'nominatim'}
+    if location:
+        raw = getattr(location, 'raw', {}) or {}
+        address = raw.get('address', {}) if isinstance(raw, dict) else {}
+        result.update({
+            'name': address.get('road'),
+            'city': address.get('city') or address.get('town') or address.get('village'),
+            'state': address.get('state'),
+            'display': location.address,
+            'lat': float(location.latitude),
+            'lon': float(location.longitude),
+            'postcode': address.get('postcode'),
+        })
+    GEOCODE_CACHE.set(key, result)
+    return result
 
 
 # ==============================================================================
@@ -303,73 +605,458 @@ def geocode_street():
 
 GEOJSON_DIR = BASE_DIR / 'animali_qgis' / 'geojson'
 
+# Layer tenuti in memoria in forma precompressa, ricaricati quando il file cambia
+GEOJSON_STORE = GeoJSONStore(GEOJSON_DIR)
+
+
+def _preload_geojson():
+    try:
+        # Originali e versioni ottimizzate per livello di zoom (python -m scripts.geojson_optimize)
+        caricati = GEOJSON_STORE.preload() + GEOJSON_STORE.preload(f'{LOD_DIRNAME}/*.geojson')
+        print(f"Layer GeoJSON precompressi: {caricati}")
+    except Exception as e:
+        print(f"Impossibile precaricare i layer GeoJSON: {e}")
+
+GEOJSON_CACHE_CONTROL = 'public, max-age=300, stale-while-revalidate=60'
+
+
+def _send_precompressed(payload, content_type: str, cache_control: str):
+    """
+    Invia un contenuto precompresso negoziando la codifica (Accept-Encoding)
+    e rispondendo 304 se il client ha già la versione corrente (If-None-Match).
+    """
+    coding, body, etag = payload.negotiate(request.headers.get('Accept-Encoding'))
+    if etag_matches(request.headers.get('If-None-Match'), payload.etags.values()):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(body)
+        resp.headers['Content-Type'] = content_type
+        if coding != 'identity':
+            resp.headers['Content-Encoding'] = coding
+    resp.headers['ETag'] = etag
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+def _resolve_geojson(filename: str) -> Path:
+    """Risolve il percorso di un file GeoJSON, sollevando ValueError se esce dalla cartella."""
+    target = (GEOJSON_DIR / filename).resolve()
+    target.relative_to(GEOJSON_DIR.resolve())  # Security Check
+    return target
+
+
+def _request_zoom():
+    """Livello di zoom richiesto con ?zoom= (None se assente o non valido)."""
+    try:
+        zoom = float(request.args.get('zoom'))
+    except (TypeError, ValueError):
+        return None
+    return zoom if 0 <= zoom <= 30 else None
+
+
+def _load_geojson_layer(target: Path, zoom):
+    """
+    Restituisce la versione ottimizzata del layer adatta allo zoom richiesto,
+    o il file originale se le versioni ottimizzate non sono state generate
+    (o sono state generate da un contenuto diverso del file originale).
+    """
+    source = GEOJSON_STORE.get(target)
+    if source is None:
+        return None
+    source_sha256 = source.derived('sha256', lambda l: hashlib.sha256(l.payload.data).hexdigest())
+    for level in lod_candidates(zoom):
+        layer = GEOJSON_STORE.get(lod_path(target.parent, target.stem, level))
+        if layer is not None and layer.derived('source_sha256',
+                                               lambda l: lod_source_sha256(l.payload.data)) == source_sha256:
+            return layer
+    return source
+
+
+def _feature_index(layer):
+    """Indice STR delle feature, costruito una volta per versione del layer."""
+    return layer.derived('feature_index', lambda l: FeatureIndex(l.data))
+
 
 def _serve_geojson_safe(filename: str):
-    """Serve file GeoJSON dalla cartella 'animali_qgis/geojson' in modo sicuro."""
+    """
+    Serve file GeoJSON dalla cartella 'animali_qgis/geojson' in modo sicuro.
+    Con ?zoom= viene servita la versione semplificata per quel livello di zoom;
+    con ?bbox=minx,miny,maxx,maxy solo le feature che intersecano la bounding box.
+    """
     try:
-        target = (GEOJSON_DIR / filename).resolve()
-        base = GEOJSON_DIR.resolve()
-        target.relative_to(base)  # Security Check
+        target = _resolve_geojson(filename)
     except Exception:
         return jsonify({'error': 'Invalid file path.'}), 400
 
-    if not target.exists():
-        # Restituisce FeatureCollection vuota per non rompere il frontend
-        return jsonify({"type": "FeatureCollection", "features": []})
+    try:
+        bbox = parse_bbox(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     try:
-        resp = make_response(send_file(str(target)))
-        resp.headers['Content-Type'] = 'application/geo+json; charset=utf-8'
-        resp.headers['Cache-Control'] = 'public, max-age=300, stale-while-revalidate=60'
-        return resp
+        layer = _load_geojson_layer(target, _request_zoom())
     except Exception as e:
         return jsonify({'error': f'Unable to read file: {e}'}), 500
 
+    if layer is None:
+        # Restituisce FeatureCollection vuota per non rompere il frontend
+        return jsonify({"type": "FeatureCollection", "features": []})
+
+    if bbox is not None:
+        index = _feature_index(layer)
+        payload = Precompressed(index.collection_bytes(index.query(bbox)), gzip_level=6, brotli_quality=5)
+        return _send_precompressed(payload, 'application/geo+json; charset=utf-8', GEOJSON_CACHE_CONTROL)
 
-@app.route('/api/geojson/zone_rosse')
+    return _send_precompressed(layer.payload, 'application/geo+json; charset=utf-8', GEOJSON_CACHE_CONTROL)
+
+
+@bp.route('/api/geojson/zone_rosse')
 def api_zone_rosse():
     # Assicurati che il file 'zone_rosse.geojson' sia nella cartella 'animali_qgis/geojson'
     return _serve_geojson_safe('zone_rosse.geojson')
 
 
-@app.route('/api/geojson/animali_malati')
+@bp.route('/api/geojson/animali_malati')
 def api_animali_malati():
     return _serve_geojson_safe('animali_malati.geojson')
 
 
-@app.route('/api/geojson/animali_randagi_prova')
+@bp.route('/api/geojson/animali_randagi_prova')
 def api_animali_randagi_prova():
     # Serve il file animali_randagi_prova.geojson se presente nella cartella GEOJSON_DIR
     return _serve_geojson_safe('animali_randagi_prova.geojson')
 
 
-@app.route('/api/geojson/animali_randagi')
+@bp.route('/api/geojson/animali_randagi')
 def api_animali_randagi():
     # Serve il file animali_randagi.geojson se presente nella cartella GEOJSON_DIR
     return _serve_geojson_safe('animali_randagi.geojson')
 
 
 # Aggiungi o verifica questa route in server.py
-@app.route('/api/geojson/Animali Domestici.geojson')
+@bp.route('/api/geojson/Animali Domestici.geojson')
 def api_animali_domestici():
     return _serve_geojson_safe('Animali Domestici.geojson')
 
 
-@app.route('/api/geojson/Fauna Selvatica.geojson')
+@bp.route('/api/geojson/Fauna Selvatica.geojson')
 def api_fauna_selvatica():
     return _serve_geojson_safe('Fauna Selvatica.geojson')
 
 
-@app.route('/api/geojson/Fauna Selvatica -Heatmap.geojson')
+@bp.route('/api/geojson/Fauna Selvatica -Heatmap.geojson')
 def api_fauna_heatmap():
     return _serve_geojson_safe('Fauna Selvatica -Heatmap.geojson')
 
 
-@app.route('/api/geojson/animali_difficili')
+@bp.route('/api/geojson/animali_difficili')
 def api_quartieri_intake():
     return _serve_geojson_safe('animali_difficili.geojson')
 
 
+# ==============================================================================
+# CLUSTERING DEI LAYER DI PUNTI
+# ==============================================================================
+
+# Layer di punti per cui è disponibile il clustering: nome nell'URL -> file
+CLUSTER_LAYERS = {
+    'zone_rosse': 'zone_rosse.geojson',
+    'animali_domestici': 'Animali Domestici.geojson',
+    'fauna_selvatica': 'Fauna Selvatica.geojson',
+}
+
+
+def _clusterer(layer):
+    """Gerarchia dei cluster, calcolata una volta per versione del layer."""
+    return layer.derived('clusters', lambda l: PointClusterer(l.data))
+
+
+@bp.route('/api/clusters/<layer_name>')
+def api_clusters(layer_name):
+    """
+    Cluster del layer visibili nella bbox al livello di zoom indicato.
+    Parametri: bbox=minx,miny,maxx,maxy (default: tutto il mondo), zoom (default 0).
+    """
+    filename = CLUSTER_LAYERS.get(layer_name.lower())
+    if filename is None:
+        return jsonify({'error': f'Layer non disponibile: {layer_name}'}), 404
+    try:
+        bbox = parse_bbox(request.args.get('bbox')) or (-180.0, -90.0, 180.0, 90.0)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    zoom = _request_zoom()
+    if zoom is None:
+        zoom = 0
+
+    try:
+        layer = GEOJSON_STORE.layer(filename)
+        if layer is None:
+            return jsonify({"type": "FeatureCollection", "features": []})
+        clusterer = _clusterer(layer)
+    except Exception as e:
+        return jsonify({'error': f'Unable to read file: {e}'}), 500
+
+    payload = Precompressed(clusterer.clusters(bbox, zoom), gzip_level=6, brotli_quality=5)
+    return _send_precompressed(payload, 'application/geo+json; charset=utf-8', GEOJSON_CACHE_CONTROL)
+
+
+# ==============================================================================
+# HEATMAP (TILE PNG)
+# ==============================================================================
+
+# Layer per cui è disponibile la heatmap: nome nell'URL -> file
+HEATMAP_LAYERS = {
+    'fauna_selvatica': 'Fauna Selvatica -Heatmap.geojson',
+}
+MAX_HEATMAP_ZOOM = 22
+
+
+def _heatmap_tiles(layer):
+    """Griglie e cache delle tile heatmap, legate alla versione del layer."""
+    return layer.derived('heatmap', lambda l: HeatmapTiles(l.data))
+
+
+@bp.route('/api/heatmap/<layer_name>/<int:z>/<int:x>/<int:y>.png')
+def api_heatmap_tile(layer_name, z, x, y):
+    """Tile PNG (schema XYZ) della heatmap di un layer di punti."""
+    filename = HEATMAP_LAYERS.get(layer_name.lower())
+    if filename is None:
+        return jsonify({'error': f'Layer non disponibile: {layer_name}'}), 404
+    if not (0 <= z <= MAX_HEATMAP_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'error': 'Tile non valida.'}), 400
+
+    try:
+        layer = GEOJSON_STORE.layer(filename)
+        if layer is None:
+            png, etag = EMPTY_TILE, '"empty"'
+        else:
+            tiles = _heatmap_tiles(layer)
+            png, etag = tiles.render(z, x, y), f'"{layer.version}-{z}-{x}-{y}"'
+    except Exception as e:
+        return jsonify({'error': f'Unable to render tile: {e}'}), 500
+
+    # Il PNG è già compresso: nessuna negoziazione della codifica
+    if etag_matches(request.headers.get('If-None-Match'), [etag]):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(png)
+        resp.headers['Content-Type'] = 'image/png'
+    resp.headers['ETag'] = etag
+    resp.headers['Cache-Control'] = GEOJSON_CACHE_CONTROL
+    return resp
+
+
+# ==============================================================================
+# ANIMALI RANDAGI: SERIE MENSILE
+# ==============================================================================
+
+RANDAGI_FILENAME = 'animali_randagi.geojson'
+
+
+def _randagi_timeline():
+    """Serie mensile del layer animali_randagi (None se il file non esiste)."""
+    layer = GEOJSON_STORE.layer(RANDAGI_FILENAME)
+    if layer is None:
+        return None, None
+    return layer, layer.derived('timeline', lambda l: RandagiTimeline(l.data))
+
+
+@bp.route('/api/randagi/mesi')
+def api_randagi_mesi():
+    """Elenco dei mesi con i conteggi per specie, rifugio e sesso degli animali (deduplicati)."""
+    try:
+        layer, timeline = _randagi_timeline()
+    except Exception as e:
+        return jsonify({'error': f'Unable to read file: {e}'}), 500
+    if timeline is None:
+        return jsonify({'versione': None, 'mesi': []})
+    payload = layer.derived('timeline_summary', lambda l: Precompressed(json.dumps(
+        {'versione': l.version, 'mesi': timeline.riepilogo()}, ensure_ascii=False).encode('utf-8')))
+    # Il riepilogo va sempre riconvalidato (risposta 304 se il layer non è cambiato)
+    return _send_precompressed(payload, 'application/json; charset=utf-8', 'no-cache')
+
+
+@bp.route('/api/randagi/mese/<mese>')
+def api_randagi_mese(mese):
+    """
+    Feature deduplicate di un mese ('YYYY-MM' o 'Unknown').
+    Con ?nuovi=1 solo gli animali non comparsi nei mesi precedenti (animazione cumulativa).
+    """
+    solo_nuovi = request.args.get('nuovi', '').lower() in ('1', 'true', 'yes')
+    try:
+        _, timeline = _randagi_timeline()
+    except Exception as e:
+        return jsonify({'error': f'Unable to read file: {e}'}), 500
+    payload = timeline.payload(mese, solo_nuovi) if timeline is not None else None
+    if payload is None:
+        return jsonify({'error': f'Mese non disponibile: {mese}'}), 404
+    return _send_precompressed(payload, 'application/geo+json; charset=utf-8', GEOJSON_CACHE_CONTROL)
+
+
+# ==============================================================================
+# AREE DI SERVIZIO DEI RIFUGI
+# ==============================================================================
+
+# Partizione di Voronoi dei rifugi, ricalcolata quando cambia il CSV
+RIFUGI_CSV = BASE_DIR / 'dataset' / 'rifugi_locations.csv'
+SERVICE_AREAS = ServiceAreaStore(RIFUGI_CSV)
+
+
+@bp.route('/api/geojson/service_areas')
+def api_service_areas():
+    """Area di servizio di ogni rifugio (i punti per cui è il rifugio più vicino), come poligoni."""
+    try:
+        layer = SERVICE_AREAS.get()
+    except Exception as e:
+        return jsonify({'error': f'Unable to build service areas: {e}'}), 500
+    if layer is None:
+        return jsonify({"type": "FeatureCollection", "features": []})
+    return _send_precompressed(layer.payload, 'application/geo+json; charset=utf-8', GEOJSON_CACHE_CONTROL)
+
+
+@bp.route('/api/service-area')
+def api_service_area():
+    """
+    Rifugio che serve il punto ?lat=&lon= (ricerca nella partizione precalcolata, senza geocoding).
+    I punti fuori dalla regione della partizione ricevono il rifugio più vicino, come /api/nearest.
+    """
+    try:
+        lat = float(request.args.get('lat'))
+        lon = float(request.args.get('lon'))
+    except (TypeError, ValueError):
+        return jsonify({"successo": False, "messaggio": "Parametri 'lat' e 'lon' non validi."}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"successo": False, "messaggio": "Coordinate fuori intervallo."}), 400
+
+    try:
+        layer = SERVICE_AREAS.get()
+    except Exception as e:
+        return jsonify({"successo": False, "messaggio": str(e)}), 500
+    if layer is None or not _formatta_rifugio:
+        return jsonify({"successo": False, "messaggio": "Database dei rifugi non disponibile."}), 503
+
+    found = layer.locate(lat, lon)
+    if found is None:
+        return jsonify({"successo": False, "messaggio": "Nessun rifugio con coordinate valide."}), 404
+    distanza, rifugio = found
+    return jsonify({"successo": True, "dati_rifugio": _formatta_rifugio(rifugio, distanza),
+                    "coordinate_utente": (lat, lon), "versione": layer.version})
+
+
+# ==============================================================================
+# APPLICATION FACTORY
+# ==============================================================================
+
+def warmup():
+    """
+    Costruisce subito le strutture derivate dei layer (indici, cluster, heatmap, serie mensile,
+    aree di servizio dei rifugi), che altrimenti verrebbero calcolate alla prima richiesta da ogni worker.
+    """
+    for layer in GEOJSON_STORE.layers():
+        _feature_index(layer)
+    for filename in CLUSTER_LAYERS.values():
+        layer = GEOJSON_STORE.layer(filename)
+        if layer is not None:
+            _clusterer(layer)
+    for filename in HEATMAP_LAYERS.values():
+        layer = GEOJSON_STORE.layer(filename)
+        if layer is not None:
+            _heatmap_tiles(layer)
+    _randagi_timeline()
+    SERVICE_AREAS.get()
+
+
+def load_data(warm: bool = True):
+    """
+    Carica tutti i dataset e gli indici in memoria (una sola volta per processo).
+    @:param warm: Se True costruisce anche le strutture derivate dei layer (vedi warmup())
+    """
+    global DATA_LOADED
+    if DATA_LOADED:
+        return
+    DATASETS.prune()
+    _load_street_data()
+    _open_geocode_cache()
+    _preload_geojson()
+    if warm:
+        try:
+            warmup()
+        except Exception as e:
+            print(f"Attenzione: precalcolo dei layer non riuscito: {e}")
+    DATA_LOADED = True
+
+
+@bp.route('/api/health')
+def api_health():
+    """Stato del server: 200 quando i dati sono caricati, 503 altrimenti."""
+    ready = bool(current_app.config.get('READY'))
+    return jsonify({'ready': ready, 'strade': len(STREET_NAMES), 'pid': os.getpid()}), (200 if ready else 503)
+
+
+@bp.route('/metrics')
+def api_metrics():
+    """Metriche del server (tutti i worker) nel formato testuale di Prometheus."""
+    response = make_response(metrics.REGISTRY.render())
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def _start_timer():
+    request.environ['metrics.start'] = time.perf_counter()
+
+
+def _observe_request(response):
+    # Etichetta route = regola di routing (es. /api/geojson/<name>), non l'URL: cardinalità limitata
+    start = request.environ.get('metrics.start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_LATENCY.observe(time.perf_counter() - start, request.method, route, str(response.status_code))
+    return response
+
+
+def create_app(load: bool = True, warm: bool = True) -> Flask:
+    """
+    Crea l'applicazione Flask.
+    @:param load: Se True carica dati e indici prima di restituire l'app (vedi load_data())
+    @:param warm: Se True precalcola anche le strutture derivate dei layer
+    @:return: Applicazione pronta a servire richieste (app.config['READY'] = True)
+    """
+    global FRONTEND_DIR, INDEX_FULL_PATH, INDEX_PARENT, STATIC_ASSETS
+    FRONTEND_DIR, INDEX_FULL_PATH, INDEX_PARENT = _resolve_frontend()
+    # index.html è servito come pagina "/": i percorsi relativi di HTML e script partono da lì
+    STATIC_ASSETS = AssetManifest([FRONTEND_DIR, INDEX_PARENT], document_url='/')
+    print(f"[server] File statici nel manifest: {len(STATIC_ASSETS)}")
+
+    # I file statici sono serviti dal manifest (static_proxy), non dalla cartella statica di Flask
+    flask_app = Flask(__name__, static_folder=None)
+    CORS(flask_app)
+    flask_app.register_blueprint(bp)
+    flask_app.before_request(_start_timer)
+    flask_app.after_request(_observe_request)
+
+    flask_app.config['READY'] = False
+    if load:
+        load_data(warm=warm)
+        flask_app.config['READY'] = True
+    return flask_app
+
+
+_app = None
+
+
+def __getattr__(name):
+    # "from scripts.server import app" (es. gunicorn scripts.server:app) crea l'app alla prima richiesta
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
+    # Server di sviluppo; in produzione usare scripts/serve.py
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG') == '1')
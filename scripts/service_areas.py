@@ -0,0 +1,416 @@
+import json
+import math
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.dataset_store import DATASETS
+from scripts.precompressed import Precompressed
+from scripts.spatial_index import EARTH_RADIUS_KM, SphericalKDTree, chord_to_km, km_to_chord, to_unit_xyz
+
+# Aree di servizio dei rifugi: partizione di Voronoi sferica della regione attorno ai rifugi
+# (ogni punto della regione appartiene al rifugio più vicino in distanza ortodromica).
+# Le celle sono calcolate nella proiezione gnomonica centrata sui rifugi: in questa proiezione i
+# cerchi massimi sono rette, quindi il bisettore sferico di due rifugi è una retta e ogni cella è
+# l'intersezione (esatta) di semipiani, ottenuta ritagliando il rettangolo della regione.
+# Per ogni cella si considerano i rifugi in ordine di distanza (dal KD-tree) e ci si ferma quando
+# il rifugio successivo è più lontano del doppio del vertice più lontano della cella.
+# La localizzazione di un punto usa una decomposizione a strisce verticali della partizione: una
+# ricerca binaria trova la striscia e una seconda ricerca binaria, tra i bordi delle celle che
+# attraversano la striscia (ordinati dal basso verso l'alto), trova la cella: O(log n) per punto.
+# I punti fuori dalla regione (oltre REGION_MARGIN_KM dai rifugi più esterni) non hanno una cella:
+# locate() e locate_batch() li assegnano comunque al rifugio più vicino con il KD-tree dei rifugi.
+# ServiceAreaStore ricostruisce la partizione (e il GeoJSON precompresso) quando il CSV dei
+# rifugi cambia, con lo stesso controllo di mtime/dimensione di GeoJSONStore.
+
+# Margine della regione attorno ai rifugi (km)
+REGION_MARGIN_KM = 25.0
+# Lunghezza massima di un lato dei poligoni nel GeoJSON (i lati delle celle sono archi di cerchio massimo)
+DENSIFY_KM = 5.0
+# Decimali delle coordinate nel GeoJSON (~0.1 m)
+COORD_DECIMALS = 6
+# Tolleranza sulle ascisse dei vertici (unità della proiezione, ~ radianti)
+_EPS = 1e-12
+# Proprietà dei rifugi copiate nelle feature del GeoJSON
+PROPERTIES = ('Shelter_Name', 'Address', 'City')
+
+
+class ServiceAreas:
+    """
+    Partizione di Voronoi sferica della regione attorno ai rifugi, con indice di localizzazione.
+    Più rifugi con le stesse coordinate condividono la cella (viene restituito il primo).
+    @:param lat: Latitudini dei rifugi
+    @:param lon: Longitudini dei rifugi
+    @:param ids: Identificativi dei rifugi (default: posizione negli array)
+    @:param margin_km: Margine della regione attorno ai rifugi
+    """
+
+    def __init__(self, lat: Sequence[float], lon: Sequence[float], ids: Optional[Sequence[int]] = None,
+                 margin_km: float = REGION_MARGIN_KM):
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel()
+        ids = np.arange(len(lat)) if ids is None else np.asarray(ids, dtype=np.intp).ravel()
+        if not (len(lat) == len(lon) == len(ids)):
+            raise ValueError("Latitudine, longitudine e identificativi devono avere la stessa lunghezza.")
+        if not (np.isfinite(lat).all() and np.isfinite(lon).all()):
+            raise ValueError("Coordinate non valide (NaN o infinito) tra i rifugi.")
+
+        # Un sito per coordinata distinta: il primo rifugio in ordine di input
+        first = np.sort(np.unique(np.column_stack([lat, lon]), axis=0, return_index=True)[1]) if len(lat) else ids[:0]
+        self.lat, self.lon, self.ids = lat[first], lon[first], ids[first]
+        self.xyz = to_unit_xyz(self.lat, self.lon) if len(first) else np.empty((0, 3))
+        self.cells: List[np.ndarray] = []
+        self.tree = SphericalKDTree(self.lat, self.lon)
+        if len(first):
+            self._setup_projection(margin_km)
+            self._build_cells()
+            self._build_slabs()
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    # --- PROIEZIONE GNOMONICA ---
+    def _setup_projection(self, margin_km: float):
+        center = self.xyz.sum(axis=0)
+        norm = np.linalg.norm(center)
+        if norm < 1e-9:
+            raise ValueError("Rifugi distribuiti su tutto il globo: partizione non calcolabile.")
+        self.center = center / norm
+        east = np.cross([0.0, 0.0, 1.0], self.center)
+        if np.linalg.norm(east) < 1e-9:
+            east = np.array([0.0, 1.0, 0.0])
+        self.east = east / np.linalg.norm(east)
+        self.north = np.cross(self.center, self.east)
+
+        # La proiezione vale solo nell'emisfero attorno al centro: qui si richiede meno di ~80°
+        if (self.xyz @ self.center).min() < math.cos(math.radians(80)):
+            raise ValueError("I rifugi coprono un'area troppo estesa per la partizione.")
+        self.sites = self.project(self.xyz)
+        margin = math.tan(margin_km / EARTH_RADIUS_KM)
+        (x0, y0), (x1, y1) = self.sites.min(axis=0) - margin, self.sites.max(axis=0) + margin
+        # Regione: rettangolo nel piano della proiezione (lati = archi di cerchio massimo), in senso antiorario
+        self.region = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+
+    def project(self, xyz: np.ndarray) -> np.ndarray:
+        """Vettori sulla sfera unitaria -> coordinate (x, y) nel piano della proiezione gnomonica."""
+        depth = xyz @ self.center
+        return np.column_stack([(xyz @ self.east) / depth, (xyz @ self.north) / depth])
+
+    def unproject(self, xy: np.ndarray) -> np.ndarray:
+        """Coordinate nel piano della proiezione -> vettori sulla sfera unitaria."""
+        xyz = self.center + xy[:, :1] * self.east + xy[:, 1:2] * self.north
+        return xyz / np.linalg.norm(xyz, axis=1, keepdims=True)
+
+    # --- CELLE ---
+    def _build_cells(self):
+        tree = self.tree
+        n = len(self.sites)
+        for i in range(n):
+            cell = self.region
+            far = self._farthest(i, cell)
+            k, done, start = min(16, n), False, 0
+            while not done:
+                dist, neighbours = tree.query(self.lat[i], self.lon[i], k=k)
+                for d, j in zip(dist[start:], neighbours[start:]):
+                    if j == i:
+                        continue
+                    # Nessun rifugio oltre il doppio del vertice più lontano può togliere area alla cella
+                    if km_to_chord(d) >= 2 * far:
+                        done = True
+                        break
+                    clipped = _clip(cell, self._bisector(i, int(j)))
+                    if clipped is not cell:
+                        cell, far = clipped, self._farthest(i, clipped)
+                if k >= n:
+                    done = True
+                start, k = k, min(2 * k, n)
+            self.cells.append(cell)
+
+    def _farthest(self, i: int, cell: np.ndarray) -> float:
+        # Corda tra il rifugio e il vertice più lontano della cella
+        return float(np.sqrt(((self.unproject(cell) - self.xyz[i]) ** 2).sum(axis=1)).max())
+
+    def _bisector(self, i: int, j: int) -> Tuple[float, float, float]:
+        # Punti più vicini a i che a j: dot(p, p_i - p_j) >= 0, lineare nel piano della proiezione
+        diff = self.xyz[i] - self.xyz[j]
+        return float(diff @ self.east), float(diff @ self.north), float(diff @ self.center)
+
+    def area_km2(self, cell: int) -> float:
+        """Area (sferica) della cella, come somma dei triangoli tra il rifugio e i lati."""
+        a = self.xyz[cell]
+        b = self.unproject(self.cells[cell])
+        c = np.roll(b, -1, axis=0)
+        triple = np.abs(np.einsum('ij,ij->i', np.broadcast_to(a, b.shape), np.cross(b, c)))
+        den = 1.0 + b @ a + np.einsum('ij,ij->i', b, c) + c @ a
+        return float(2.0 * np.arctan2(triple, den).sum() * EARTH_RADIUS_KM ** 2)
+
+    # --- LOCALIZZAZIONE ---
+    def _build_slabs(self):
+        # Strisce tra ascisse consecutive dei vertici: all'interno di una striscia ogni cella che la
+        # attraversa è un trapezio, delimitato in basso e in alto da un solo segmento
+        xs = np.unique(np.round(np.concatenate([c[:, 0] for c in self.cells]), 12))
+        slab, cell_ids, lower, upper = [], [], [], []
+        for cell, poly in enumerate(self.cells):
+            lo_chain, hi_chain = _chains(poly)
+            k0 = int(np.searchsorted(xs, poly[:, 0].min() - _EPS, 'left'))
+            k1 = int(np.searchsorted(xs, poly[:, 0].max() + _EPS, 'right')) - 1
+            if k1 <= k0:
+                continue
+            bounds = xs[k0:k1 + 1]
+            ylo = np.interp(bounds, *lo_chain)
+            yhi = np.interp(bounds, *hi_chain)
+            slab.append(np.arange(k0, k1))
+            cell_ids.append(np.full(k1 - k0, cell))
+            lower.append(np.column_stack([ylo[:-1], ylo[1:]]))
+            upper.append(np.column_stack([yhi[:-1], yhi[1:]]))
+
+        slab, cell_ids = np.concatenate(slab), np.concatenate(cell_ids)
+        lower, upper = np.concatenate(lower), np.concatenate(upper)
+        # Nella striscia le celle sono ordinate dal basso verso l'alto (i bordi non si incrociano)
+        order = np.lexsort((lower.sum(axis=1), slab))
+        self._xs = xs
+        self._slab_start = np.searchsorted(slab[order], np.arange(len(xs)))
+        self._cell = cell_ids[order]
+        self._lower = lower[order]
+        self._upper = upper[order]
+
+    def locate_cell(self, lat: float, lon: float) -> Optional[int]:
+        """
+        Cella che contiene il punto (ricerca binaria su strisce e bordi).
+        @:return: Indice della cella o None se il punto è fuori dalla regione
+        """
+        cells = self.locate_cells(np.array([lat], dtype=float), np.array([lon], dtype=float))
+        return None if cells[0] < 0 else int(cells[0])
+
+    def locate_cells(self, lat, lon) -> np.ndarray:
+        """
+        Versione vettoriale di locate_cell: la ricerca binaria avanza in parallelo su tutti i punti.
+        @:return: Array di indici delle celle (-1 per i punti fuori dalla regione o non validi)
+        """
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel()
+        result = np.full(len(lat), -1, dtype=np.intp)
+        if not self.cells or not len(lat):
+            return result
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        xyz = to_unit_xyz(np.where(valid, lat, 0.0), np.where(valid, lon, 0.0))
+        valid &= (xyz @ self.center) > 0
+        xy = self.project(np.where(valid[:, None], xyz, self.center))
+        qx, qy = xy[:, 0], xy[:, 1]
+
+        xs = self._xs
+        slab = np.searchsorted(xs, qx, 'right') - 1
+        # Il bordo destro della regione appartiene all'ultima striscia
+        slab[(slab == len(xs) - 1) & (qx <= xs[-1] + _EPS)] = len(xs) - 2
+        valid &= (slab >= 0) & (slab < len(xs) - 1)
+        slab = np.where(valid, slab, 0)
+        x0, x1 = xs[slab], xs[slab + 1]
+        t = np.clip((qx - x0) / np.where(x1 > x0, x1 - x0, 1.0), 0.0, 1.0)
+
+        # Ultimo bordo inferiore sotto il punto, tra le voci [lo, hi) della striscia
+        lo, hi = self._slab_start[slab].copy(), self._slab_start[slab + 1].copy()
+        first = lo.copy()
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            m = np.minimum(mid, len(self._cell) - 1)
+            below = self._lower[m, 0] + t * (self._lower[m, 1] - self._lower[m, 0]) <= qy + _EPS
+            lo = np.where(active & below, mid + 1, lo)
+            hi = np.where(active & ~below, mid, hi)
+        entry = lo - 1
+        valid &= entry >= first
+        entry = np.where(valid, entry, 0)
+        top = self._upper[entry, 0] + t * (self._upper[entry, 1] - self._upper[entry, 0])
+        valid &= qy <= top + _EPS
+        result[valid] = self._cell[entry[valid]]
+        return result
+
+    def locate(self, lat: float, lon: float) -> Optional[Tuple[float, int]]:
+        """
+        Rifugio che serve il punto (fuori dalla regione: il rifugio più vicino, dal KD-tree).
+        @:return: Tuple (distanza in km, identificativo del rifugio) o None se non ci sono rifugi
+        """
+        cell = self.locate_cell(lat, lon)
+        if cell is None:
+            found = self.tree.nearest(lat, lon)
+            if found is None:
+                return None
+            distance, cell = found
+            return distance, int(self.ids[cell])
+        chord = np.linalg.norm(to_unit_xyz(lat, lon)[0] - self.xyz[cell])
+        return float(chord_to_km(chord)), int(self.ids[cell])
+
+    def locate_batch(self, lat, lon) -> np.ndarray:
+        """
+        Identificativi dei rifugi che servono i punti (-1 per i punti non validi).
+        """
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel()
+        cells = self.locate_cells(lat, lon)
+        if not len(self.ids):
+            return cells
+        outside = np.flatnonzero(cells < 0)
+        if len(outside):
+            cells[outside] = self.tree.query_batch(lat[outside], lon[outside], k=1)[1][:, 0]
+        return np.where(cells >= 0, self.ids[np.maximum(cells, 0)], -1)
+
+    # --- GEOJSON ---
+    def polygon(self, cell: int) -> List[List[float]]:
+        """Anello chiuso [lon, lat] della cella, con i lati suddivisi ogni DENSIFY_KM."""
+        poly = self.cells[cell]
+        points = []
+        for a, b in zip(poly, np.roll(poly, -1, axis=0)):
+            ends = self.unproject(np.array([a, b]))
+            length = chord_to_km(np.linalg.norm(ends[0] - ends[1]))
+            steps = max(1, int(math.ceil(float(length) / DENSIFY_KM)))
+            t = np.arange(steps)[:, None] / steps
+            points.append(a + t * (b - a))
+        xyz = self.unproject(np.concatenate(points))
+        lat = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1.0, 1.0)))
+        lon = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0]))
+        ring = np.round(np.column_stack([lon, lat]), COORD_DECIMALS).tolist()
+        return ring + ring[:1]
+
+    def features(self, properties: Optional[Sequence[dict]] = None) -> List[dict]:
+        """
+        Feature GeoJSON delle celle.
+        @:param properties: Proprietà aggiuntive per cella (nell'ordine delle celle)
+        """
+        features = []
+        for cell in range(len(self.cells)):
+            props = {'rifugio_id': int(self.ids[cell]), 'Latitude': float(self.lat[cell]),
+                     'Longitude': float(self.lon[cell]), 'area_km2': round(self.area_km2(cell), 3)}
+            if properties is not None:
+                props.update(properties[cell])
+            features.append({'type': 'Feature', 'properties': props,
+                             'geometry': {'type': 'Polygon', 'coordinates': [self.polygon(cell)]}})
+        return features
+
+
+def _clip(poly: np.ndarray, halfplane: Tuple[float, float, float]) -> np.ndarray:
+    """Sutherland-Hodgman: parte del poligono convesso con a*x + b*y + d >= 0."""
+    a, b, d = halfplane
+    side = poly[:, 0] * a + poly[:, 1] * b + d
+    if (side >= 0).all():
+        return poly
+    if (side < 0).all():
+        return poly[:0]
+    out = []
+    for k in range(len(poly)):
+        nxt = (k + 1) % len(poly)
+        if side[k] >= 0:
+            out.append(poly[k])
+        if (side[k] > 0 > side[nxt]) or (side[k] < 0 < side[nxt]):
+            t = side[k] / (side[k] - side[nxt])
+            out.append(poly[k] + t * (poly[nxt] - poly[k]))
+    return np.array(out)
+
+
+def _chains(poly: np.ndarray) -> Tuple[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """
+    Catena inferiore e superiore di un poligono convesso antiorario, come (x crescenti, y)
+    per np.interp.
+    """
+    n = len(poly)
+    x, y = poly[:, 0], poly[:, 1]
+
+    def walk(start, end):
+        idx = [start]
+        while idx[-1] != end:
+            idx.append((idx[-1] + 1) % n)
+        return np.array(idx)
+
+    left, right = x.min(), x.max()
+    left_low = min(np.flatnonzero(x == left), key=lambda k: y[k])
+    left_high = max(np.flatnonzero(x == left), key=lambda k: y[k])
+    right_low = min(np.flatnonzero(x == right), key=lambda k: y[k])
+    right_high = max(np.flatnonzero(x == right), key=lambda k: y[k])
+    # In senso antiorario la catena inferiore va da sinistra a destra, quella superiore al contrario
+    low = walk(left_low, right_low)
+    high = walk(right_high, left_high)[::-1]
+    return (x[low], y[low]), (x[high], y[high])
+
+
+# ==============================================================================
+# PARTIZIONE DEL DATASET DEI RIFUGI
+# ==============================================================================
+
+class ServiceAreaLayer:
+    """
+    Partizione calcolata da una versione del CSV dei rifugi, con il GeoJSON precompresso.
+    @:param path: Percorso del CSV
+    @:param signature: (mtime_ns, dimensione) del file al momento della lettura
+    @:param rifugi: DataFrame dei rifugi
+    """
+
+    def __init__(self, path: Path, signature: Tuple[int, int], rifugi: pd.DataFrame):
+        self.path = path
+        self.signature = signature
+        self.rifugi = rifugi
+        lat = pd.to_numeric(rifugi['Latitude'], errors='coerce').to_numpy(dtype=float)
+        lon = pd.to_numeric(rifugi['Longitude'], errors='coerce').to_numpy(dtype=float)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        # Gli identificativi sono le posizioni delle righe nel DataFrame (come per l'indice dei rifugi)
+        self.areas = ServiceAreas(lat[valid], lon[valid], ids=np.flatnonzero(valid))
+
+        columns = [c for c in PROPERTIES if c in rifugi.columns]
+        properties = [{c: _json_value(rifugi[c].iat[i]) for c in columns} for i in self.areas.ids]
+        collection = {'type': 'FeatureCollection', 'features': self.areas.features(properties)}
+        raw = json.dumps(collection, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.payload = Precompressed(raw).precompute()
+        self.version = self.payload.etags['identity'].strip('"')
+
+    def locate(self, lat: float, lon: float) -> Optional[Tuple[float, pd.Series]]:
+        """
+        Rifugio che serve il punto (vedi ServiceAreas.locate).
+        @:return: Tuple (distanza in km, riga del rifugio) o None se non ci sono rifugi
+        """
+        found = self.areas.locate(lat, lon)
+        if found is None:
+            return None
+        distance, row = found
+        return distance, self.rifugi.iloc[row]
+
+
+def _json_value(value):
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ServiceAreaStore:
+    """
+    Partizione del CSV dei rifugi, ricalcolata quando il file cambia.
+    @:param path: Percorso del CSV dei rifugi
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._layer: Optional[ServiceAreaLayer] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[ServiceAreaLayer]:
+        """
+        @:return: ServiceAreaLayer della versione corrente del file o None se il file non esiste
+        """
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        layer = self._layer
+        if layer is not None and layer.signature == signature:
+            return layer
+
+        with self._lock:
+            layer = self._layer
+            if layer is None or layer.signature != signature:
+                layer = ServiceAreaLayer(self.path, signature, DATASETS.read(self.path))
+                self._layer = layer
+        return layer
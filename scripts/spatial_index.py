@@ -0,0 +1,258 @@
+import heapq
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Indice spaziale per ricerche di prossimità su coordinate geografiche.
+# I punti (lat, lon) vengono proiettati sulla sfera unitaria come vettori 3D:
+# su questi la distanza euclidea (corda) è monotona rispetto alla distanza
+# ortodromica, quindi un semplice KD-tree in 3 dimensioni restituisce gli
+# stessi vicini della formula di Haversine, senza dover calcolare la distanza
+# verso tutti i punti ad ogni richiesta.
+
+# Raggio della Terra in km (lo stesso usato da haversine_distance)
+EARTH_RADIUS_KM = 6371.0
+# Oltre questo numero di punti query_batch visita l'albero punto per punto invece di
+# confrontare ogni blocco di richieste con tutti i punti
+BATCH_BRUTE_FORCE_MAX = 20000
+# Elementi massimi della matrice richieste x punti calcolata da query_batch per ogni blocco
+BATCH_MATRIX_MAX = 4_000_000
+
+
+def to_unit_xyz(lat, lon) -> np.ndarray:
+    """
+    Converte coordinate geografiche in vettori 3D sulla sfera unitaria.
+    @:param lat: Latitudine (scalare o array) in gradi
+    @:param lon: Longitudine (scalare o array) in gradi
+    @:return: Array (n, 3) di coordinate cartesiane
+    """
+    phi = np.radians(np.asarray(lat, dtype=float))
+    lam = np.radians(np.asarray(lon, dtype=float))
+    cos_phi = np.cos(phi)
+    return np.column_stack([
+        np.atleast_1d(cos_phi * np.cos(lam)),
+        np.atleast_1d(cos_phi * np.sin(lam)),
+        np.atleast_1d(np.sin(phi)),
+    ])
+
+
+def chord_to_km(chord) -> np.ndarray:
+    """Converte la lunghezza di una corda sulla sfera unitaria in km sulla superficie."""
+    chord = np.clip(np.asarray(chord, dtype=float), 0.0, 2.0)
+    return EARTH_RADIUS_KM * 2.0 * np.arcsin(chord / 2.0)
+
+
+def km_to_chord(km: float) -> float:
+    """Converte una distanza in km sulla superficie nella corda equivalente sulla sfera unitaria."""
+    theta = min(max(float(km), 0.0) / EARTH_RADIUS_KM, np.pi)
+    return float(2.0 * np.sin(theta / 2.0))
+
+
+class SphericalKDTree:
+    """
+    KD-tree su coordinate geografiche proiettate sulla sfera unitaria.
+    Viene costruito una sola volta e permette di rispondere in tempo logaritmico
+    alle richieste di vicino più prossimo, k vicini e punti entro un raggio.
+    Gli indici restituiti sono gli identificativi passati in `ids` oppure, se assenti,
+    le posizioni dei punti negli array passati al costruttore.
+    """
+
+    def __init__(self, lat: Sequence[float], lon: Sequence[float], ids: Optional[Sequence[int]] = None, leaf_size: int = 32):
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel()
+        if lat.shape != lon.shape:
+            raise ValueError("Latitudine e longitudine devono avere la stessa lunghezza.")
+        if not (np.isfinite(lat).all() and np.isfinite(lon).all()):
+            raise ValueError("Coordinate non valide (NaN o infinito) nell'indice spaziale.")
+
+        self.leaf_size = max(1, int(leaf_size))
+        self.lat = lat
+        self.lon = lon
+        self.xyz = to_unit_xyz(lat, lon) if len(lat) else np.empty((0, 3))
+        self.ids = np.arange(len(lat)) if ids is None else np.asarray(ids, dtype=np.intp).ravel()
+        if len(self.ids) != len(lat):
+            raise ValueError("Il numero di identificativi non corrisponde al numero di punti.")
+        self._build()
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    # --- COSTRUZIONE ---
+    def _build(self):
+        n = len(self.lat)
+        perm = np.arange(n)
+        starts, ends, lefts, rights, los, his = [], [], [], [], [], []
+
+        def new_node(start, end):
+            pts = self.xyz[perm[start:end]]
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            los.append(pts.min(axis=0) if end > start else np.zeros(3))
+            his.append(pts.max(axis=0) if end > start else np.zeros(3))
+            return len(starts) - 1
+
+        # Costruzione iterativa: ogni nodo viene diviso sulla mediana della dimensione più estesa
+        stack = [new_node(0, n)]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= self.leaf_size:
+                continue
+            dim = int(np.argmax(his[node] - los[node]))
+            mid = (start + end) // 2
+            segment = perm[start:end]
+            order = np.argpartition(self.xyz[segment, dim], mid - start)
+            perm[start:end] = segment[order]
+            left = new_node(start, mid)
+            right = new_node(mid, end)
+            lefts[node], rights[node] = left, right
+            stack.extend((left, right))
+
+        self._perm = perm
+        self._start = np.asarray(starts, dtype=np.intp)
+        self._end = np.asarray(ends, dtype=np.intp)
+        # I bounding box sono tenuti anche come liste Python: per 3 dimensioni
+        # l'aritmetica scalare è più rapida di numpy su array così piccoli
+        self._lo = [tuple(b) for b in np.asarray(los, dtype=float).reshape(-1, 3).tolist()]
+        self._hi = [tuple(b) for b in np.asarray(his, dtype=float).reshape(-1, 3).tolist()]
+        self._children = [(l, r) for l, r in zip(lefts, rights)]
+
+    def _box_dist2(self, node: int, q: Tuple[float, float, float]) -> float:
+        # Distanza (al quadrato) minima tra il punto e il bounding box del nodo
+        total = 0.0
+        for qi, lo, hi in zip(q, self._lo[node], self._hi[node]):
+            if qi < lo:
+                total += (lo - qi) ** 2
+            elif qi > hi:
+                total += (qi - hi) ** 2
+        return total
+
+    # --- INTERROGAZIONI ---
+    def query(self, lat: float, lon: float, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Restituisce i k punti più vicini a (lat, lon), ordinati per distanza crescente.
+        @:param lat: Latitudine del punto di ricerca
+        @:param lon: Longitudine del punto di ricerca
+        @:param k: Numero di vicini richiesti
+        @:return: Tuple (distanze in km, identificativi dei punti)
+        """
+        k = min(int(k), len(self))
+        if k <= 0:
+            return np.empty(0), np.empty(0, dtype=np.intp)
+
+        q = to_unit_xyz(lat, lon)[0]
+        q_t = tuple(q.tolist())
+        best_d2 = np.empty(0)
+        best_idx = np.empty(0, dtype=np.intp)
+        heap = [(0.0, 0)]
+        while heap:
+            d2, node = heapq.heappop(heap)
+            if len(best_d2) == k and d2 > best_d2[-1]:
+                break
+            left, right = self._children[node]
+            if left == -1:
+                pts = self._perm[self._start[node]:self._end[node]]
+                diff = self.xyz[pts] - q
+                cand_d2 = np.concatenate([best_d2, np.einsum('ij,ij->i', diff, diff)])
+                cand_idx = np.concatenate([best_idx, pts])
+                order = np.argsort(cand_d2, kind='stable')[:k]
+                best_d2, best_idx = cand_d2[order], cand_idx[order]
+            else:
+                heapq.heappush(heap, (self._box_dist2(left, q_t), left))
+                heapq.heappush(heap, (self._box_dist2(right, q_t), right))
+
+        return chord_to_km(np.sqrt(best_d2)), self.ids[best_idx]
+
+    def nearest(self, lat: float, lon: float) -> Optional[Tuple[float, int]]:
+        """
+        Restituisce il punto più vicino a (lat, lon).
+        @:return: Tuple (distanza in km, identificativo del punto) o None se l'indice è vuoto
+        """
+        dist, idx = self.query(lat, lon, k=1)
+        if len(idx) == 0:
+            return None
+        return float(dist[0]), int(idx[0])
+
+    def query_radius(self, lat: float, lon: float, radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Restituisce tutti i punti entro radius_km da (lat, lon), ordinati per distanza crescente.
+        @:param radius_km: Raggio di ricerca in chilometri
+        @:return: Tuple (distanze in km, identificativi dei punti)
+        """
+        if len(self) == 0 or radius_km < 0:
+            return np.empty(0), np.empty(0, dtype=np.intp)
+
+        q = to_unit_xyz(lat, lon)[0]
+        q_t = tuple(q.tolist())
+        r2 = km_to_chord(radius_km) ** 2
+        found_d2: List[np.ndarray] = []
+        found_idx: List[np.ndarray] = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._box_dist2(node, q_t) > r2:
+                continue
+            left, right = self._children[node]
+            if left == -1:
+                pts = self._perm[self._start[node]:self._end[node]]
+                diff = self.xyz[pts] - q
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                mask = d2 <= r2
+                found_d2.append(d2[mask])
+                found_idx.append(pts[mask])
+            else:
+                stack.extend((left, right))
+
+        if not found_idx:
+            return np.empty(0), np.empty(0, dtype=np.intp)
+        d2 = np.concatenate(found_d2)
+        idx = np.concatenate(found_idx)
+        order = np.argsort(d2, kind='stable')
+        return chord_to_km(np.sqrt(d2[order])), self.ids[idx[order]]
+
+    def query_batch(self, lat, lon, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Restituisce i k punti più vicini a ciascuna delle coordinate indicate, in modo vettoriale.
+        Con pochi punti indicizzati (es. i rifugi) ogni blocco di richieste viene confrontato con
+        tutti i punti con un prodotto matriciale (la corda minima è il prodotto scalare massimo);
+        con molti punti ogni richiesta visita l'albero come query().
+        @:param lat: Array di latitudini (NaN per le richieste senza coordinate)
+        @:param lon: Array di longitudini
+        @:param k: Numero di vicini per richiesta
+        @:return: Tuple (distanze in km, identificativi), entrambi di forma (n, k) ordinati per
+                  distanza crescente; NaN e -1 per le richieste non valide
+        """
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel()
+        k = min(int(k), len(self))
+        dist = np.full((len(lat), max(k, 0)), np.nan)
+        ids = np.full((len(lat), max(k, 0)), -1, dtype=np.intp)
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        if k <= 0 or not len(valid):
+            return dist, ids
+
+        if len(self) > BATCH_BRUTE_FORCE_MAX:
+            for i in valid:
+                d, found = self.query(lat[i], lon[i], k)
+                dist[i], ids[i] = d, found
+            return dist, ids
+
+        block_size = max(1, BATCH_MATRIX_MAX // len(self))
+        for start in range(0, len(valid), block_size):
+            rows = valid[start:start + block_size]
+            q = to_unit_xyz(lat[rows], lon[rows])
+            dot = q @ self.xyz.T
+            if k < len(self):
+                best = np.argpartition(-dot, k - 1, axis=1)[:, :k]
+            else:
+                best = np.broadcast_to(np.arange(len(self)), (len(rows), k))
+            # Distanze esatte dei soli candidati (2 - 2*dot perde precisione sulle distanze brevi)
+            diff = self.xyz[best] - q[:, np.newaxis, :]
+            chord = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+            order = np.argsort(chord, axis=1, kind='stable')
+            best = np.take_along_axis(best, order, axis=1)
+            dist[rows] = chord_to_km(np.take_along_axis(chord, order, axis=1))
+            ids[rows] = self.ids[best]
+        return dist, ids
@@ -0,0 +1,162 @@
+import hashlib
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from scripts.dataset_store import file_sha256
+from scripts.precompressed import Precompressed
+
+# Manifest dei file statici del front-end, costruito una sola volta all'avvio del server.
+# Ogni file delle cartelle del front-end ha due URL:
+#   - l'URL originale (es. /css/styles.css), servito con revalidazione (ETag, Cache-Control: no-cache);
+#   - un URL con l'impronta del contenuto (es. /css/styles.3f2a9c1b0d.css), servito con
+#     Cache-Control immutable: il browser lo tiene in cache senza più chiedere al server.
+# Nei file HTML, CSS e JS i riferimenti ad altri file del manifest vengono riscritti con gli URL
+# con impronta (l'impronta di un file che ne riferisce altri è calcolata dopo la riscrittura, quindi
+# cambia quando cambia un file riferito). index.html resta all'URL originale e rimanda ai file
+# con impronta.
+# I file fino a MEMORY_MAX byte restano in memoria, con le varianti gzip/brotli calcolate all'avvio
+# per i tipi comprimibili: servirli non richiede alcuna chiamata al filesystem. I file più grandi
+# (es. GIF animate) vengono letti dal disco dal percorso già risolto.
+# Le modifiche ai file del front-end sono visibili al riavvio del server.
+
+# Dimensione massima dei file tenuti in memoria (byte)
+MEMORY_MAX = 512 * 1024
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+# Lunghezza dell'impronta (caratteri esadecimali dello SHA-256)
+HASH_LENGTH = 10
+# File in cui si riscrivono i riferimenti, nell'ordine di elaborazione (i CSS prima di chi li include)
+REWRITE_ORDER = ('.css', '.js', '.html', '.htm')
+
+# Riferimenti a file locali tra apici o in url(...): percorso senza schema, query o frammento
+_REFERENCE = re.compile(r"""(?P<open>["'(])(?P<ref>[^"'()\s?#:]+\.[A-Za-z0-9]{1,5})(?=["')])""")
+
+
+def is_compressible(mimetype: str) -> bool:
+    return (mimetype.startswith('text/') or mimetype.endswith(('javascript', 'json', 'xml'))
+            or mimetype == 'image/svg+xml')
+
+
+def fingerprint_url(url: str, digest: str) -> str:
+    """/css/styles.css -> /css/styles.<impronta>.css"""
+    stem, ext = posixpath.splitext(url)
+    return f"{stem}.{digest[:HASH_LENGTH]}{ext}"
+
+
+class Asset:
+    """
+    File statico del manifest.
+    @:param url: URL originale (es. /css/styles.css)
+    @:param path: Percorso del file su disco
+    @:param mimetype: Content-Type
+    @:param data: Contenuto (eventualmente riscritto); None per i file serviti dal disco
+    @:param digest: SHA-256 del contenuto servito
+    """
+
+    def __init__(self, url: str, path: Path, mimetype: str, data: Optional[bytes], digest: str):
+        self.url = url
+        self.path = path
+        self.mimetype = mimetype
+        self.digest = digest
+        self.hashed_url = fingerprint_url(url, digest)
+        self.etag = f'"{digest[:20]}"'
+        self.compressible = is_compressible(mimetype)
+        self.payload: Optional[Precompressed] = None
+        if data is not None:
+            self.payload = Precompressed(data)
+            if self.compressible:
+                self.payload.precompute()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.payload is not None
+
+
+class AssetManifest:
+    """
+    URL -> file statico, per una o più cartelle radice (la prima che contiene un percorso vince).
+    @:param roots: Cartelle del front-end
+    @:param document_url: URL della pagina in cui vengono eseguiti gli script (per risolvere i
+                          percorsi relativi scritti nel JS e nell'HTML)
+    @:param memory_max: Dimensione massima dei file tenuti in memoria
+    """
+
+    def __init__(self, roots: Iterable[Optional[str]] = (), document_url: str = '/', memory_max: int = MEMORY_MAX):
+        self.document_url = document_url
+        self.memory_max = memory_max
+        self.assets: Dict[str, Asset] = {}
+        # URL (originale o con impronta) -> (file, immutabile)
+        self._routes: Dict[str, Tuple[Asset, bool]] = {}
+        self._build([Path(r) for r in roots if r])
+
+    # --- COSTRUZIONE ---
+    def _build(self, roots: List[Path]):
+        files: Dict[str, Path] = {}
+        for root in roots:
+            if not root.is_dir():
+                continue
+            for path in sorted(root.rglob('*')):
+                if path.is_file() and not any(part.startswith('.') for part in path.relative_to(root).parts):
+                    files.setdefault('/' + path.relative_to(root).as_posix(), path.resolve())
+
+        def order(item):
+            ext = posixpath.splitext(item[0])[1].lower()
+            return (REWRITE_ORDER.index(ext) + 1 if ext in REWRITE_ORDER else 0), item[0]
+
+        for url, path in sorted(files.items(), key=order):
+            self._add(url, path)
+
+    def _add(self, url: str, path: Path):
+        mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/') or mimetype.endswith('javascript'):
+            mimetype += '; charset=utf-8'
+        ext = posixpath.splitext(url)[1].lower()
+        if ext in REWRITE_ORDER:
+            data = self._rewrite(path.read_bytes(), url, ext)
+        elif path.stat().st_size <= self.memory_max:
+            data = path.read_bytes()
+        else:
+            data = None
+        digest = hashlib.sha256(data).hexdigest() if data is not None else file_sha256(path)
+        asset = Asset(url, path, mimetype, data if data is None or len(data) <= self.memory_max else None, digest)
+        self.assets[url] = asset
+        self._routes[url] = (asset, False)
+        self._routes[asset.hashed_url] = (asset, True)
+
+    def _rewrite(self, data: bytes, url: str, ext: str) -> bytes:
+        """Sostituisce i riferimenti ai file già nel manifest con i loro URL con impronta."""
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data
+        # Nei CSS i percorsi sono relativi al file stesso, negli script e nell'HTML alla pagina
+        base = posixpath.dirname(url) if ext == '.css' else posixpath.dirname(self.document_url)
+
+        def replace(match):
+            ref = match.group('ref')
+            target = posixpath.normpath(posixpath.join(base or '/', ref))
+            asset = self.assets.get(target)
+            if asset is None or target == url:
+                return match.group(0)
+            return match.group('open') + asset.hashed_url
+
+        return _REFERENCE.sub(replace, text).encode('utf-8')
+
+    # --- API ---
+    def lookup(self, url: str) -> Optional[Tuple[Asset, bool]]:
+        """
+        @:param url: Percorso richiesto (es. /css/styles.css)
+        @:return: Tuple (file, True se l'URL ha l'impronta) o None se non è nel manifest
+        """
+        return self._routes.get(url)
+
+    def mapping(self) -> Dict[str, str]:
+        """URL originale -> URL con impronta."""
+        return {url: asset.hashed_url for url, asset in self.assets.items()}
+
+    def __len__(self) -> int:
+        return len(self.assets)
+
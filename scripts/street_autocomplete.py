@@ -0,0 +1,371 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from scripts.spatial_index import chord_to_km, to_unit_xyz
+
+# Indice per l'autocompletamento dei nomi delle strade.
+# Viene costruito una sola volta all'avvio del server a partire da STREET_NAMES e contiene:
+#   1. un indice ordinato delle chiavi (display e nome in minuscolo) per le ricerche per prefisso;
+#   2. un indice invertito a trigrammi (trigramma -> strade che lo contengono) per le ricerche
+#      per sottostringa;
+#   3. per le query di 1-2 caratteri, le prime strade (in ordine di caricamento) che contengono
+#      ciascun unigramma/bigramma, in modo che anche le query cortissime non scorrano tutta la lista.
+# Gli n-grammi sono calcolati in modo vettoriale con numpy, così l'indice resta rapido da
+# costruire anche con milioni di strade.
+# Ordinamento dei risultati: prima i match per prefisso (in ordine alfabetico della chiave),
+# poi i match per sottostringa (nell'ordine originale di STREET_NAMES).
+# Se i match esatti non bastano (es. "Anahiem"), la ricerca approssimata raccoglie i candidati dagli
+# stessi indici: le varianti della query con un errore (come in SymSpell) cercate per prefisso, e
+# per le query lunghe le voci che condividono più trigrammi con la query (scorrendo al massimo
+# FUZZY_SCAN_BUDGET voci delle posting list, dalle più rare). I candidati sono ordinati per distanza
+# di edit (con trasposizioni) tra la query e l'inizio del testo della voce. Il lavoro per query è
+# limitato indipendentemente dalla dimensione dell'indice, così la ricerca può girare ad ogni tasto.
+# Con una posizione (lat, lon) i candidati (fino a LOCATION_POOL * limit) vengono riordinati
+# sommando al costo del match (prefisso < sottostringa < approssimato) un termine di distanza.
+
+NGRAM = 3
+DEFAULT_LIMIT = 20
+# Lunghezza minima della query per la ricerca approssimata
+FUZZY_MIN_LEN = 4
+# Voci delle posting list esaminate al massimo per query nella ricerca approssimata
+FUZZY_SCAN_BUDGET = 50_000
+# Candidati (quelli con più trigrammi in comune) su cui si calcola la distanza di edit
+FUZZY_CANDIDATES = 256
+# Candidati considerati (in multipli di limit) quando i risultati vengono ordinati per distanza
+LOCATION_POOL = 5
+# Oltre questa distanza (km) la vicinanza non cambia più l'ordinamento
+LOCATION_RADIUS_KM = 30.0
+# Peso della distanza rispetto al costo del match: una strada vicina che contiene la query
+# può precedere una lontana che inizia con la query, ma non un match esatto vicino
+LOCATION_WEIGHT = 1.5
+# Costo dei match: prefisso, sottostringa; i match approssimati costano 1 + errori
+_COST_PREFIX = 0.0
+_COST_CONTAINS = 1.0
+# Bit per carattere nella codifica intera degli n-grammi (codepoint Unicode < 2^21)
+_CHAR_BITS = 21
+
+
+def _gram_code(gram: str) -> int:
+    """Codifica un n-gramma (n <= 3) come intero, come fa _gram_pairs in modo vettoriale."""
+    code = 0
+    for ch in gram:
+        code = (code << _CHAR_BITS) | ord(ch)
+    return code
+
+
+def _gram_pairs(codepoints: np.ndarray, owners: np.ndarray, n: int):
+    """
+    Calcola in modo vettoriale le coppie (n-gramma, voce) distinte, ordinate per n-gramma e voce.
+    @:param codepoints: Codepoint dei testi concatenati, separati da 0
+    @:param owners: Indice della voce a cui appartiene ciascun carattere
+    @:param n: Lunghezza degli n-grammi
+    @:return: Tuple (codici degli n-grammi, indici delle voci)
+    """
+    size = len(codepoints) - n + 1
+    if size <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int32)
+    codes = codepoints[:size].copy()
+    valid = codes != 0
+    for j in range(1, n):
+        shifted = codepoints[j:j + size]
+        codes = (codes << np.uint64(_CHAR_BITS)) | shifted
+        valid &= shifted != 0
+    codes, ids = codes[valid], owners[:size][valid]
+
+    # Le voci sono già in ordine crescente: un ordinamento stabile sui soli codici
+    # lascia ordinati anche gli indici all'interno di ciascun n-gramma
+    order = np.argsort(codes, kind='stable')
+    codes, ids = codes[order], ids[order]
+    keep = np.ones(len(codes), dtype=bool)
+    keep[1:] = (codes[1:] != codes[:-1]) | (ids[1:] != ids[:-1])
+    return codes[keep], ids[keep]
+
+
+def _group_bounds(codes: np.ndarray):
+    """Restituisce (codici distinti, inizi, fini) dei gruppi di valori uguali di un array ordinato."""
+    if len(codes) == 0:
+        return [], [], []
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    return codes[starts].tolist(), starts.tolist(), ends.tolist()
+
+
+def max_edits(length: int) -> int:
+    """Errori ammessi nella ricerca approssimata per una query della lunghezza indicata."""
+    if length < FUZZY_MIN_LEN:
+        return 0
+    return 1 if length < 7 else 2
+
+
+def prefix_edit_distance(query: str, targets: Sequence[str], max_dist: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Distanza di edit (inserimenti, cancellazioni, sostituzioni e trasposizioni di caratteri
+    adiacenti) tra la query e il prefisso più simile di ciascun testo, calcolata in modo
+    vettoriale su tutti i testi.
+    @:param query: Testo digitato
+    @:param targets: Testi candidati
+    @:param max_dist: Errori massimi considerati (i prefissi più lunghi di len(query) + max_dist sono ignorati)
+    @:return: Tuple (distanze, lunghezza del prefisso più simile) come array di int
+    """
+    n, width = len(query), len(query) + max_dist
+    if not targets:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    if n == 0:
+        return np.zeros(len(targets), dtype=np.int32), np.zeros(len(targets), dtype=np.int32)
+    # Testi troncati a `width` caratteri, come matrice di codepoint (0 = oltre la fine del testo)
+    padded = [t[:width].ljust(width, '\x00') for t in targets]
+    chars = np.frombuffer(''.join(padded).encode('utf-32-le'), dtype=np.uint32).reshape(len(targets), width)
+    lengths = np.fromiter((min(len(t), width) for t in targets), dtype=np.int32, count=len(targets))
+    q = np.frombuffer(query.encode('utf-32-le'), dtype=np.uint32)
+
+    # Riga i della matrice: distanza tra query[:i] e ciascun prefisso target[:j], j = 0..width
+    prev2 = None
+    prev = np.tile(np.arange(width + 1, dtype=np.int32), (len(targets), 1))
+    for i in range(1, n + 1):
+        diff = (chars != q[i - 1]).astype(np.int32)
+        base = np.minimum(prev[:, :-1] + diff, prev[:, 1:] + 1)
+        if prev2 is not None and width > 1:
+            swap = (chars[:, 1:] == q[i - 2]) & (chars[:, :-1] == q[i - 1])
+            base[:, 1:] = np.where(swap, np.minimum(base[:, 1:], prev2[:, :-2] + 1), base[:, 1:])
+        cur = np.empty_like(prev)
+        cur[:, 0] = i
+        for j in range(1, width + 1):
+            cur[:, j] = np.minimum(base[:, j - 1], cur[:, j - 1] + 1)
+        prev2, prev = prev, cur
+    # Solo i prefissi che esistono davvero (j <= lunghezza del testo)
+    valid = np.arange(width + 1) <= lengths[:, None]
+    dist = np.where(valid, prev, np.iinfo(np.int32).max)
+    best = dist.argmin(axis=1)
+    return dist[np.arange(len(targets)), best], best
+
+
+class StreetAutocomplete:
+    """
+    Indice di autocompletamento sui dizionari prodotti da load_street_names().
+    @:param entries: Lista di dict con almeno le chiavi 'name' e 'display'
+    @:param limit: Numero massimo di suggerimenti per query
+    """
+
+    def __init__(self, entries: List[dict], limit: int = DEFAULT_LIMIT):
+        self.entries = entries
+        self.limit = limit
+
+        # Ogni voce ha un testo di ricerca in minuscolo: display, più il nome se non già contenuto
+        self._texts: List[str] = []
+        prefix_keys = []
+        for idx, s in enumerate(entries):
+            display = (s.get('display') or '').lower().replace('\x00', '')
+            name = (s.get('name') or '').lower().replace('\x00', '')
+            self._texts.append(display if name in display else f"{display}\n{name}")
+            prefix_keys.append((display, idx))
+            if name and not display.startswith(name):
+                prefix_keys.append((name, idx))
+
+        prefix_keys.sort()
+        self._prefix_keys = [k for k, _ in prefix_keys]
+        self._prefix_ids = [i for _, i in prefix_keys]
+        self._build_ngrams()
+
+        # Posizioni delle strade (NaN se mancanti) per l'ordinamento per distanza
+        lat = np.array([s.get('lat') for s in entries], dtype=float).reshape(-1)
+        lon = np.array([s.get('lon') for s in entries], dtype=float).reshape(-1)
+        self._xyz = to_unit_xyz(lat, lon) if len(entries) else np.empty((0, 3))
+
+    def _build_ngrams(self):
+        # Tutti i testi concatenati in un unico array di codepoint (0 come separatore)
+        joined = '\x00'.join(self._texts)
+        codepoints = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        lengths = np.fromiter((len(t) + 1 for t in self._texts), dtype=np.int64, count=len(self._texts))
+        owners = np.repeat(np.arange(len(self._texts), dtype=np.int32), lengths)[:len(codepoints)]
+
+        # Indice invertito a trigrammi: un unico array di indici, con un intervallo per trigramma.
+        # Le posting list risultano ordinate per indice della voce.
+        codes, ids = _gram_pairs(codepoints, owners, NGRAM)
+        self._posting_ids = ids
+        grams, starts, ends = _group_bounds(codes)
+        self._postings: Dict[int, tuple] = {g: (a, b) for g, a, b in zip(grams, starts, ends)}
+        self._alphabet = ''
+
+        # Query brevi: per ogni unigramma/bigramma solo le prime voci che lo contengono.
+        # Con al massimo `limit` match per prefisso da escludere, 2 * limit candidati bastano sempre.
+        short_cap = 2 * self.limit
+        self._short_tops: Dict[int, List[int]] = {}
+        for n in (1, 2):
+            codes, ids = _gram_pairs(codepoints, owners, n)
+            grams, starts, ends = _group_bounds(codes)
+            for g, a, b in zip(grams, starts, ends):
+                self._short_tops[g] = ids[a:min(b, a + short_cap)].tolist()
+            if n == 1:
+                # Caratteri presenti nei testi, dal più frequente: l'alfabeto delle varianti con un errore
+                by_count = np.argsort(-(np.asarray(ends) - np.asarray(starts)), kind='stable') if grams else []
+                self._alphabet = ''.join(chr(grams[i]) for i in by_count if chr(grams[i]) not in '\n\x00')
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # --- RICERCA ---
+    def _prefix_matches(self, q: str, limit: int) -> List[int]:
+        found = []
+        seen = set()
+        pos = bisect_left(self._prefix_keys, q)
+        while pos < len(self._prefix_keys) and len(found) < limit:
+            if not self._prefix_keys[pos].startswith(q):
+                break
+            idx = self._prefix_ids[pos]
+            if idx not in seen:
+                seen.add(idx)
+                found.append(idx)
+            pos += 1
+        return found
+
+    def _contains_candidates(self, q: str) -> Iterable[int]:
+        # Query brevi: liste precalcolate e già limitate
+        if len(q) < NGRAM:
+            return self._short_tops.get(_gram_code(q), [])
+
+        # Query lunghe: intersezione delle posting list dei trigrammi, partendo dalla più corta
+        lists = []
+        for gram in {q[i:i + NGRAM] for i in range(len(q) - NGRAM + 1)}:
+            bounds = self._postings.get(_gram_code(gram))
+            if bounds is None:
+                return []
+            lists.append(self._posting_ids[bounds[0]:bounds[1]])
+        lists.sort(key=len)
+        return self._intersect(lists[0], lists[1:])
+
+    @staticmethod
+    def _intersect(base: np.ndarray, others: List[np.ndarray], chunk: int = 512) -> Iterable[int]:
+        # Generatore a blocchi: si ferma appena il chiamante ha raccolto abbastanza risultati
+        for start in range(0, len(base), chunk):
+            block = base[start:start + chunk]
+            mask = np.ones(len(block), dtype=bool)
+            for other in others:
+                pos = np.searchsorted(other, block)
+                pos[pos >= len(other)] = len(other) - 1
+                mask &= other[pos] == block
+            yield from block[mask].tolist()
+
+    def _one_edit_candidates(self, q: str, per_variant: int) -> set:
+        """
+        Voci che iniziano con una variante della query a un errore di distanza (cancellazione,
+        trasposizione, sostituzione o inserimento di un carattere), cercate sull'indice per prefisso.
+        """
+        variants = {q[:i] + q[i + 1:] for i in range(len(q))}
+        variants.update(q[:i] + q[i + 1] + q[i] + q[i + 2:] for i in range(len(q) - 1))
+        for i in range(len(q)):
+            for ch in self._alphabet:
+                variants.add(q[:i] + ch + q[i + 1:])
+                variants.add(q[:i] + ch + q[i:])
+        variants.discard(q)
+        found = set()
+        for variant in variants:
+            found.update(self._prefix_matches(variant, per_variant))
+        return found
+
+    def _trigram_candidates(self, q: str, edits: int) -> List[int]:
+        """Voci con più trigrammi in comune con la query (al più FUZZY_CANDIDATES)."""
+        lists = []
+        for gram in {q[i:i + NGRAM] for i in range(len(q) - NGRAM + 1)}:
+            bounds = self._postings.get(_gram_code(gram))
+            if bounds is not None:
+                lists.append(self._posting_ids[bounds[0]:bounds[1]])
+        if not lists:
+            return []
+
+        # Posting list dalle più rare (le più selettive), fino al budget di voci esaminate
+        lists.sort(key=len)
+        budget, chosen = FUZZY_SCAN_BUDGET, []
+        for ids in lists:
+            if chosen and len(ids) > budget:
+                break
+            chosen.append(ids[:budget])
+            budget -= len(chosen[-1])
+        ids, shared = np.unique(np.concatenate(chosen), return_counts=True)
+
+        # Ogni errore fa perdere al più NGRAM trigrammi della query
+        keep = shared >= max(1, len(chosen) - NGRAM * edits)
+        ids, shared = ids[keep], shared[keep]
+        if len(ids) > FUZZY_CANDIDATES:
+            ids = ids[np.argpartition(-shared, FUZZY_CANDIDATES)[:FUZZY_CANDIDATES]]
+        return ids.tolist()
+
+    def _fuzzy_matches(self, q: str, exclude: set, limit: int) -> List[Tuple[int, int]]:
+        """
+        Ricerca approssimata: varianti a un errore sull'indice per prefisso (ricerca esatta per
+        un errore) e, per due errori, candidati dall'indice a trigrammi.
+        @:return: Lista di (indice, errori) ordinata per errori
+        """
+        edits = max_edits(len(q))
+        if edits == 0 or limit <= 0:
+            return []
+        candidates = self._one_edit_candidates(q, limit)
+        if edits > 1:
+            candidates.update(self._trigram_candidates(q, edits))
+        ids = sorted(candidates - exclude)
+
+        # Distanza dall'inizio del display (o del nome, se il display non lo contiene)
+        targets = [self._texts[i].split('\n')[-1] for i in ids]
+        dist, matched = prefix_edit_distance(q, targets, edits)
+        # A parità di errori, prima le voci il cui prefisso simile è lungo quanto la query
+        found = [(i, d, abs(m - len(q))) for i, d, m in zip(ids, dist.tolist(), matched.tolist()) if d <= edits]
+        found.sort(key=lambda item: (item[1], item[2]))
+        return [(i, d) for i, d, _ in found[:limit]]
+
+    def _distances_km(self, ids: List[int], lat: float, lon: float) -> np.ndarray:
+        chord = np.linalg.norm(self._xyz[ids] - to_unit_xyz(lat, lon)[0], axis=1)
+        km = chord_to_km(chord)
+        return np.where(np.isnan(km), LOCATION_RADIUS_KM, km)
+
+    def search(self, q: str, limit: int = None, lat: Optional[float] = None, lon: Optional[float] = None,
+               fuzzy: bool = True) -> List[int]:
+        """
+        Restituisce gli indici (in `entries`) delle strade che corrispondono alla query.
+        @:param q: Testo digitato dall'utente
+        @:param limit: Numero massimo di risultati (default: quello dell'indice)
+        @:param lat: Latitudine dell'utente (opzionale): favorisce le strade vicine
+        @:param lon: Longitudine dell'utente (opzionale)
+        @:param fuzzy: Se True, completa i risultati con i match approssimati (errori di battitura)
+        @:return: Lista di indici ordinata per rilevanza
+        """
+        q = (q or '').strip().lower()
+        limit = self.limit if limit is None else min(limit, self.limit)
+        if not q or limit <= 0:
+            return []
+        located = lat is not None and lon is not None and len(self._xyz) > 0
+        wanted = LOCATION_POOL * limit if located else limit
+
+        results = self._prefix_matches(q, wanted)
+        costs = [_COST_PREFIX] * len(results)
+        seen = set(results)
+        if len(results) < wanted:
+            for idx in self._contains_candidates(q):
+                if idx not in seen and q in self._texts[idx]:
+                    seen.add(idx)
+                    results.append(idx)
+                    costs.append(_COST_CONTAINS)
+                    if len(results) >= wanted:
+                        break
+        if fuzzy and len(results) < limit:
+            for idx, errors in self._fuzzy_matches(q, seen, wanted - len(results)):
+                results.append(idx)
+                costs.append(1.0 + errors)
+
+        if located and results:
+            km = self._distances_km(results, lat, lon)
+            score = np.asarray(costs) + LOCATION_WEIGHT * np.minimum(km, LOCATION_RADIUS_KM) / LOCATION_RADIUS_KM
+            results = [results[i] for i in np.argsort(score, kind='stable')]
+        return results[:limit]
+
+    def suggest(self, q: str, limit: int = None, lat: Optional[float] = None,
+                lon: Optional[float] = None) -> List[dict]:
+        """
+        Restituisce i dizionari delle strade suggerite per la query.
+        @:param q: Testo digitato dall'utente
+        @:param limit: Numero massimo di risultati
+        @:param lat: Latitudine dell'utente (opzionale)
+        @:param lon: Longitudine dell'utente (opzionale)
+        @:return: Lista di dict nel formato di load_street_names()
+        """
+        return [self.entries[i] for i in self.search(q, limit, lat, lon)]
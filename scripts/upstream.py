@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Optional, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Chiamate ai servizi esterni (Nominatim) fuori dai thread che servono le richieste HTTP.
+# Ogni chiamata gira in un pool dedicato con concorrenza limitata e con un limite alle chiamate
+# in attesa: quando il servizio è lento le richieste in eccesso falliscono subito (UpstreamBusy)
+# invece di occupare tutti i thread del server.
+# Le chiamate identiche (stessa chiave, es. la query normalizzata) in corso nello stesso momento
+# vengono unite (single-flight): una sola chiamata al servizio, lo stesso risultato per tutti.
+# Con rate indicato le chiamate partono al massimo rate volte al secondo (token bucket condiviso
+# dai thread del pool): Nominatim pubblico ammette 1 richiesta al secondo.
+# Con più processi worker (scripts/serve.py) il limite va condiviso tra i processi: share_rate()
+# sostituisce il token bucket con SharedTokenBucket, un file con l'istante del prossimo turno
+# aggiornato sotto flock, così il rate vale per l'intero server e non per ogni worker.
+
+
+class TokenBucket:
+    """
+    Rate limiter a token bucket condiviso tra più thread.
+    Ogni richiesta consuma un token; i token si ricaricano a `rate` al secondo fino a `capacity`.
+    @:param rate: Richieste al secondo consentite (es. 1.0 per Nominatim pubblico)
+    @:param capacity: Numero massimo di richieste consecutive senza attesa (burst)
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        if rate <= 0:
+            raise ValueError("Il rate del token bucket deve essere positivo.")
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocca finché non è disponibile un token, poi lo consuma."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedTokenBucket:
+    """
+    Rate limiter condiviso tra processi (equivale a TokenBucket con capacity 1).
+    Il file contiene l'istante (time.time()) del prossimo turno libero: ogni richiesta prenota il
+    turno sotto flock e attende fino al suo arrivo.
+    @:param path: File condiviso dai processi (creato se manca)
+    @:param rate: Richieste al secondo consentite all'insieme dei processi
+    """
+
+    def __init__(self, path: Union[str, Path], rate: float):
+        if fcntl is None:
+            raise RuntimeError("SharedTokenBucket richiede fcntl (non disponibile su questa piattaforma)")
+        if rate <= 0:
+            raise ValueError("Il rate del token bucket deve essere positivo.")
+        self.path = Path(path)
+        self.rate = float(rate)
+
+    def acquire(self):
+        """Prenota il prossimo turno libero e attende fino al suo arrivo."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                slot = float(os.pread(fd, 64, 0) or 0)
+            except ValueError:
+                slot = 0.0
+            now = time.time()
+            slot = max(slot, now)
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, repr(slot + 1.0 / self.rate).encode('ascii'), 0)
+        finally:
+            os.close(fd)
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class UpstreamBusy(Exception):
+    """Troppe chiamate al servizio esterno già in coda."""
+
+
+class UpstreamClient:
+    """
+    Pool limitato con coalescenza delle chiamate per chiave.
+    @:param max_concurrency: Chiamate eseguite contemporaneamente
+    @:param max_pending: Chiamate distinte ammesse tra in esecuzione e in coda
+    @:param rate: Chiamate al secondo (None = nessun limite)
+    """
+
+    def __init__(self, max_concurrency: int = 2, max_pending: int = 32, rate: Optional[float] = None):
+        self.max_pending = max_pending
+        self._bucket = TokenBucket(rate) if rate else None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='upstream')
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        # Contatori (esposti da /metrics): chiamate avviate, unite a una già in corso, rifiutate
+        self.stats = {'submitted': 0, 'coalesced': 0, 'rejected': 0}
+
+    def share_rate(self, path: Union[str, Path]) -> bool:
+        """
+        Condivide il limite di chiamate al secondo con gli altri processi che usano lo stesso file.
+        Va chiamata prima del fork dei worker.
+        @:param path: File del limite condiviso (es. nella cartella METRICS_DIR)
+        @:return: False se il limite non può essere condiviso (fcntl non disponibile)
+        """
+        if self._bucket is None:
+            return True
+        if fcntl is None:
+            return False
+        self._bucket = SharedTokenBucket(path, self._bucket.rate)
+        return True
+
+    def stats_snapshot(self) -> Dict[str, int]:
+        """Copia coerente dei contatori delle chiamate."""
+        with self._lock:
+            return dict(self.stats)
+
+    def pending(self) -> int:
+        """Numero di chiamate distinte in esecuzione o in coda."""
+        with self._lock:
+            return len(self._inflight)
+
+    def submit(self, key: Hashable, fn: Callable[[], Any]) -> Future:
+        """
+        Avvia fn() nel pool, o restituisce la chiamata già in corso con la stessa chiave.
+        @:param key: Chiave della chiamata (richieste con la stessa chiave condividono il risultato)
+        @:param fn: Funzione senza argomenti che interroga il servizio
+        @:return: Future del risultato
+        @:raise UpstreamBusy: Se ci sono già max_pending chiamate distinte
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                return future
+            if len(self._inflight) >= self.max_pending:
+                self.stats['rejected'] += 1
+                raise UpstreamBusy(f"{len(self._inflight)} chiamate in attesa")
+            future = self._executor.submit(self._run, fn)
+            self._inflight[key] = future
+            self.stats['submitted'] += 1
+
+        def _done(_):
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+        future.add_done_callback(_done)
+        return future
+
+    def _run(self, fn: Callable[[], Any]) -> Any:
+        if self._bucket is not None:
+            self._bucket.acquire()
+        return fn()
+
+    def call(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """
+        Esegue (o attende) la chiamata con la chiave indicata e ne restituisce il risultato.
+        Se l'attesa supera timeout la chiamata prosegue comunque nel pool: chi la esegue deve
+        salvare il risultato (es. in cache) perché le richieste successive lo trovino.
+        @:raise UpstreamBusy: Se il pool è saturo
+        @:raise concurrent.futures.TimeoutError: Se il risultato non arriva entro timeout
+        """
+        return self.submit(key, fn).result(timeout=timeout)